@@ -40,14 +40,16 @@ async def onboarding_next_2(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-async def _finish_onboarding(callback: CallbackQuery, users_collection, state: FSMContext):
+async def _finish_onboarding(callback: CallbackQuery, users_collection, state: FSMContext, metrics=None):
     user_id = callback.from_user.id
     try:
-        await users_collection.update_one(
+        result = await users_collection.update_one(
             {"user_id": user_id, "type": "user_profile"},
             {"$set": {"onboarding_completed": True}},
             upsert=True
         )
+        if metrics is not None and (result.modified_count or result.upserted_id is not None):
+            await metrics.record_onboarding_completed(user_id)
     except Exception as e:
         logger.error(f"Ошибка обновления статуса онбординга: {e}")
 
@@ -62,11 +64,11 @@ async def _finish_onboarding(callback: CallbackQuery, users_collection, state: F
 
 
 @router.callback_query(F.data == "onb_finish", StateFilter(states.OnboardingStates.step3))
-async def onboarding_finish(callback: CallbackQuery, users_collection, state: FSMContext):
-    await _finish_onboarding(callback, users_collection, state)
+async def onboarding_finish(callback: CallbackQuery, users_collection, state: FSMContext, metrics=None):
+    await _finish_onboarding(callback, users_collection, state, metrics)
 
 
 @router.callback_query(F.data == "onb_skip", StateFilter(states.OnboardingStates.step1, states.OnboardingStates.step2, states.OnboardingStates.step3))
-async def onboarding_skip(callback: CallbackQuery, users_collection, state: FSMContext):
-    await _finish_onboarding(callback, users_collection, state)
+async def onboarding_skip(callback: CallbackQuery, users_collection, state: FSMContext, metrics=None):
+    await _finish_onboarding(callback, users_collection, state, metrics)
 
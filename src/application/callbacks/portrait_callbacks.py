@@ -8,8 +8,10 @@ from aiogram.exceptions import TelegramBadRequest
 from google.genai import types
 
 from src import config
+from src.domain.services.portrait_input_service import PortraitInputBuilder
+from src.domain.services.portrait_queue_service import PRIORITY_INTERACTIVE, PortraitGenerationError
 from src.presentation import keyboards, photos
-from src.utils.portrait_utils import sanitize_portrait_text, update_portrait_caption_animation
+from src.utils.portrait_utils import sanitize_portrait_text, split_into_pages, update_portrait_caption_animation
 
 logger = logging.getLogger(__name__)
 router = Router()
@@ -17,14 +19,16 @@ router = Router()
 ERROR_MESSAGES = [
     "Ошибка генерации портрета. Попробуйте позже.",
     "К сожалению, в базе данных не найдено достаточно сообщений для анализа.",
-    "Произошла критическая ошибка в системе. Ваш лимит не был исчерпан. Попробуйте, пожалуйста, снова."
+    "Произошла критическая ошибка в системе. Ваш лимит не был исчерпан. Попробуйте, пожалуйста, снова.",
+    "С прошлого портрета новых сообщений не было — он по-прежнему актуален.",
 ]
 
 
 async def _generate_portrait_async(user_id, users_collection, generate_content_sync_func, gemini_client,
-                                   openai_client=None, generate_openai_func=None, alert_func=None, bot=None):
+                                   openai_client=None, generate_openai_func=None, alert_func=None, bot=None,
+                                   message_archive=None, token_estimator=None):
     portrait_prompt_template = (
-        "ТЫ — профессиональный аналитик, специализирующийся на формировании психологического портрета и стиля общения на основе текстовых данных. Твоя задача — проанализировать представленный ниже текст, который является диалогами пользователя.\n\n"
+        "ТЫ — профессиональный аналитик, специализирующийся на формировании психологического портрета и стиля общения на основе текстовых данных. Твоя задача — проанализировать представленные ниже материалы: конспекты сессий и сообщения пользователя, а если есть — и его предыдущий портрет.\n\n"
         "ТВОЙ АНАЛИЗ ДОЛЖЕН СОДЕРЖАТЬ СЛЕДУЮЩИЕ РАЗДЕЛЫ:\n"
         "1.  ОБЩИЙ ЭМОЦИОНАЛЬНЫЙ ФОН: Какие преобладающие эмоции прослеживаются в сообщениях (тревога, неуверенность, стремление к контролю, оптимизм и т.д.)?\n"
         "2.  ПАТТЕРНЫ МЫШЛЕНИЯ И РЕАКЦИЙ: Какие повторяющиеся темы, установки, когнитивные искажения (например, \"все или ничего\", катастрофизация, сверхобобщение) или защитные механизмы можно отметить?\n"
@@ -37,29 +41,27 @@ async def _generate_portrait_async(user_id, users_collection, generate_content_s
         "* Отвечай исключительно на РУССКОМ языке.\n"
         "* Запрещены любые заглушки/примеры вроде 'example text', 'пример текста', 'template', '[...]'. Пиши только фактический анализ.\n"
         "* НИ ПРИ КАКИХ УСЛОВИЯХ НЕ ОТВЕЧАЙ ФРАЗАМИ ТИПА \"Я НЕ СПЕЦИАЛИСТ\" ИЛИ \"ОБРАТИТЕСЬ К ПРОФЕССИОНАЛУ\". Твоя роль — дать анализ.\n\n"
-        "ИСТОРИЯ СООБЩЕНИЙ ПОЛЬЗОВАТЕЛЯ:\n---\n{dialog_text}\n---"
+        "{portrait_input}"
     )
 
-    user_messages_cursor = users_collection.find(
-        {"user_id": user_id, "type": "user_message"},
-        {"text": 1, "username": 1, "_id": 0}
-    ).sort("timestamp", 1).limit(500)
-
-    user_dialogs = []
-    async for doc in user_messages_cursor:
-        text = doc.get('text', '')
-        username = doc.get('username')
-        if username:
-            user_dialogs.append(f"@{username}: {text}")
-        else:
-            user_dialogs.append(text)
-
-    if not user_dialogs:
-        return ERROR_MESSAGES[1]
+    portrait_input = await PortraitInputBuilder(
+        users_collection,
+        token_budget=config.PORTRAIT_INPUT_TOKENS,
+        estimate=token_estimator.estimate if token_estimator is not None else None,
+        message_archive=message_archive
+    ).build(user_id)
+
+    if portrait_input.is_empty:
+        if not portrait_input.prior:
+            return ERROR_MESSAGES[1]
+        # Пересчитывать нечего: новый запрос к модели лишь перефразировал бы прежний портрет.
+        date_str = f"\n\n📅 Последний портрет: {portrait_input.prior_at.strftime('%d.%m.%Y')}." if portrait_input.prior_at else ""
+        return (
+            f"{ERROR_MESSAGES[3]}{date_str}\n\n"
+            "Лимит не потрачен — продолжите общение, и следующий портрет учтёт новые сессии."
+        )
 
-    filtered_dialogs = [msg for msg in user_dialogs if msg.strip()]
-    dialog_text = "\n".join([f"- {msg}" for msg in filtered_dialogs])
-    summary_prompt = portrait_prompt_template.format(dialog_text=dialog_text)
+    summary_prompt = portrait_prompt_template.format(portrait_input=portrait_input.render())
 
     portrait_contents = [
         types.Content(
@@ -94,25 +96,19 @@ async def _generate_portrait_async(user_id, users_collection, generate_content_s
     return portrait_result
 
 
-def _split_into_pages(text: str, max_len: int = 1000) -> list[str]:
-    pages = []
-    text_left = text
-    while text_left:
-        chunk = text_left[:max_len]
-        if len(text_left) > max_len:
-            last_nl = chunk.rfind("\n")
-            last_space = chunk.rfind(" ")
-            cut_at = max(last_nl, last_space)
-            if cut_at > 200:
-                chunk = chunk[:cut_at]
-        pages.append(chunk)
-        text_left = text_left[len(chunk):]
-    return pages
+async def generate_portrait(user_id: int, **deps) -> str:
+    """Готовый текст портрета для очереди; при неудаче — PortraitGenerationError с текстом для пользователя."""
+    result = await _generate_portrait_async(user_id, **deps)
+    if any(err in result for err in ERROR_MESSAGES):
+        raise PortraitGenerationError(result)
+    return sanitize_portrait_text(result)
 
 
 @router.callback_query(F.data == "get_portrait")
 async def get_portrait_handler(callback: CallbackQuery, users_collection, generate_content_sync_func, gemini_client,
-                               state: FSMContext, bot, openai_client=None, generate_openai_func=None, alert_func=None) -> None:
+                               state: FSMContext, bot, openai_client=None, generate_openai_func=None, alert_func=None,
+                               metrics=None, message_archive=None, portrait_queue=None,
+                               token_estimator=None) -> None:
     user_id = callback.from_user.id
     current_time = datetime.now(timezone.utc)
 
@@ -131,6 +127,9 @@ async def get_portrait_handler(callback: CallbackQuery, users_collection, genera
     last_portrait_timestamp_from_db = user_doc.get("last_portrait_timestamp") if user_doc and isinstance(
         user_doc.get("last_portrait_timestamp"), datetime) else None
 
+    # Переключатель ночной генерации показываем, только когда работает очередь портретов.
+    nightly = bool(user_doc and user_doc.get("portrait_nightly")) if portrait_queue is not None else None
+
     last_portrait_timestamp = None
     if last_portrait_timestamp_from_db:
         last_portrait_timestamp = last_portrait_timestamp_from_db.replace(tzinfo=timezone.utc)
@@ -152,27 +151,36 @@ async def get_portrait_handler(callback: CallbackQuery, users_collection, genera
                 portrait_text = last_portrait_doc.get("portrait_text", "")
                 generated_at = last_portrait_doc.get("generated_at")
                 
-                cooldown_info = (
-                    f"⚠️ Психологический портрет можно создавать не чаще, чем раз в {config.PORTRAIT_COOLDOWN_HOURS} часа.\n"
-                    f"Повторная попытка будет доступна через {hours} ч. {minutes} мин.\n\n"
-                )
-                
-                if generated_at:
-                    date_str = generated_at.strftime("%d.%m.%Y в %H:%M")
-                    cooldown_info += f"📅 Последний портрет был сгенерирован {date_str} (UTC)\n\n"
-                
-                cooldown_info += "---\n\n"
+                if last_portrait_doc.get("seen") is False:
+                    # Ночной портрет открывают впервые: показываем его как свежий.
+                    cooldown_info = ""
+                    await users_collection.update_one(
+                        {"_id": last_portrait_doc["_id"], "type": "portrait"},
+                        {"$set": {"seen": True}}
+                    )
+                else:
+                    cooldown_info = (
+                        f"⚠️ Психологический портрет можно создавать не чаще, чем раз в {config.PORTRAIT_COOLDOWN_HOURS} часа.\n"
+                        f"Повторная попытка будет доступна через {hours} ч. {minutes} мин.\n\n"
+                    )
+
+                    if generated_at:
+                        date_str = generated_at.strftime("%d.%m.%Y в %H:%M")
+                        cooldown_info += f"📅 Последний портрет был сгенерирован {date_str} (UTC)\n\n"
+
+                    cooldown_info += "---\n\n"
                 header = "Ваш Психологический Портрет: 🧠\n\n"
                 full_text = f"{cooldown_info}{header}{portrait_text}"
                 
-                pages = _split_into_pages(full_text)
+                pages = split_into_pages(full_text)
                 total_pages = max(1, len(pages))
                 current_page = 1
                 
                 await state.update_data(
                     portrait_pages=pages,
                     portrait_page_idx=current_page,
-                    portrait_message_id=callback.message.message_id
+                    portrait_message_id=callback.message.message_id,
+                    portrait_nightly=nightly
                 )
                 
                 new_media = InputMediaPhoto(
@@ -183,19 +191,19 @@ async def get_portrait_handler(callback: CallbackQuery, users_collection, genera
                 try:
                     await callback.message.edit_media(
                         media=new_media,
-                        reply_markup=keyboards.portrait_pagination_keyboard(current_page, total_pages)
+                        reply_markup=keyboards.portrait_pagination_keyboard(current_page, total_pages, nightly)
                     )
                 except TelegramBadRequest:
                     try:
                         await callback.message.edit_caption(
                             caption=pages[0] if pages else full_text,
-                            reply_markup=keyboards.portrait_pagination_keyboard(current_page, total_pages)
+                            reply_markup=keyboards.portrait_pagination_keyboard(current_page, total_pages, nightly)
                         )
                     except TelegramBadRequest:
                         await callback.message.answer_photo(
                             photo=photos.portrait_photo,
                             caption=pages[0] if pages else full_text,
-                            reply_markup=keyboards.portrait_pagination_keyboard(current_page, total_pages)
+                            reply_markup=keyboards.portrait_pagination_keyboard(current_page, total_pages, nightly)
                         )
             else:
                 await callback.answer(
@@ -214,6 +222,33 @@ async def get_portrait_handler(callback: CallbackQuery, users_collection, genera
 
     await callback.answer(text=alert_message, show_alert=True)
 
+    if portrait_queue is not None:
+        # Генерация уходит в пул воркеров; результат придёт в это же сообщение.
+        queued_caption = "⏳ Портрет в очереди. Я пришлю его сюда, как только он будет готов."
+        try:
+            message_to_edit = await callback.message.edit_media(
+                media=InputMediaPhoto(media=photos.portrait_photo, caption=queued_caption),
+                reply_markup=keyboards.back_to_menu_keyboard
+            )
+        except TelegramBadRequest:
+            message_to_edit = await callback.message.edit_caption(
+                caption=queued_caption,
+                reply_markup=keyboards.back_to_menu_keyboard
+            )
+        message_id = getattr(message_to_edit, "message_id", callback.message.message_id)
+        try:
+            await portrait_queue.enqueue(user_id, callback.message.chat.id, message_id=message_id,
+                                         priority=PRIORITY_INTERACTIVE)
+        except Exception as e:
+            logger.error(f"Failed to enqueue portrait for user {user_id}: {e}")
+            await bot.edit_message_caption(
+                chat_id=callback.message.chat.id,
+                message_id=message_id,
+                caption=ERROR_MESSAGES[2],
+                reply_markup=keyboards.back_to_menu_keyboard
+            )
+        return
+
     initial_caption = "⏳ Начинаю анализ..."
     new_media = InputMediaPhoto(
         media=photos.portrait_photo,
@@ -256,7 +291,9 @@ async def get_portrait_handler(callback: CallbackQuery, users_collection, genera
             openai_client=openai_client,
             generate_openai_func=generate_openai_func,
             alert_func=alert_func,
-            bot=bot
+            bot=bot,
+            message_archive=message_archive,
+            token_estimator=token_estimator
         )
     )
 
@@ -288,6 +325,8 @@ async def get_portrait_handler(callback: CallbackQuery, users_collection, genera
                     upsert=True
                 )
                 logger.info(f"Portrait saved to DB for user {user_id}")
+                if metrics is not None:
+                    await metrics.record_portrait()
             except Exception as e:
                 logger.error(f"Ошибка сохранения портрета в БД: {e}")
         
@@ -312,7 +351,7 @@ async def get_portrait_handler(callback: CallbackQuery, users_collection, genera
         cleaned_portrait = portrait_result
     full_text = f"{header}{cleaned_portrait}" if cleaned_portrait else (ERROR_MESSAGES[0])
 
-    pages = _split_into_pages(full_text)
+    pages = split_into_pages(full_text)
     total_pages = max(1, len(pages))
     current_page = 1
 
@@ -341,6 +380,7 @@ async def portrait_pagination_handler(callback: CallbackQuery, state: FSMContext
     data = await state.get_data()
     pages = data.get("portrait_pages", [])
     msg_id = data.get("portrait_message_id")
+    nightly = data.get("portrait_nightly")
     try:
         requested = int(callback.data.split(":")[1])
     except Exception:
@@ -361,11 +401,36 @@ async def portrait_pagination_handler(callback: CallbackQuery, state: FSMContext
             chat_id=callback.message.chat.id,
             message_id=msg_id or callback.message.message_id,
             caption=pages[requested - 1],
-            reply_markup=keyboards.portrait_pagination_keyboard(requested, total_pages)
+            reply_markup=keyboards.portrait_pagination_keyboard(requested, total_pages, nightly)
         )
     except TelegramBadRequest as e:
         await callback.message.answer(
             text=pages[requested - 1],
-            reply_markup=keyboards.portrait_pagination_keyboard(requested, total_pages)
+            reply_markup=keyboards.portrait_pagination_keyboard(requested, total_pages, nightly)
         )
     await callback.answer()
+
+
+@router.callback_query(F.data.startswith("portrait_nightly:"))
+async def portrait_nightly_toggle_handler(callback: CallbackQuery, state: FSMContext, users_collection):
+    enabled = callback.data.split(":", 1)[1] == "on"
+    await users_collection.update_one(
+        {"user_id": callback.from_user.id, "type": "user_profile"},
+        {"$set": {"portrait_nightly": enabled}},
+        upsert=True
+    )
+    await state.update_data(portrait_nightly=enabled)
+
+    data = await state.get_data()
+    pages = data.get("portrait_pages") or [""]
+    current = data.get("portrait_page_idx") or 1
+    try:
+        await callback.message.edit_reply_markup(
+            reply_markup=keyboards.portrait_pagination_keyboard(current, len(pages), enabled)
+        )
+    except TelegramBadRequest:
+        pass
+    await callback.answer(
+        "🌙 Буду обновлять портрет ночью, если у вас появятся новые сообщения." if enabled
+        else "Ночное обновление портрета выключено."
+    )
@@ -10,11 +10,27 @@ from aiogram.exceptions import TelegramBadRequest
 from src import states, config
 from src.presentation import keyboards, photos, texts
 from src.application.handlers import _save_to_db_async
+from src.domain.services.context_service import ContextService
+from src.domain.services.segment_service import SegmentService
 
 logger = logging.getLogger(__name__)
 router = Router()
 
 
+async def _save_progress_score_async(users_collection, cache, user_id: int, score: int, timestamp: datetime,
+                                     write_buffer=None, metrics=None):
+    await _save_to_db_async(users_collection, {
+        "user_id": user_id,
+        "type": "progress_score",
+        "score": score,
+        "timestamp": timestamp,
+    }, write_buffer)
+    if metrics is not None:
+        await metrics.record_score(score)
+    await ContextService(users_collection, cache).record_progress_score(user_id, score, timestamp)
+    await SegmentService(users_collection).record_progress_score(user_id)
+
+
 async def update_stats_caption_animation(bot, chat_id: int, message_id: int, stop_event: asyncio.Event):
     animation_texts = [
         "📊 Собираю все оценки прогресса...",
@@ -138,7 +154,8 @@ async def start_progress_scale_handler(callback: CallbackQuery, state: FSMContex
 
 
 @router.callback_query(F.data.startswith("set_score:"))
-async def set_score_handler(callback: CallbackQuery, state: FSMContext, users_collection) -> None:
+async def set_score_handler(callback: CallbackQuery, state: FSMContext, users_collection, cache=None,
+                            write_buffer=None, metrics=None) -> None:
     if await state.get_state() != states.MoodStates.waiting_for_score:
         await callback.answer("Ошибка: Опрос не был начат корректно.")
         return
@@ -147,15 +164,7 @@ async def set_score_handler(callback: CallbackQuery, state: FSMContext, users_co
     user_id = callback.from_user.id
     current_time = datetime.now(timezone.utc)
 
-    try:
-        asyncio.create_task(_save_to_db_async(users_collection, {
-            "user_id": user_id,
-            "type": "progress_score",
-            "score": score,
-            "timestamp": current_time,
-        }))
-    except Exception as e:
-        logger.error(f"Error scheduling score save: {e}")
+    await _save_progress_score_async(users_collection, cache, user_id, score, current_time, write_buffer, metrics)
 
     filled = "🟢" * score
     empty = "⚪" * (10 - score)
@@ -1,4 +1,3 @@
-import asyncio
 import logging
 from datetime import datetime, timezone
 from aiogram import Router, F
@@ -10,50 +9,59 @@ from google.genai import types
 
 from src import states, config
 from src.presentation import keyboards, photos, texts
+from src.utils.dialog import Dialog
 
 logger = logging.getLogger(__name__)
 router = Router()
 
 
-async def _save_session_summary_async(collection, session_record):
+async def _save_session_summary_async(collection, session_record, write_buffer=None):
     try:
-        await collection.insert_one(session_record)
+        if write_buffer is not None:
+            await write_buffer.put(session_record)
+        else:
+            await collection.insert_one(session_record)
     except Exception as e:
         logger.error(f"MongoDB error during summary insertion: {e}")
 
 
-async def _load_session_history(user_id, users_collection, state: FSMContext, cache=None):
-    cache_key = f"session_history:{user_id}"
-    if cache is not None:
-        cached = await cache.get(cache_key)
-        if cached:
-            await state.update_data(current_dialog=cached)
-            return
-    
+async def _fetch_session_history(user_id, users_collection) -> list:
     initial_history = []
+    last_summary_record = await users_collection.find_one(
+        {"user_id": user_id, "type": "session_summary"},
+        sort=[("date", -1)]
+    )
+    if last_summary_record and 'summary' in last_summary_record:
+        last_summary = last_summary_record['summary']
+        if last_summary and last_summary.strip():
+            initial_history.append({
+                "role": "user",
+                "content": f"ПРЕДЫДУЩИЙ КОНСПЕКТ СЕССИИ: {last_summary}. Учти его в текущем диалоге."
+            })
+    return initial_history
+
+
+async def _load_session_history(user_id, users_collection, state: FSMContext, cache=None):
     try:
-        last_summary_record = await users_collection.find_one(
-            {"user_id": user_id, "type": "session_summary"},
-            sort=[("date", -1)]
-        )
-        if last_summary_record and 'summary' in last_summary_record:
-            last_summary = last_summary_record['summary']
-            if last_summary and last_summary.strip():
-                initial_history.append({
-                    "role": "user",
-                    "content": f"ПРЕДЫДУЩИЙ КОНСПЕКТ СЕССИИ: {last_summary}. Учти его в текущем диалоге."
-                })
-        
         if cache is not None:
-            await cache.set(cache_key, initial_history, ttl=600)
-        
-        await state.update_data(current_dialog=initial_history)
+            initial_history = await cache.get_or_compute(
+                f"session_history:{user_id}",
+                lambda: _fetch_session_history(user_id, users_collection),
+                ttl=600
+            )
+        else:
+            initial_history = await _fetch_session_history(user_id, users_collection)
+
+        await state.update_data(
+            current_dialog=Dialog.from_state(list(initial_history), max_turns=config.MAX_DIALOG_MESSAGES)
+        )
     except Exception as e:
         logger.error(f"Критическая ошибка при загрузке конспекта для {user_id}: {e}")
 
 
 async def _save_summary_async(session_data, users_collection, generate_content_sync_func, gemini_client,
-                              openai_client=None, generate_openai_func=None, alert_func=None, bot=None):
+                              openai_client=None, generate_openai_func=None, alert_func=None, bot=None,
+                              write_buffer=None, metrics=None):
     user_id = session_data['user_id']
     full_dialog = session_data['full_dialog']
     real_user_message_count = session_data['real_user_message_count']
@@ -125,14 +133,14 @@ async def _save_summary_async(session_data, users_collection, generate_content_s
         "type": "session_summary"
     }
 
-    try:
-        asyncio.create_task(_save_session_summary_async(users_collection, session_record))
-    except Exception as e:
-        logger.error(f"Error scheduling session summary save: {e}")
+    await _save_session_summary_async(users_collection, session_record, write_buffer)
+    if metrics is not None:
+        await metrics.record_session(real_user_message_count)
 
 
 @router.callback_query(F.data == "start_session")
-async def start_session_handler(callback: CallbackQuery, state: FSMContext, users_collection) -> None:
+async def start_session_handler(callback: CallbackQuery, state: FSMContext, users_collection,
+                                session_summarizer=None, write_buffer=None, metrics=None) -> None:
     user_id = callback.from_user.id
     current_time_utc = datetime.now(timezone.utc)
     today_utc = current_time_utc.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=timezone.utc)
@@ -175,6 +183,11 @@ async def start_session_handler(callback: CallbackQuery, state: FSMContext, user
         loading_message = await callback.message.answer(loading_caption, reply_markup=None)
         loading_message_id = loading_message.message_id
 
+    if session_summarizer is not None:
+        # Черновик прошлой сессии, которую не завершили кнопкой, закрываем до начала новой.
+        previous_started_at = (await state.get_data()).get("session_started_at")
+        await session_summarizer.close_session(user_id, previous_started_at)
+
     cache = getattr(callback.bot, '_cache', None) if hasattr(callback, 'bot') else None
     
     await _load_session_history(
@@ -222,15 +235,18 @@ async def start_session_handler(callback: CallbackQuery, state: FSMContext, user
     await state.set_state(states.SessionStates.in_session)
     await state.update_data(
         last_ai_message_id=callback.message.message_id,
-        real_user_message_count=0
+        real_user_message_count=0,
+        session_token_count=None,
+        session_started_at=current_time_utc
     )
 
 
 @router.callback_query(F.data == "end_session", StateFilter(states.SessionStates.in_session))
 async def end_session_handler(callback: CallbackQuery, state: FSMContext, users_collection, generate_content_sync_func,
-                              gemini_client, openai_client=None, generate_openai_func=None, alert_func=None) -> None:
+                              gemini_client, openai_client=None, generate_openai_func=None, alert_func=None,
+                              session_summarizer=None, write_buffer=None, metrics=None) -> None:
     data = await state.get_data()
-    full_dialog = data.get('current_dialog', [])
+    full_dialog = list(Dialog.from_state(data.get('current_dialog'), max_turns=config.MAX_DIALOG_MESSAGES).messages())
     last_ai_message_id = data.get('last_ai_message_id')
     user_id = callback.from_user.id
 
@@ -247,6 +263,8 @@ async def end_session_handler(callback: CallbackQuery, state: FSMContext, users_
     real_user_message_count = data.get('real_user_message_count', 0)
 
     if real_user_message_count < 1:
+        if session_summarizer is not None:
+            await session_summarizer.discard_session(user_id)
         try:
             await callback.message.answer(
                 text="Сессия была слишком короткой (0 сообщений) и не была сохранена."
@@ -267,36 +285,46 @@ async def end_session_handler(callback: CallbackQuery, state: FSMContext, users_
         await callback.answer()
         return
 
-    processing_text = "📝 Создаю конспект и завершаю сессию..."
-    processing_message = await callback.message.answer(text=processing_text)
-
-    session_data = {
-        "user_id": user_id,
-        "full_dialog": full_dialog,
-        "real_user_message_count": real_user_message_count
-    }
-
-    await _save_summary_async(
-        session_data,
-        users_collection,
-        generate_content_sync_func,
-        gemini_client,
-        openai_client=openai_client,
-        generate_openai_func=generate_openai_func,
-        alert_func=alert_func,
-        bot=callback.bot
-    )
+    if session_summarizer is not None and await session_summarizer.close_session(user_id, data.get("session_started_at")):
+        final_text = (
+            f"✅ Сессия завершена! "
+            f"Вы обменялись {real_user_message_count} сообщениями.\n"
+            f"📝 Конспект будет сохранён в течение нескольких секунд."
+        )
+        await callback.message.answer(text=final_text)
+    else:
+        processing_text = "📝 Создаю конспект и завершаю сессию..."
+        processing_message = await callback.message.answer(text=processing_text)
+
+        session_data = {
+            "user_id": user_id,
+            "full_dialog": full_dialog,
+            "real_user_message_count": real_user_message_count
+        }
+
+        await _save_summary_async(
+            session_data,
+            users_collection,
+            generate_content_sync_func,
+            gemini_client,
+            openai_client=openai_client,
+            generate_openai_func=generate_openai_func,
+            alert_func=alert_func,
+            bot=callback.bot,
+            write_buffer=write_buffer,
+            metrics=metrics
+        )
 
-    final_text = (
-        f"✅ Сессия завершена! "
-        f"Вы обменялись {real_user_message_count} сообщениями.\n"
-        f"📝 Конспект сохранен."
-    )
+        final_text = (
+            f"✅ Сессия завершена! "
+            f"Вы обменялись {real_user_message_count} сообщениями.\n"
+            f"📝 Конспект сохранен."
+        )
 
-    try:
-        await processing_message.edit_text(text=final_text)
-    except TelegramBadRequest:
-        await callback.message.answer(text=final_text)
+        try:
+            await processing_message.edit_text(text=final_text)
+        except TelegramBadRequest:
+            await callback.message.answer(text=final_text)
 
     data = await state.get_data()
     saved_style = data.get("ai_style", "default")
@@ -9,16 +9,22 @@ from aiogram.exceptions import TelegramBadRequest
 from src import states
 from src.presentation import keyboards, photos, texts
 from src import tests_data
+from src.domain.services.context_service import ContextService
 
 logger = logging.getLogger(__name__)
 router = Router()
 
 
-async def _save_test_result_async(collection, record):
+async def _save_test_result_async(collection, record, cache=None, write_buffer=None):
     try:
-        await collection.insert_one(record)
+        if write_buffer is not None:
+            await write_buffer.put(record)
+        else:
+            await collection.insert_one(record)
     except Exception as e:
         logger.error(f"MongoDB error saving test result: {e}")
+        return
+    await ContextService(collection, cache).record_test_result(record["user_id"], record)
 
 
 def _likert_options() -> list[tuple[str, str]]:
@@ -164,7 +170,8 @@ async def test_len(callback: CallbackQuery, state: FSMContext) -> None:
 
 
 @router.callback_query(F.data.startswith("test_answer:"), StateFilter(states.TestStates.in_test))
-async def test_answer(callback: CallbackQuery, state: FSMContext, users_collection) -> None:
+async def test_answer(callback: CallbackQuery, state: FSMContext, users_collection, cache=None,
+                      write_buffer=None) -> None:
     val = callback.data.split(":", 1)[1]
     data = await state.get_data()
     test_id: str = data.get("test_id")
@@ -190,10 +197,7 @@ async def test_answer(callback: CallbackQuery, state: FSMContext, users_collecti
             "answers": answers,
             "result": result,
         }
-        try:
-            asyncio.create_task(_save_test_result_async(users_collection, record))
-        except Exception as e:
-            logger.error(f"Error scheduling test result save: {e}")
+        await _save_test_result_async(users_collection, record, cache, write_buffer)
 
         verdict_text = result.get("verdict", "Результаты обработаны.")
         msg_id = data.get("last_question_message_id", callback.message.message_id)
@@ -7,9 +7,14 @@ from aiogram import Router, F
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from src import config
-from src.presentation.prompts import SYSTEM_PROMPT_TEXT
 from src.presentation import keyboards, photos, texts
 from src import states
+from src.utils.token_estimator import estimate_tokens
+from src.utils.dialog import Dialog
+from src.domain.services.context_service import ContextService
+from src.domain.services.prompt_service import PromptBuilder
+from src.domain.services.conversation_service import ConversationWindowBuilder
+from src.utils.stream_utils import ProgressiveMessageEditor
 from google.genai import types
 from aiogram.types import Message
 
@@ -17,6 +22,9 @@ logger = logging.getLogger(__name__)
 
 router = Router()
 
+_inline_prompt_builder = PromptBuilder()
+_default_conversation_window = ConversationWindowBuilder()
+
 _GEMINI_BACKOFF_UNTIL: float | None = None
 
 def _gemini_backoff_seconds() -> int:
@@ -55,7 +63,8 @@ async def _save_user_profile_async(collection, user_id, username, first_name, us
                     "$set": {
                         "username": username,
                         "first_name": first_name,
-                        "last_active": datetime.now(timezone.utc)
+                        "last_active": datetime.now(timezone.utc),
+                        "blacklisted": False
                     },
                     "$setOnInsert": {
                         "created_at": datetime.now(timezone.utc)
@@ -66,165 +75,27 @@ async def _save_user_profile_async(collection, user_id, username, first_name, us
     except Exception as e:
         logger.error(f"Ошибка сохранения/обновления профиля пользователя: {e}")
 
-async def _save_to_db_async(collection, data):
+async def _save_to_db_async(collection, data, write_buffer=None):
     try:
-        await collection.insert_one(data)
+        if write_buffer is not None:
+            await write_buffer.put(data)
+        else:
+            await collection.insert_one(data)
     except Exception as e:
         logger.error(f"Ошибка сохранения данных в MongoDB в фоновом режиме: {e}")
 
 
-def _get_time_of_day() -> str:
-    now = datetime.now(timezone.utc)
-    hour = now.hour
-    
-    if 5 <= hour < 12:
-        return "утро"
-    elif 12 <= hour < 17:
-        return "день"
-    elif 17 <= hour < 22:
-        return "вечер"
-    else:
-        return "ночь"
-
-
-async def _load_user_context(users_collection, user_id: int) -> str:
-    context_parts = []
-    
-    time_of_day = _get_time_of_day()
-    time_emoji = {"утро": "🌅", "день": "☀️", "вечер": "🌆", "ночь": "🌙"}.get(time_of_day, "🕐")
-    context_parts.append(f"{time_emoji} Сейчас {time_of_day} (по UTC).")
-    
-    try:
-        test_results_cursor = users_collection.find(
-            {"user_id": user_id, "type": "test_result"}
-        ).sort("finished_at", -1).limit(5)
-        
-        test_results = []
-        async for doc in test_results_cursor:
-            test_title = doc.get("test_title", "Неизвестный тест")
-            test_id = doc.get("test_id", "")
-            result = doc.get("result", {})
-            verdict = result.get("verdict", "")
-            
-            finished_at = doc.get("finished_at")
-            date_str = ""
-            if finished_at:
-                if isinstance(finished_at, datetime):
-                    date_str = finished_at.strftime("%d.%m.%Y")
-                else:
-                    try:
-                        date_str = datetime.fromisoformat(str(finished_at)).strftime("%d.%m.%Y")
-                    except:
-                        pass
-            
-            date_prefix = f"[{date_str}] " if date_str else ""
-            
-            if result.get("type") == "mbti":
-                code = result.get("code", "")
-                description = result.get("description", "")
-                if description:
-                    short_desc = description[:200] + "..." if len(description) > 200 else description
-                    test_results.append(f"- {date_prefix}{test_title}: тип личности {code}. {short_desc}")
-                else:
-                    test_results.append(f"- {date_prefix}{test_title}: тип личности {code}")
-            elif result.get("type") == "likert_multi":
-                if "emotional" in test_id:
-                    averages = result.get("averages", {})
-                    if averages:
-                        stress = averages.get("stress", 0)
-                        anxiety = averages.get("anxiety", 0)
-                        burnout = averages.get("burnout", 0)
-                        interpretation = []
-                        if stress >= 4.0:
-                            interpretation.append("высокий уровень стресса")
-                        elif stress >= 3.0:
-                            interpretation.append("умеренный стресс")
-                        if anxiety >= 4.0:
-                            interpretation.append("высокая тревожность")
-                        elif anxiety >= 3.0:
-                            interpretation.append("умеренная тревожность")
-                        if burnout >= 4.0:
-                            interpretation.append("высокий риск выгорания")
-                        elif burnout >= 3.0:
-                            interpretation.append("признаки выгорания")
-                        
-                        interp_text = f" ({', '.join(interpretation)})" if interpretation else ""
-                        test_results.append(
-                            f"- {date_prefix}{test_title}: "
-                            f"стресс {stress:.1f}/5, тревожность {anxiety:.1f}/5, "
-                            f"выгорание {burnout:.1f}/5{interp_text}"
-                        )
-                    else:
-                        short_verdict = verdict[:200] + "..." if len(verdict) > 200 else verdict
-                        test_results.append(f"- {date_prefix}{test_title}: {short_verdict}")
-                elif "attachment" in test_id:
-                    short_verdict = verdict[:200] + "..." if len(verdict) > 200 else verdict
-                    test_results.append(f"- {date_prefix}{test_title}: {short_verdict}")
-                elif "love" in test_id:
-                    short_verdict = verdict[:200] + "..." if len(verdict) > 200 else verdict
-                    test_results.append(f"- {date_prefix}{test_title}: {short_verdict}")
-                else:
-                    short_verdict = verdict[:200] + "..." if len(verdict) > 200 else verdict
-                    test_results.append(f"- {date_prefix}{test_title}: {short_verdict}")
-        
-        if test_results:
-            context_parts.append("\n📊 Результаты последних тестов пользователя (это психологические тесты, которые пользователь проходил ранее):")
-            context_parts.extend(test_results[:3])
-            context_parts.append("Используй эти результаты для понимания текущего состояния пользователя и его психологических особенностей.")
-    except Exception as e:
-        logger.error(f"Ошибка загрузки результатов тестов: {e}")
-    
+async def _calibrate_token_estimator(token_estimator, count_tokens_func, gemini_client, text: str):
     try:
-        progress_scores_cursor = users_collection.find(
-            {"user_id": user_id, "type": "progress_score"}
-        ).sort("timestamp", -1).limit(10)
-        
-        progress_scores = []
-        score_values = []
-        async for doc in progress_scores_cursor:
-            score = doc.get("score", 0)
-            timestamp = doc.get("timestamp")
-            if timestamp:
-                date_str = timestamp.strftime("%d.%m.%Y")
-                progress_scores.append(f"{date_str}: {score}/10")
-                score_values.append(score)
-        
-        if progress_scores:
-            context_parts.append("\n📈 Последние оценки прогресса (дневник эмоций):")
-            context_parts.append(", ".join(progress_scores[:5]))
-            
-            if len(score_values) >= 2:
-                latest = score_values[0]
-                previous = score_values[1]
-                avg_recent = sum(score_values[:5]) / min(5, len(score_values))
-                
-                trend_info = []
-                if latest > previous:
-                    trend_info.append("тенденция к улучшению")
-                elif latest < previous:
-                    trend_info.append("тенденция к снижению")
-                else:
-                    trend_info.append("стабильное состояние")
-                
-                if avg_recent >= 7:
-                    trend_info.append("в целом хорошее состояние")
-                elif avg_recent <= 4:
-                    trend_info.append("требуется поддержка")
-                
-                if trend_info:
-                    context_parts.append(f"({', '.join(trend_info)}, среднее за последние оценки: {avg_recent:.1f}/10)")
-            elif len(score_values) == 1:
-                latest = score_values[0]
-                if latest >= 7:
-                    context_parts.append("(хорошее состояние)")
-                elif latest <= 4:
-                    context_parts.append("(требуется поддержка)")
+        response = await count_tokens_func(
+            gemini_client,
+            'gemini-3-flash-preview',
+            [types.Content(role="user", parts=[types.Part(text=text)])],
+        )
+        if response and hasattr(response, 'total_tokens'):
+            token_estimator.calibrate(text, response.total_tokens)
     except Exception as e:
-        logger.error(f"Ошибка загрузки оценок прогресса: {e}")
-    
-    if len(context_parts) > 1:
-        return "\n".join(context_parts)
-    return context_parts[0] if context_parts else ""
+        logger.warning(f"Token estimator calibration failed: {e}")
 
 
 @router.message(Command("health"))
@@ -242,6 +113,12 @@ async def health_handler(message: Message, health_checker=None) -> None:
         status_text += f"📊 База данных: {services['database'].get('status', 'unknown')}\n"
         status_text += f"🤖 Gemini API: {services['gemini_api'].get('status', 'unknown')} ({services['gemini_api'].get('state', 'N/A')})\n"
         status_text += f"🧠 OpenAI API: {services['openai_api'].get('status', 'unknown')} ({services['openai_api'].get('state', 'N/A')})\n"
+        cache_status = services.get('cache', {})
+        if 'hit_rate' in cache_status:
+            status_text += (
+                f"🗄️ Кэш ({cache_status.get('backend', 'memory')}): "
+                f"hit rate {cache_status['hit_rate'] * 100:.1f}%, вытеснено {cache_status.get('evictions', 0)}\n"
+            )
         
         if services['database'].get('error'):
             status_text += f"\n⚠️ Ошибка БД: {services['database']['error']}"
@@ -253,14 +130,14 @@ async def health_handler(message: Message, health_checker=None) -> None:
 
 
 @router.message(Command("start"))
-async def start_handler(message: Message, state: FSMContext, users_collection) -> None:
+async def start_handler(message: Message, state: FSMContext, users_collection, metrics=None) -> None:
     await state.set_state(states.SessionStates.idle)
 
     user = message.from_user
     try:
         from src.domain.services.user_service import UserService
         cache = getattr(message.bot, '_cache', None) if hasattr(message, 'bot') else None
-        user_service = UserService(users_collection, cache)
+        user_service = UserService(users_collection, cache, metrics)
         asyncio.create_task(user_service.save_user_profile_async(
             user.id,
             user.username,
@@ -334,12 +211,15 @@ async def non_text_in_session_handler(message: Message) -> None:
 
 @router.message(StateFilter(states.SessionStates.in_session))
 async def echo_handler(message: Message, state: FSMContext, generate_content_sync_func, users_collection, bot,
-                       gemini_client, count_tokens_sync_func, openai_client=None, generate_openai_func=None, alert_func=None) -> None:
+                       gemini_client, count_tokens_sync_func, openai_client=None, generate_openai_func=None, alert_func=None,
+                       token_estimator=None, stream_content_func=None, merged_text=None,
+                       prompt_builder=None, conversation_window=None, session_summarizer=None,
+                       write_buffer=None, metrics=None) -> None:
     if not message or not message.from_user:
         logger.error("Invalid message object in echo_handler")
         return
     
-    user_text = message.text or ""
+    user_text = merged_text or message.text or ""
     user_id = message.from_user.id
     chat_id = message.chat.id if message.chat else user_id
     username = message.from_user.username or ""
@@ -354,24 +234,9 @@ async def echo_handler(message: Message, state: FSMContext, generate_content_syn
     current_data = await state.get_data()
     ai_style = current_data.get("ai_style", "default")
 
-    style_modifier = ""
-    if ai_style == "empathy":
-        style_modifier = (
-            "ТВОЙ ПРИОРИТЕТ: Сейчас ты должен быть максимально эмпатичным и поддерживающим. "
-            "Фокусируйся на валидации чувств пользователя, покажи, что ты слышишь его боль. "
-            "Уменьши количество прямых вопросов, увеличь количество фраз сочувствия."
-        )
-    elif ai_style == "action":
-        style_modifier = (
-            "ТВОЙ ПРИОРИТЕТ: Ты должен быть максимально практичным и ориентированным на действия. "
-            "Избегай лишних фраз сочувствия. Сразу предлагай конкретные шаги, формулируй задачи "
-            "и фокусируйся на плане действий. В выводах '3-2-1' делай упор на '1️⃣ Действие'."
-        )
+    max_msgs = getattr(config, "MAX_DIALOG_MESSAGES", 20)
+    dialog = Dialog.from_state(current_data.get("current_dialog"), max_turns=max_msgs)
 
-    history = current_data.get("current_dialog", [])
-    if not isinstance(history, list):
-        history = []
-    
     last_ai_message_id = current_data.get('last_ai_message_id')
 
     if last_ai_message_id:
@@ -386,81 +251,40 @@ async def echo_handler(message: Message, state: FSMContext, generate_content_syn
         except Exception as e:
             logger.warning(f"Error editing message markup: {e}")
 
-    is_summary_present = (
-            len(history) > 0 and
-            isinstance(history[0], dict) and
-            history[0].get('content', '').startswith("ПРЕДЫДУЩИЙ КОНСПЕКТ СЕССИИ:")
-    )
-    summary_content_dict = history[0] if is_summary_present else None
-
-    dialog_messages_only = history[1:] if is_summary_present else (history.copy() if history else [])
+    summary_content_dict = dialog.summary_message()
 
-    user_message_content_dict = {"role": "user", "content": user_text}
-    dialog_messages_only.append(user_message_content_dict)
-    max_msgs = getattr(config, "MAX_DIALOG_MESSAGES", 20)
-    if len(dialog_messages_only) > max_msgs:
-        dialog_messages_only = dialog_messages_only[-max_msgs:]
-
-    try:
-        from src.domain.services.context_service import ContextService
-        cache = getattr(bot, '_cache', None)
-        context_service = ContextService(users_collection, cache)
-        user_context = await context_service.load_user_context(user_id)
-    except Exception as e:
-        logger.error(f"Error loading context via service: {e}, falling back to old method")
-        user_context = await _load_user_context(users_collection, user_id)
-    
-    context_section = ""
-    if user_context:
-        context_section = (
-            f"\n\n### КОНТЕКСТ ПОЛЬЗОВАТЕЛЯ:\n{user_context}\n\n"
-            "ВАЖНО: Используй эту информацию для более персонализированного ответа:\n"
-            "- Если сейчас ночь, упомяни это естественно (например: 'Глубокая ночь, а мысли не отпускают?')\n"
-            "- РЕЗУЛЬТАТЫ ТЕСТОВ: Это психологические тесты, которые пользователь проходил ранее. "
-            "Если видишь высокий уровень стресса (≥4/5), тревожности (≥4/5) или выгорания (≥4/5) - будь более поддерживающим и эмпатичным. "
-            "Если видишь тип личности MBTI - учитывай особенности этого типа в общении. "
-            "Используй эту информацию естественно, не перечисляя явно, но учитывая в своих ответах.\n"
-            "- ОЦЕНКИ ПРОГРЕССА: Это дневник эмоций пользователя (шкала 1-10). "
-            "Если есть тенденция к улучшению - отметь это поддержкой; если к снижению - прояви больше эмпатии и предложи исследовать причины.\n"
-            "- Не перечисляй все данные явно, но используй их для понимания состояния пользователя\n"
-            "- Если видишь противоречия (например, высокий стресс по тесту, но хорошие оценки прогресса), мягко исследуй это в диалоге"
-        )
+    context_service = ContextService(users_collection, getattr(bot, '_cache', None))
+    user_context = await context_service.load_user_context(user_id)
     
-    base_prompt_with_style = f"{SYSTEM_PROMPT_TEXT}{context_section}\n\n{style_modifier}"
-
-    if is_summary_present and summary_content_dict:
-        final_system_prompt = f"{summary_content_dict['content']}\n\n{base_prompt_with_style}"
-        logger.info("Конспект, контекст пользователя и акцент добавлены в системную инструкцию.")
-    else:
-        final_system_prompt = base_prompt_with_style
-        if user_context:
-            logger.info(f"Используется акцент: {ai_style}, контекст пользователя загружен.")
-        else:
-            logger.info(f"Используется акцент: {ai_style}")
+    if prompt_builder is None:
+        prompt_builder = _inline_prompt_builder
+    summary_text = summary_content_dict['content'] if summary_content_dict else ""
+    # Реплики, выпавшие из окна и из буфера Dialog, представлены свёрнутым конспектом текущей сессии.
+    session_summary = ""
+    if session_summarizer is not None:
+        session_summary = await session_summarizer.running_summary(user_id, current_data.get("session_started_at"))
+    prompt = await prompt_builder.prepare(ai_style, user_context, summary_text, session_summary)
+    final_system_prompt = prompt.system_instruction
+    logger.info(
+        f"Используется акцент: {ai_style}"
+        f"{', конспект добавлен' if summary_text else ''}"
+        f"{', конспект текущей сессии' if session_summary else ''}"
+        f"{', кэш префикса Gemini' if prompt.cached_content else ''}"
+    )
 
-    new_contents_gemini = []
+    if conversation_window is None:
+        conversation_window = _default_conversation_window
     try:
-        for item in dialog_messages_only:
-            if not item or not isinstance(item, dict):
-                continue
-            role = item.get('role', 'user')
-            content = item.get('content', '')
-            if content:
-                new_contents_gemini.append(
-                    types.Content(
-                        role=role,
-                        parts=[types.Part(text=str(content))]
-                    )
-                )
+        # Реплика пользователя попадает в буфер только вместе с ответом, в конце хода.
+        window = conversation_window.build(dialog.with_turn("user", user_text))
+        new_contents_gemini = window.contents
+        if window.dropped:
+            logger.info(f"В окно диалога вошло {len(window.contents)} реплик (~{window.tokens} токенов), "
+                        f"{window.dropped} старых реплик не отправлены")
     except Exception as e:
         logger.error(f"Error creating Gemini contents: {e}")
-    new_contents_gemini = [
-        types.Content(
-                role="user",
-                parts=[types.Part(text=user_text)]
-            )
-        ]
-    
+        new_contents_gemini = []
+
     if not new_contents_gemini:
         logger.error("Empty contents for Gemini, using fallback")
         new_contents_gemini = [
@@ -468,32 +292,25 @@ async def echo_handler(message: Message, state: FSMContext, generate_content_syn
                 role="user",
                 parts=[types.Part(text=user_text)]
             )
-    ]
+        ]
 
-    total_token_count = 0
-    token_task = None
+    _estimate = token_estimator.estimate if token_estimator is not None else estimate_tokens
 
-    if not gemini_client or not count_tokens_sync_func:
-        logger.warning("Gemini client or count_tokens function not available, skipping token count")
-    else:
+    session_token_count = current_data.get("session_token_count")
+    if not isinstance(session_token_count, int):
+        session_token_count = sum(
+            _estimate(item["content"]) for item in dialog.messages()
+        )
+    total_token_count = session_token_count + _estimate(user_text)
+
+    if (token_estimator is not None and gemini_client and count_tokens_sync_func
+            and token_estimator.begin_calibration()):
         try:
-                token_task = asyncio.create_task(
-                    count_tokens_sync_func(
-                gemini_client,
-                'gemini-3-flash-preview',
-                new_contents_gemini,
-            )
-                )
+            asyncio.create_task(_calibrate_token_estimator(
+                token_estimator, count_tokens_sync_func, gemini_client, user_text
+            ))
         except Exception as e:
-            logger.error(f"Error starting token count: {e}")
-        
-        if token_task:
-            try:
-                token_response = await token_task
-                if token_response and hasattr(token_response, 'total_tokens'):
-                    total_token_count = token_response.total_tokens
-            except Exception as e:
-                logger.error(f"Error counting tokens: {e}")
+            logger.error(f"Error scheduling token estimator calibration: {e}")
 
     if total_token_count >= config.MAX_TOKENS_PER_SESSION:
         await message.answer(
@@ -509,6 +326,9 @@ async def echo_handler(message: Message, state: FSMContext, generate_content_syn
                 pass
         return
 
+    stream_editor = None
+    generation_started_at = time.monotonic()
+
     try:
         thinking_message = await message.answer("...")
     except Exception as e:
@@ -518,16 +338,25 @@ async def echo_handler(message: Message, state: FSMContext, generate_content_syn
         animation_task = None
     else:
         stop_event = asyncio.Event()
-        try:
-            animation_task = asyncio.create_task(
-            update_thinking_message(
+        animation_task = None
+        if stream_content_func is not None:
+            stream_editor = ProgressiveMessageEditor(
                 bot,
                 chat_id,
                 thinking_message.message_id,
-                stop_event))   
-        except Exception as e:
-            logger.error(f"Error starting animation task: {e}")
-            animation_task = None
+                min_interval=getattr(config, "STREAM_EDIT_INTERVAL_SEC", 1.0)
+            )
+            stream_editor.start()
+        else:
+            try:
+                animation_task = asyncio.create_task(
+                update_thinking_message(
+                    bot,
+                    chat_id,
+                    thinking_message.message_id,
+                    stop_event))
+            except Exception as e:
+                logger.error(f"Error starting animation task: {e}")
 
     ai_response = "Извините, модель поставщика на данный момент перегружена. Попробуйте повторить последнее сообщение! Если ошибка повторяется, завершите сессию."
 
@@ -577,11 +406,7 @@ async def echo_handler(message: Message, state: FSMContext, generate_content_syn
         
         for model in ("gpt-4.1", "gpt-5-chat-latest"):
             try:
-                if not dialog_messages_only:
-                    logger.warning("Empty dialog for OpenAI fallback")
-                    break
-                
-                joined_dialog = "\n".join([f"{m.get('role', 'user')}: {m.get('content', '')}" for m in dialog_messages_only])
+                joined_dialog = "\n".join(f"{t.role_name}: {t.content}" for t in dialog.with_turn("user", user_text))
                 if not joined_dialog.strip():
                     logger.warning("Empty dialog text for OpenAI fallback")
                     break
@@ -629,17 +454,46 @@ async def echo_handler(message: Message, state: FSMContext, generate_content_syn
             if not gemini_client:
                 raise RuntimeError("Gemini client not initialized")
             
-            ai_response_obj = await generate_content_sync_func(
-                gemini_client,
-                'gemini-3-flash-preview',
-                new_contents_gemini,
-                final_system_prompt
-            )
-            
-            if not ai_response_obj or not hasattr(ai_response_obj, 'text'):
-                raise RuntimeError("Invalid response from Gemini API")
-            
-            ai_response = ai_response_obj.text
+            async def _call_gemini(contents, system_instruction, cached_content=None):
+                if stream_editor is not None:
+                    return await stream_content_func(
+                        gemini_client,
+                        'gemini-3-flash-preview',
+                        contents,
+                        system_instruction,
+                        on_chunk=stream_editor.update,
+                        cached_content=cached_content
+                    )
+                response_obj = await generate_content_sync_func(
+                    gemini_client,
+                    'gemini-3-flash-preview',
+                    contents,
+                    system_instruction,
+                    cached_content=cached_content
+                )
+                if not response_obj or not hasattr(response_obj, 'text'):
+                    raise RuntimeError("Invalid response from Gemini API")
+                return response_obj.text
+
+            if prompt.cached_content:
+                try:
+                    ai_response = await _call_gemini(
+                        prompt.with_context(new_contents_gemini),
+                        None,
+                        prompt.cached_content
+                    )
+                except Exception as e:
+                    streamed = stream_editor is not None and stream_editor.first_chunk_at is not None
+                    if streamed or not prompt_builder.is_cache_error(e):
+                        raise
+                    logger.warning(f"Gemini context cache rejected, retrying with inline prompt: {e}")
+                    prompt_builder.invalidate(ai_style)
+                    ai_response = await _call_gemini(new_contents_gemini, final_system_prompt)
+            else:
+                ai_response = await _call_gemini(new_contents_gemini, final_system_prompt)
+
+            if stream_editor is not None and stream_editor.first_chunk_at is not None:
+                logger.info(f"Gemini stream TTFT: {stream_editor.first_chunk_at - generation_started_at:.2f}s")
             if not ai_response or not ai_response.strip():
                 raise RuntimeError("Empty response from Gemini API")
             
@@ -678,6 +532,9 @@ async def echo_handler(message: Message, state: FSMContext, generate_content_syn
     if stop_event:
         stop_event.set()
 
+    if stream_editor is not None:
+        await stream_editor.stop()
+
     if animation_task:
         try:
             await animation_task
@@ -720,47 +577,42 @@ async def echo_handler(message: Message, state: FSMContext, generate_content_syn
     current_time = datetime.now(timezone.utc)
 
     if users_collection is not None:
-        try:
-            asyncio.create_task(_save_to_db_async(users_collection, {
-                "user_id": user_id,
-                "type": "user_message",
-                "text": user_text,
-                "timestamp": current_time,
-                "username": username,
-            }))
-        except Exception as e:
-            logger.error(f"Error scheduling user message save: {e}")
-
-        try:
-            asyncio.create_task(_save_to_db_async(users_collection, {
-                "user_id": user_id,
-                "type": "model_response",
-                "text": ai_response,
-                "timestamp": current_time,
-            }))
-        except Exception as e:
-            logger.error(f"Error scheduling AI response save: {e}")
+        await _save_to_db_async(users_collection, {
+            "user_id": user_id,
+            "type": "user_message",
+            "text": user_text,
+            "timestamp": current_time,
+            "username": username,
+        }, write_buffer)
+
+        await _save_to_db_async(users_collection, {
+            "user_id": user_id,
+            "type": "model_response",
+            "text": ai_response,
+            "timestamp": current_time,
+        }, write_buffer)
+
+    if metrics is not None:
+        await metrics.record_message(user_id)
+
+    if session_summarizer is not None and ai_response:
+        # Ждём запись (один upsert), чтобы «Закончить сессию» не обогнало последнюю реплику.
+        await session_summarizer.record_turn(user_id, user_text, ai_response)
 
     try:
+        dialog.add("user", user_text)
         if ai_response:
-            dialog_messages_only.append({"role": "model", "content": ai_response})
-    
-        if len(dialog_messages_only) > max_msgs:
-            dialog_messages_only = dialog_messages_only[-max_msgs:]
-
-        history_to_save = dialog_messages_only.copy() if dialog_messages_only else []
-
-        if is_summary_present and summary_content_dict:
-            history_to_save.insert(0, summary_content_dict)
-            logger.info("Конспект возвращен в историю для FSMContext (индекс 0).")
+            dialog.add("model", ai_response)
 
         real_user_message_count = current_data.get("real_user_message_count", 0) + 1
+        session_token_count = total_token_count + (_estimate(ai_response) if ai_response else 0)
 
         message_id = final_message.message_id if final_message and hasattr(final_message, 'message_id') else None
         await state.update_data(
-            current_dialog=history_to_save,
-                last_ai_message_id=message_id,
-            real_user_message_count=real_user_message_count
+            current_dialog=dialog,
+            last_ai_message_id=message_id,
+            real_user_message_count=real_user_message_count,
+            session_token_count=session_token_count
         )
     except Exception as e:
         logger.error(f"Error updating state: {e}")
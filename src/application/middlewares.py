@@ -0,0 +1,129 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+from src import states
+
+logger = logging.getLogger(__name__)
+
+
+class _UserSlot:
+    __slots__ = ("queue", "task", "pending")
+
+    def __init__(self, max_pending: int):
+        self.queue: "asyncio.Queue[tuple]" = asyncio.Queue(maxsize=max_pending)
+        self.task: Optional[asyncio.Task] = None
+        self.pending: list[Message] = []
+
+
+class UserSerializationMiddleware(BaseMiddleware):
+    """Обрабатывает апдейты одного пользователя строго по очереди.
+
+    Апдейт кладётся в очередь пользователя, а разбирает её отдельная задача этого пользователя,
+    так что воркер вебхука возвращается сразу и не простаивает на чужой блокировке. Воркер ждёт
+    только при переполнении очереди одного пользователя — это его личный back-pressure.
+    Сообщения, пришедшие в сессии, пока предыдущее ещё обрабатывается,
+    склеиваются в один запрос к модели (если включено merge_messages).
+    """
+
+    def __init__(self, merge_messages: bool = True, merge_separator: str = "\n\n", max_pending: int = 20):
+        self.merge_messages = merge_messages
+        self.merge_separator = merge_separator
+        self.max_pending = max_pending
+        self._slots: Dict[int, _UserSlot] = {}
+        self.merged_messages = 0
+
+    @staticmethod
+    def _user_id(event: TelegramObject) -> Optional[int]:
+        if isinstance(event, (Message, CallbackQuery)) and event.from_user:
+            return event.from_user.id
+        return None
+
+    def _is_mergeable(self, event: TelegramObject, data: Dict[str, Any]) -> bool:
+        return (
+            self.merge_messages
+            and isinstance(event, Message)
+            and bool(event.text)
+            and not event.text.startswith("/")
+            and data.get("raw_state") == states.SessionStates.in_session.state
+        )
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user_id = self._user_id(event)
+        if user_id is None:
+            return await handler(event, data)
+
+        slot = self._slots.get(user_id)
+        if slot is None:
+            slot = self._slots[user_id] = _UserSlot(self.max_pending)
+
+        mergeable = self._is_mergeable(event, data)
+        if mergeable:
+            slot.pending.append(event)
+        await slot.queue.put((handler, event, data, mergeable))
+        if slot.task is None:
+            slot.task = asyncio.create_task(self._drain(user_id, slot))
+        return None
+
+    async def _drain(self, user_id: int, slot: _UserSlot) -> None:
+        try:
+            while not slot.queue.empty():
+                handler, event, data, mergeable = slot.queue.get_nowait()
+                try:
+                    await self._process(user_id, slot, handler, event, data, mergeable)
+                except Exception as e:
+                    logger.error(f"Error processing update of user {user_id}: {e}", exc_info=True)
+        finally:
+            slot.task = None
+            if slot.queue.empty() and self._slots.get(user_id) is slot:
+                self._slots.pop(user_id, None)
+
+    async def _process(self, user_id: int, slot: _UserSlot, handler, event: TelegramObject,
+                       data: Dict[str, Any], mergeable: bool) -> Any:
+        state = data.get("state")
+        if state is not None:
+            # Пока апдейт ждал в очереди, предыдущий мог сменить состояние.
+            data["raw_state"] = await state.get_state()
+
+        if mergeable:
+            if not any(m is event for m in slot.pending):
+                # Текст уже ушёл в модель вместе с предыдущим сообщением.
+                return None
+            if data.get("raw_state") != states.SessionStates.in_session.state:
+                # Сессия закончилась, пока сообщение ждало: склеивать больше не во что,
+                # каждое из ожидающих сообщений обработается отдельно в новом состоянии.
+                slot.pending = [m for m in slot.pending if m is not event]
+            else:
+                batch, slot.pending = slot.pending, []
+                if len(batch) > 1:
+                    self.merged_messages += len(batch) - 1
+                    data["merged_text"] = self.merge_separator.join(m.text for m in batch)
+                    logger.info(f"Merged {len(batch)} consecutive messages from user {user_id}")
+
+        return await handler(event, data)
+
+    async def close(self, timeout: float = 10.0) -> None:
+        """Дожидается разбора уже принятых апдейтов, затем отменяет оставшиеся очереди."""
+        tasks = [slot.task for slot in self._slots.values() if slot.task is not None]
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if pending:
+            logger.warning(f"{len(pending)} users still had queued updates after {timeout}s, dropped")
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "active_users": len(self._slots),
+            "merged_messages": self.merged_messages,
+        }
@@ -27,6 +27,19 @@ if not DB_NAME:
     print("ERROR: DB_NAME environment variable is not set", file=sys.stderr)
     sys.exit(1)
 
+BOT_MODE: str = (os.getenv("BOT_MODE") or "polling").lower()
+WEBHOOK_BASE_URL: str = os.getenv("WEBHOOK_BASE_URL") or ""
+WEBHOOK_PATH: str = os.getenv("WEBHOOK_PATH") or "/telegram/webhook"
+WEBHOOK_SECRET: str = os.getenv("WEBHOOK_SECRET") or ""
+WEBAPP_HOST: str = os.getenv("WEBAPP_HOST") or "0.0.0.0"
+WEBAPP_PORT: int = int(os.getenv("PORT") or 8080)
+WEBHOOK_QUEUE_SIZE = 1000
+WEBHOOK_WORKERS = 16
+
+if BOT_MODE == "webhook" and not WEBHOOK_BASE_URL:
+    print("ERROR: WEBHOOK_BASE_URL environment variable is required for BOT_MODE=webhook", file=sys.stderr)
+    sys.exit(1)
+
 SYSTEM_PROMPT_TEXT: str = (
     
     
@@ -73,15 +86,54 @@ SYSTEM_PROMPT_TEXT: str = (
 
 CHAT_COLLECTION = "chats"
 USERS_COLLECTION = "users_data"
+# single — всё в USERS_COLLECTION; dual — запись в обе раскладки на время миграции; split — коллекция на тип.
+STORAGE_LAYOUT = os.getenv("STORAGE_LAYOUT", "single")
 
 MAX_SESSIONS_PER_DAY = 3
 MAX_TOKENS_PER_SESSION = 10000
 MAX_DIALOG_MESSAGES = 20
+CONVERSATION_WINDOW_TOKENS = 4000
+SUMMARY_FOLD_EVERY_TURNS = 6
+SESSION_IDLE_TIMEOUT_MIN = int(os.getenv("SESSION_IDLE_TIMEOUT_MIN") or 60)
+SESSION_SWEEP_INTERVAL_SEC = 300
+# Реплики старше этого срока сжимаются в месячные бакеты архива.
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.getenv("MESSAGE_ARCHIVE_AFTER_DAYS") or 90)
+MESSAGE_ARCHIVE_INTERVAL_SEC = 3600
+WRITE_BUFFER_MAX_BATCH = 200
+WRITE_BUFFER_FLUSH_INTERVAL_SEC = 0.5
+WRITE_BUFFER_MAX_PENDING = 10_000
+ADMIN_METRICS_CONCURRENCY = 4
+ADMIN_METRIC_SLOW_SEC = 1.0
+TOKEN_ESTIMATOR_CALIBRATE_EVERY = 25
+STREAMING_ENABLED = os.getenv("STREAMING_ENABLED", "1") == "1"
+STREAM_EDIT_INTERVAL_SEC = 1.0
+MAX_CONCURRENT_LLM_CALLS = int(os.getenv("MAX_CONCURRENT_LLM_CALLS") or 32)
+MERGE_RAPID_MESSAGES = os.getenv("MERGE_RAPID_MESSAGES", "1") == "1"
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE_ENABLED", "1") == "1"
+PROMPT_CACHE_TTL_SEC = 3600
 PORTRAIT_COOLDOWN_HOURS = 24
+# Бюджет входа портрета: прошлый портрет, конспекты сессий после него и новые сообщения.
+PORTRAIT_INPUT_TOKENS = 12000
+PORTRAIT_WORKERS = int(os.getenv("PORTRAIT_WORKERS") or 2)
+# Ночная генерация для подписавшихся: окно по UTC [начало, конец) и активность за последние дни.
+PORTRAIT_NIGHTLY_WINDOW_UTC = (1, 5)
+PORTRAIT_NIGHTLY_ACTIVE_DAYS = 7
+PORTRAIT_NIGHTLY_CHECK_INTERVAL_SEC = 900
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "20000"))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_CLEANUP_INTERVAL_SEC = 15
+
+REDIS_URL: str = os.getenv("REDIS_URL", "")
+REDIS_CACHE_NAMESPACE = "itb:cache:"
+FSM_STATE_TTL_SEC = 30 * 24 * 3600
 PROGRESS_SCORE_COOLDOWN_HOURS = 2
 
 admin_ids = [2079274689, 7341879283, 8391442752]
-RATE_LIMIT_DELAY = 1 / 25
+# Общий лимит Telegram — около 30 сообщений в секунду на бота.
+MAILING_RATE_PER_SEC = 25
+MAILING_CONCURRENCY = 20
+MAILING_CHECKPOINT_EVERY = 100
+JOB_PROGRESS_INTERVAL_SEC = 5
 
 class IsAdmin(BaseFilter):
     async def __call__(self, obj: TelegramObject) -> bool:
@@ -0,0 +1,282 @@
+import asyncio
+import json
+import logging
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+BUCKET_TYPE = "message_bucket"
+# Тип исходного документа -> роль реплики в архиве.
+ARCHIVED_TYPES: Dict[str, str] = {"user_message": "user", "model_response": "model"}
+# Лимит записей в бакете держит документ далеко от 16 МБ даже для длинных ответов модели.
+BUCKET_MAX_MESSAGES = 1000
+MAX_MESSAGES_PER_PASS = 1000
+
+# Запись архива: [timestamp в мс, роль, текст, username].
+Record = Tuple[int, str, str, Optional[str]]
+
+
+class _BucketConflict(Exception):
+    pass
+
+
+def _encode(records: Sequence[Record]) -> bytes:
+    return zlib.compress(json.dumps(list(records), ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+
+def _decode(payload: bytes) -> List[Record]:
+    return [tuple(r) for r in json.loads(zlib.decompress(payload).decode("utf-8"))]
+
+
+def _ts_ms(dt: datetime) -> int:
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+
+def _month(ts_ms: int) -> datetime:
+    dt = datetime.fromtimestamp(ts_ms / 1000, tz=timezone.utc)
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+class MessageArchive:
+    """Архив реплик: старые user_message/model_response сжимаются в бакеты по пользователю и месяцу.
+
+    Свежие реплики остаются отдельными документами. Архивация идёт по каждому пользователю
+    по возрастанию времени, поэтому всё, что не позже last_ts последнего бакета, уже в архиве:
+    так повторный проход после падения не дублирует записи, а чтение отбрасывает документы,
+    которые успели попасть в бакет, но ещё не удалены.
+    """
+
+    def __init__(self, users_collection, *, archive_after_days: int = 90):
+        self.collection = users_collection
+        self.archive_after_days = archive_after_days
+        self._task: Optional[asyncio.Task] = None
+
+    # --- чтение ---
+
+    async def load_messages(self, user_id: int, roles: Sequence[str] = ("user", "model"),
+                            limit: int = 500) -> List[Dict]:
+        """Первые limit реплик пользователя по возрастанию времени: сначала архив, затем свежие документы."""
+        messages: List[Dict] = []
+        archived_until: Optional[int] = None
+        cursor = self.collection.find(
+            {"user_id": user_id, "type": BUCKET_TYPE},
+            {"payload": 1, "last_ts": 1}
+        ).sort([("month", 1), ("seq", 1)])
+        async for bucket in cursor:
+            archived_until = bucket["last_ts"]
+            for ts, role, text, username in _decode(bucket["payload"]):
+                if role in roles and len(messages) < limit:
+                    messages.append(self._message(ts, role, text, username))
+            if len(messages) >= limit:
+                return messages
+
+        hot_query: Dict = {"user_id": user_id}
+        if archived_until is not None:
+            hot_query["timestamp"] = {"$gt": datetime.fromtimestamp(archived_until / 1000, tz=timezone.utc)}
+        remaining = limit - len(messages)
+        hot: List[Dict] = []
+        for doc_type, role in ARCHIVED_TYPES.items():
+            if role not in roles:
+                continue
+            async for doc in self.collection.find(
+                {**hot_query, "type": doc_type},
+                {"text": 1, "username": 1, "timestamp": 1, "_id": 0}
+            ).sort("timestamp", 1).limit(remaining):
+                hot.append(self._message(_ts_ms(doc["timestamp"]), role, doc.get("text", ""), doc.get("username")))
+        hot.sort(key=lambda m: m["timestamp"])
+        return messages + hot[:remaining]
+
+    async def load_recent_messages(self, user_id: int, roles: Sequence[str] = ("user", "model"),
+                                   limit: int = 500, after: Optional[datetime] = None) -> List[Dict]:
+        """Последние limit реплик пользователя позже after, от новых к старым: свежие документы и архив вместе."""
+        after_ms = _ts_ms(after) if after is not None else None
+        newest = await self.collection.find_one(
+            {"user_id": user_id, "type": BUCKET_TYPE}, {"last_ts": 1}, sort=[("month", -1), ("seq", -1)]
+        )
+        archived_until = newest["last_ts"] if newest is not None else None
+
+        # Документы не позже archived_until уже лежат в бакете (их удаление могло не успеть).
+        bounds = [ts for ts in (after_ms, archived_until) if ts is not None]
+        floor_ms = max(bounds) if bounds else None
+        hot_query: Dict = {"user_id": user_id}
+        if floor_ms is not None:
+            hot_query["timestamp"] = {"$gt": datetime.fromtimestamp(floor_ms / 1000, tz=timezone.utc)}
+        hot: List[Dict] = []
+        for doc_type, role in ARCHIVED_TYPES.items():
+            if role not in roles:
+                continue
+            async for doc in self.collection.find(
+                {**hot_query, "type": doc_type},
+                {"text": 1, "username": 1, "timestamp": 1, "_id": 0}
+            ).sort("timestamp", -1).limit(limit):
+                hot.append(self._message(_ts_ms(doc["timestamp"]), role, doc.get("text", ""), doc.get("username")))
+        hot.sort(key=lambda m: m["timestamp"], reverse=True)
+        messages = hot[:limit]
+        if len(messages) >= limit or archived_until is None or (after_ms is not None and archived_until <= after_ms):
+            return messages
+
+        bucket_query: Dict = {"user_id": user_id, "type": BUCKET_TYPE}
+        if after_ms is not None:
+            bucket_query["last_ts"] = {"$gt": after_ms}
+        cursor = self.collection.find(bucket_query, {"payload": 1}).sort([("month", -1), ("seq", -1)])
+        async for bucket in cursor:
+            for ts, role, text, username in reversed(_decode(bucket["payload"])):
+                if after_ms is not None and ts <= after_ms:
+                    return messages
+                if role in roles:
+                    messages.append(self._message(ts, role, text, username))
+                    if len(messages) >= limit:
+                        return messages
+        return messages
+
+    @staticmethod
+    def _message(ts_ms: int, role: str, text: str, username: Optional[str]) -> Dict:
+        return {
+            "timestamp": datetime.fromtimestamp(ts_ms / 1000, tz=timezone.utc),
+            "role": role,
+            "text": text,
+            "username": username,
+        }
+
+    # --- архивация ---
+
+    async def archive_once(self) -> int:
+        cutoff = datetime.now(timezone.utc) - timedelta(days=self.archive_after_days)
+        user_ids = set()
+        for doc_type in ARCHIVED_TYPES:
+            async for row in self.collection.aggregate([
+                {"$match": {"type": doc_type, "timestamp": {"$lt": cutoff}}},
+                {"$group": {"_id": "$user_id"}},
+            ]):
+                user_ids.add(row["_id"])
+
+        archived = 0
+        for user_id in sorted(u for u in user_ids if isinstance(u, int)):
+            try:
+                while True:
+                    n, more = await self._archive_user(user_id, cutoff)
+                    archived += n
+                    if not more:
+                        break
+            except _BucketConflict:
+                logger.info(f"Archive of user {user_id} is being written by another process, skipping")
+            except Exception as e:
+                logger.error(f"Error archiving messages of user {user_id}: {e}")
+        if archived:
+            logger.info(f"Archived {archived} messages of {len(user_ids)} users")
+        return archived
+
+    async def _archive_user(self, user_id: int, cutoff: datetime) -> Tuple[int, bool]:
+        """Один проход по пользователю; возвращает (заархивировано, остались ли старые реплики)."""
+        fetched: Dict[str, List[Dict]] = {}
+        bound: Optional[int] = None
+        for doc_type in ARCHIVED_TYPES:
+            docs = await self.collection.find(
+                {"user_id": user_id, "type": doc_type, "timestamp": {"$lt": cutoff}},
+                {"text": 1, "username": 1, "timestamp": 1}
+            ).sort("timestamp", 1).limit(MAX_MESSAGES_PER_PASS).to_list(length=MAX_MESSAGES_PER_PASS)
+            fetched[doc_type] = docs
+            if len(docs) == MAX_MESSAGES_PER_PASS:
+                last = _ts_ms(docs[-1]["timestamp"])
+                bound = last if bound is None else min(bound, last)
+
+        records: List[Record] = []
+        ids: Dict[str, List] = {}
+        for doc_type, docs in fetched.items():
+            for doc in docs:
+                ts = _ts_ms(doc["timestamp"])
+                # При усечённой выборке берём только то, что строго раньше границы во всех типах,
+                # чтобы архив пользователя оставался непрерывным по времени.
+                if bound is not None and ts >= bound:
+                    continue
+                records.append((ts, ARCHIVED_TYPES[doc_type], doc.get("text", ""), doc.get("username")))
+                ids.setdefault(doc_type, []).append(doc["_id"])
+        if not records:
+            return 0, False
+        records.sort(key=lambda r: r[0])
+
+        by_month: Dict[datetime, List[Record]] = {}
+        for record in records:
+            by_month.setdefault(_month(record[0]), []).append(record)
+        for month, month_records in by_month.items():
+            await self._append_to_bucket(user_id, month, month_records)
+
+        for doc_type, doc_ids in ids.items():
+            await self.collection.delete_many({"type": doc_type, "_id": {"$in": doc_ids}})
+        return len(records), bound is not None
+
+    async def _append_to_bucket(self, user_id: int, month: datetime, records: List[Record]) -> None:
+        bucket = await self.collection.find_one(
+            {"user_id": user_id, "type": BUCKET_TYPE, "month": month},
+            sort=[("seq", -1)]
+        )
+        if bucket is not None:
+            # Записи не позже last_ts уже в бакете: предыдущий проход упал до удаления исходников.
+            records = [r for r in records if r[0] > bucket["last_ts"]]
+            if not records:
+                return
+        now = datetime.now(timezone.utc)
+
+        if bucket is not None and bucket["count"] < BUCKET_MAX_MESSAGES:
+            # Дописываем последний бакет только до лимита, остаток уходит в следующие.
+            room = BUCKET_MAX_MESSAGES - bucket["count"]
+            merged = _decode(bucket["payload"]) + records[:room]
+            records = records[room:]
+            result = await self.collection.update_one(
+                {"_id": bucket["_id"], "type": BUCKET_TYPE, "version": bucket["version"]},
+                {
+                    "$set": {"payload": _encode(merged), "count": len(merged), "last_ts": merged[-1][0],
+                             "updated_at": now},
+                    "$inc": {"version": 1},
+                }
+            )
+            if not result.matched_count:
+                raise _BucketConflict(user_id)
+
+        seq = bucket["seq"] + 1 if bucket is not None else 0
+        for i in range(0, len(records), BUCKET_MAX_MESSAGES):
+            chunk = records[i:i + BUCKET_MAX_MESSAGES]
+            try:
+                await self.collection.insert_one({
+                    "type": BUCKET_TYPE,
+                    "user_id": user_id,
+                    "month": month,
+                    "seq": seq,
+                    "first_ts": chunk[0][0],
+                    "last_ts": chunk[-1][0],
+                    "count": len(chunk),
+                    "payload": _encode(chunk),
+                    "version": 0,
+                    "updated_at": now,
+                })
+            except DuplicateKeyError:
+                raise _BucketConflict(user_id)
+            seq += 1
+
+    def start(self, interval: int = 3600) -> None:
+        if self._task and not self._task.done():
+            return
+
+        async def archiver():
+            while True:
+                try:
+                    await self.archive_once()
+                    await asyncio.sleep(interval)
+                except asyncio.CancelledError:
+                    break
+                except Exception as e:
+                    logger.error(f"Error in message archiver: {e}")
+                    await asyncio.sleep(interval)
+
+        self._task = asyncio.create_task(archiver())
+
+    async def close(self) -> None:
+        if self._task and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
@@ -1,9 +1,18 @@
+import asyncio
 from typing import Dict, List, Optional
 from datetime import datetime, timezone
 import logging
 
+from pymongo.errors import DuplicateKeyError
+
 logger = logging.getLogger(__name__)
 
+MAX_CONTEXT_TESTS = 3
+MAX_CONTEXT_SCORES = 10
+CONTEXT_CACHE_TTL_SEC = 3600
+TIME_OF_DAY_BUCKETS = ("утро", "день", "вечер", "ночь")
+_TEST_FIELDS = ("test_title", "test_id", "result", "finished_at")
+
 
 class ContextService:
     
@@ -24,59 +33,97 @@ class ContextService:
         else:
             return "ночь", "🌙"
     
+    def _cache_key(self, user_id: int, time_of_day: str) -> str:
+        return f"context:{user_id}:{time_of_day}"
+
     async def load_user_context(self, user_id: int) -> str:
-        cache_key = f"context:{user_id}"
-        if self.cache:
-            cached = await self.cache.get(cache_key)
-            if cached:
-                return cached
-        
+        time_of_day, _ = self._get_time_of_day()
         try:
-            pipeline = [
-                {"$match": {"user_id": user_id}},
-                {"$facet": {
-                    "tests": [
-                        {"$match": {"type": "test_result"}},
-                        {"$sort": {"finished_at": -1}},
-                        {"$limit": 3},
-                        {"$project": {
-                            "test_title": 1,
-                            "test_id": 1,
-                            "result": 1,
-                            "finished_at": 1
-                        }}
-                    ],
-                    "scores": [
-                        {"$match": {"type": "progress_score"}},
-                        {"$sort": {"timestamp": -1}},
-                        {"$limit": 10},
-                        {"$project": {
-                            "score": 1,
-                            "timestamp": 1
-                        }}
-                    ]
-                }}
-            ]
-            
-            result = await self.collection.aggregate(pipeline).to_list(1)
-            
-            if not result or not result[0]:
-                context = self._format_time_of_day_only()
-            else:
-                data = result[0]
-                context = self._format_context(
-                    tests=data.get("tests", []),
-                    scores=data.get("scores", [])
-                )
-            
             if self.cache:
-                await self.cache.set(cache_key, context, ttl=300)
-            
-            return context
+                return await self.cache.get_or_compute(
+                    self._cache_key(user_id, time_of_day),
+                    lambda: self._build_user_context(user_id),
+                    ttl=CONTEXT_CACHE_TTL_SEC
+                )
+            return await self._build_user_context(user_id)
         except Exception as e:
             logger.error(f"Error loading user context: {e}")
             return self._format_time_of_day_only()
-    
+
+    async def invalidate(self, user_id: int) -> None:
+        if not self.cache:
+            return
+        for time_of_day in TIME_OF_DAY_BUCKETS:
+            await self.cache.delete(self._cache_key(user_id, time_of_day))
+
+    async def _build_user_context(self, user_id: int) -> str:
+        doc = await self.collection.find_one(
+            {"user_id": user_id, "type": "user_context"},
+            {"tests": 1, "scores": 1}
+        )
+        if doc is None:
+            doc = await self.rebuild_context_doc(user_id)
+
+        return self._format_context(
+            tests=doc.get("tests", []),
+            scores=doc.get("scores", [])
+        )
+
+    async def rebuild_context_doc(self, user_id: int) -> Dict:
+        """Собирает документ user_context из истории (для пользователей без него)."""
+        # Два независимых запроса, а не $facet по всем документам пользователя:
+        # тесты и оценки могут лежать в разных коллекциях (см. infrastructure.storage).
+        tests, scores = await asyncio.gather(
+            self.collection.find(
+                {"user_id": user_id, "type": "test_result"},
+                {"_id": 0, **{f: 1 for f in _TEST_FIELDS}}
+            ).sort("finished_at", -1).limit(MAX_CONTEXT_TESTS).to_list(length=MAX_CONTEXT_TESTS),
+            self.collection.find(
+                {"user_id": user_id, "type": "progress_score"},
+                {"_id": 0, "score": 1, "timestamp": 1}
+            ).sort("timestamp", -1).limit(MAX_CONTEXT_SCORES).to_list(length=MAX_CONTEXT_SCORES),
+        )
+        doc = {"tests": tests, "scores": scores}
+
+        try:
+            await self.collection.update_one(
+                {"user_id": user_id, "type": "user_context"},
+                {"$setOnInsert": {**doc, "updated_at": datetime.now(timezone.utc)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            pass
+        return doc
+
+    async def record_test_result(self, user_id: int, record: Dict) -> None:
+        entry = {f: record.get(f) for f in _TEST_FIELDS}
+        await self._push_entry(user_id, "tests", entry, "finished_at", MAX_CONTEXT_TESTS)
+
+    async def record_progress_score(self, user_id: int, score: int, timestamp: datetime) -> None:
+        entry = {"score": score, "timestamp": timestamp}
+        await self._push_entry(user_id, "scores", entry, "timestamp", MAX_CONTEXT_SCORES)
+
+    async def _push_entry(self, user_id: int, field: str, entry: Dict, sort_field: str, limit: int) -> None:
+        # Условие по sort_field не даёт записать ту же запись дважды,
+        # если она уже попала в документ при пересборке из истории.
+        query = {"user_id": user_id, "type": "user_context", f"{field}.{sort_field}": {"$ne": entry[sort_field]}}
+        update = {
+            "$push": {field: {"$each": [entry], "$sort": {sort_field: -1}, "$slice": limit}},
+            "$set": {"updated_at": datetime.now(timezone.utc)}
+        }
+        try:
+            result = await self.collection.update_one(query, update)
+            if result.matched_count == 0 and not await self.collection.find_one(
+                    {"user_id": user_id, "type": "user_context"}, {"_id": 1}):
+                # Документа ещё нет: собираем его из истории. Сама запись может быть
+                # ещё в буфере записи, поэтому после пересборки добавляем её явно.
+                await self.rebuild_context_doc(user_id)
+                await self.collection.update_one(query, update)
+        except Exception as e:
+            logger.error(f"Error updating user context for {user_id}: {e}")
+        finally:
+            await self.invalidate(user_id)
+
     def _format_time_of_day_only(self) -> str:
         time_of_day, emoji = self._get_time_of_day()
         return f"{emoji} Сейчас {time_of_day} (по UTC)."
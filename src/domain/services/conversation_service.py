@@ -0,0 +1,93 @@
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional, Union
+
+from google.genai import types
+
+from src.utils.dialog import Turn
+from src.utils.token_estimator import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+_ROLE_ALIASES = {"assistant": "model", "model": "model", "user": "user"}
+
+
+@dataclass
+class ConversationWindow:
+    contents: List[types.Content] = field(default_factory=list)
+    tokens: int = 0
+    dropped: int = 0
+
+
+class ConversationWindowBuilder:
+    """Скользящее окно диалога для Gemini в пределах бюджета токенов.
+
+    Объекты types.Content и их оценки токенов кэшируются по (role, text),
+    поэтому между ходами заново собирается только новая реплика.
+    """
+
+    def __init__(self, token_budget: int = 4000, max_cached: int = 5000,
+                 estimate: Optional[Callable[[str], int]] = None):
+        self.token_budget = token_budget
+        self.max_cached = max_cached
+        self.estimate = estimate or estimate_tokens
+        self._memo: "OrderedDict[tuple[str, str], tuple[types.Content, int]]" = OrderedDict()
+        self.memo_hits = 0
+        self.memo_misses = 0
+
+    def _entry(self, role: str, text: str) -> tuple[types.Content, int]:
+        key = (role, text)
+        entry = self._memo.get(key)
+        if entry is not None:
+            self._memo.move_to_end(key)
+            self.memo_hits += 1
+            return entry
+
+        self.memo_misses += 1
+        entry = (types.Content(role=role, parts=[types.Part(text=text)]), self.estimate(text))
+        self._memo[key] = entry
+        if len(self._memo) > self.max_cached:
+            self._memo.popitem(last=False)
+        return entry
+
+    def build(self, messages: Iterable[Union[Dict, Turn]]) -> ConversationWindow:
+        turns = []
+        for item in messages:
+            if isinstance(item, Turn):
+                if item.content:
+                    turns.append((item.role_name, item.content))
+                continue
+            if not item or not isinstance(item, dict):
+                continue
+            text = item.get("content")
+            if not text:
+                continue
+            turns.append((_ROLE_ALIASES.get(item.get("role"), "user"), str(text)))
+
+        window: List[tuple[types.Content, int]] = []
+        tokens = 0
+        for role, text in reversed(turns):
+            content, cost = self._entry(role, text)
+            # Последняя реплика пользователя попадает в окно всегда, даже сверх бюджета.
+            if window and tokens + cost > self.token_budget:
+                break
+            window.append((content, cost))
+            tokens += cost
+
+        # Gemini ожидает, что диалог начинается с реплики пользователя.
+        while len(window) > 1 and window[-1][0].role != "user":
+            tokens -= window.pop()[1]
+
+        window.reverse()
+        dropped = len(turns) - len(window)
+        if dropped:
+            logger.debug(f"Conversation window: {len(window)} turns (~{tokens} tokens), {dropped} older turns left out")
+        return ConversationWindow([content for content, _ in window], tokens, dropped)
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "cached_contents": len(self._memo),
+            "memo_hits": self.memo_hits,
+            "memo_misses": self.memo_misses,
+        }
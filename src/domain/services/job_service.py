@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+from aiogram.exceptions import TelegramBadRequest
+
+from src.presentation import keyboards
+
+logger = logging.getLogger(__name__)
+
+COUNTER_LABELS = {"ok": "Доставлено", "blocked": "Заблокировали", "errors": "Ошибок"}
+STATUS_LABELS = {
+    "running": "▶️ Выполняется",
+    "paused": "⏸ На паузе",
+    "cancelled": "⏹ Остановлена",
+    "done": "✅ Завершена",
+    "failed": "❌ Ошибка",
+}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobHandle:
+    """Состояние долгой админской задачи: счётчики для прогресса и управление паузой/отменой."""
+
+    def __init__(self, job_id: str, title: str, chat_id: int, message_id: Optional[int] = None,
+                 total: Optional[int] = None, counters: Optional[Dict[str, int]] = None,
+                 on_status: Optional[Callable[[str], Awaitable[None]]] = None):
+        self.job_id = job_id
+        self.title = title
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.total = total
+        self.counters: Dict[str, int] = dict(counters or {})
+        self.status = "running"
+        self.on_status = on_status
+        self._initial = self.processed
+        self._started = time.monotonic()
+        self._paused_at: Optional[float] = None
+        self._paused_total = 0.0
+        self._running = asyncio.Event()
+        self._running.set()
+
+    @property
+    def processed(self) -> int:
+        return sum(self.counters.values())
+
+    def incr(self, counter: str, n: int = 1) -> None:
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    @property
+    def cancelled(self) -> bool:
+        return self.status == "cancelled"
+
+    async def wait_if_paused(self) -> None:
+        await self._running.wait()
+        if self.cancelled:
+            raise JobCancelled(self.job_id)
+
+    def throughput(self) -> float:
+        """Скорость текущего запуска без учёта времени на паузе, единиц в секунду."""
+        now = time.monotonic()
+        paused = self._paused_total + (now - self._paused_at if self._paused_at is not None else 0.0)
+        active = now - self._started - paused
+        return (self.processed - self._initial) / active if active > 0 else 0.0
+
+    def eta_seconds(self) -> Optional[float]:
+        rate = self.throughput()
+        if self.total is None or rate <= 0:
+            return None
+        return max(0.0, (self.total - self.processed) / rate)
+
+    async def _set_status(self, status: str) -> None:
+        if status == "paused":
+            self._paused_at = time.monotonic()
+            self._running.clear()
+        else:
+            if self._paused_at is not None:
+                self._paused_total += time.monotonic() - self._paused_at
+                self._paused_at = None
+            # Отмена тоже будит ожидающих: wait_if_paused() выбросит JobCancelled.
+            self._running.set()
+        self.status = status
+        if self.on_status is not None:
+            try:
+                await self.on_status(status)
+            except Exception as e:
+                logger.error(f"Не удалось сохранить статус задачи {self.job_id}: {e}")
+
+
+def _format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds} с"
+    if seconds < 3600:
+        return f"{seconds // 60} мин {seconds % 60} с"
+    return f"{seconds // 3600} ч {seconds % 3600 // 60} мин"
+
+
+def render_progress(handle: JobHandle) -> str:
+    processed = handle.processed
+    if handle.total:
+        progress = f"{processed:,}/{handle.total:,} ({min(100.0, processed / handle.total * 100):.1f}%)"
+    else:
+        progress = f"{processed:,}"
+    lines = [
+        f"{handle.title}\n",
+        f"Статус: {STATUS_LABELS.get(handle.status, handle.status)}",
+        f"Обработано: {progress}",
+    ]
+    lines += [f"{COUNTER_LABELS.get(name, name)}: {value:,}" for name, value in handle.counters.items()]
+    if handle.status == "running":
+        lines.append(f"Скорость: {handle.throughput():.1f} сообщ./с")
+        eta = handle.eta_seconds()
+        if eta is not None:
+            lines.append(f"Осталось: ~{_format_duration(eta)}")
+    return "\n".join(lines)
+
+
+class JobRegistry:
+    """Реестр запущенных админских задач.
+
+    Для каждой задачи раз в report_interval секунд обновляет сообщение с прогрессом
+    и кнопками паузы/отмены; кнопки управляют задачей через pause/resume/cancel.
+    """
+
+    def __init__(self, bot, *, report_interval: float = 5.0):
+        self.bot = bot
+        self.report_interval = report_interval
+        self._jobs: Dict[str, JobHandle] = {}
+        self._reporters: Dict[str, asyncio.Task] = {}
+
+    def register(self, handle: JobHandle) -> JobHandle:
+        self._jobs[handle.job_id] = handle
+        self._reporters[handle.job_id] = asyncio.create_task(self._report_loop(handle))
+        return handle
+
+    def get(self, job_id: str) -> Optional[JobHandle]:
+        return self._jobs.get(job_id)
+
+    def list(self) -> list[JobHandle]:
+        return list(self._jobs.values())
+
+    async def pause(self, job_id: str) -> bool:
+        return await self._transition(job_id, "paused", allowed_from=("running",))
+
+    async def resume(self, job_id: str) -> bool:
+        return await self._transition(job_id, "running", allowed_from=("paused",))
+
+    async def cancel(self, job_id: str) -> bool:
+        return await self._transition(job_id, "cancelled", allowed_from=("running", "paused"))
+
+    async def _transition(self, job_id: str, status: str, allowed_from: tuple[str, ...]) -> bool:
+        handle = self._jobs.get(job_id)
+        if handle is None or handle.status not in allowed_from:
+            return False
+        await handle._set_status(status)
+        try:
+            await self._render(handle)
+        except Exception as e:
+            logger.warning(f"Failed to report progress of job {job_id}: {e}")
+        return True
+
+    async def finish(self, job_id: str, status: str = "done") -> None:
+        handle = self._jobs.pop(job_id, None)
+        reporter = self._reporters.pop(job_id, None)
+        if reporter is not None:
+            reporter.cancel()
+        if handle is None:
+            return
+        if not handle.cancelled:
+            handle.status = status
+        try:
+            # Задача, отпущенная на паузе, сохраняет кнопки: продолжить её можно из любого процесса.
+            await self._render(handle, final=handle.status != "paused")
+        except Exception as e:
+            logger.warning(f"Failed to report progress of job {job_id}: {e}")
+
+    async def _report_loop(self, handle: JobHandle) -> None:
+        while True:
+            try:
+                await self._render(handle)
+                await asyncio.sleep(self.report_interval)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.warning(f"Failed to report progress of job {handle.job_id}: {e}")
+                await asyncio.sleep(self.report_interval)
+
+    async def _render(self, handle: JobHandle, *, final: bool = False) -> None:
+        text = render_progress(handle)
+        markup = None if final else keyboards.job_control_keyboard(handle.job_id, paused=handle.status == "paused")
+        if handle.message_id is None:
+            message = await self.bot.send_message(handle.chat_id, text, reply_markup=markup)
+            handle.message_id = message.message_id
+            return
+        try:
+            await self.bot.edit_message_text(text=text, chat_id=handle.chat_id, message_id=handle.message_id,
+                                             reply_markup=markup)
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                raise
+
+    async def close(self) -> None:
+        reporters, self._reporters = list(self._reporters.values()), {}
+        for task in reporters:
+            task.cancel()
+        if reporters:
+            await asyncio.gather(*reporters, return_exceptions=True)
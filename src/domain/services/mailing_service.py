@@ -0,0 +1,328 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from aiogram.exceptions import (
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+
+from src.domain.services.job_service import JobCancelled, JobHandle, JobRegistry
+from src.domain.services.segment_service import SegmentService
+from src.infrastructure.rate_limiter import TokenBucket
+from src.presentation import keyboards
+
+logger = logging.getLogger(__name__)
+
+JOB_TYPE = "mailing_job"
+# Сколько живёт захват задания без чекпоинта; после этого его может продолжить другой процесс.
+JOB_LEASE_SEC = 120
+MAX_RETRY_AFTER_WAITS = 5
+
+
+async def blacklist_users(users_collection, user_ids: List[int]) -> None:
+    """Помечает профили заблокировавших бота одной пачкой bulk_write."""
+    if not user_ids:
+        return
+    now = datetime.now(timezone.utc)
+    try:
+        await users_collection.bulk_write([
+            UpdateOne(
+                {"type": "user_profile", "user_id": uid},
+                {"$set": {"blacklisted": True, "blacklisted_at": now}}
+            )
+            for uid in user_ids
+        ], ordered=False)
+    except Exception as e:
+        logger.error(f"Не удалось добавить в blacklist {len(user_ids)} пользователей: {e}")
+
+
+async def migrate_legacy_blacklist(users_collection) -> int:
+    """Переносит старые документы type=blacklisted во флаг blacklisted профиля."""
+    user_ids = [d["user_id"] async for d in users_collection.find({"type": "blacklisted"}, {"user_id": 1, "_id": 0})
+                if isinstance(d.get("user_id"), int)]
+    if not user_ids:
+        return 0
+    for i in range(0, len(user_ids), 1000):
+        chunk = user_ids[i:i + 1000]
+        await blacklist_users(users_collection, chunk)
+        await users_collection.delete_many({"type": "blacklisted", "user_id": {"$in": chunk}})
+    logger.info(f"Migrated {len(user_ids)} blacklist entries to user_profile.blacklisted")
+    return len(user_ids)
+
+
+class MailingService:
+    """Массовая рассылка с общим лимитом частоты и чекпоинтами в документе mailing_job.
+
+    Получатели читаются курсором по возрастанию user_id пачками по checkpoint_every;
+    после каждой пачки в задании сохраняются last_user_id и счётчики, поэтому после
+    падения или рестарта рассылка продолжается с последней пачки, а не с начала.
+    """
+
+    def __init__(self, bot, users_collection, *, rate_per_sec: float = 25, concurrency: int = 20,
+                 checkpoint_every: int = 100, max_retries: int = 3, registry: Optional[JobRegistry] = None,
+                 segments: Optional[SegmentService] = None):
+        self.bot = bot
+        self.registry = registry or JobRegistry(bot)
+        self.segments = segments or SegmentService(users_collection)
+        self.collection = users_collection
+        self.bucket = TokenBucket(rate_per_sec)
+        self.concurrency = concurrency
+        self.checkpoint_every = checkpoint_every
+        self.max_retries = max_retries
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    async def create_job(self, text: str, seg: str, admin_id: int, progress_message_id: Optional[int] = None) -> str:
+        now = datetime.now(timezone.utc)
+        result = await self.collection.insert_one({
+            "type": JOB_TYPE,
+            "text": text,
+            "segment": seg,
+            "admin_id": admin_id,
+            "progress_message_id": progress_message_id,
+            "status": "running",
+            "created_at": now,
+            "updated_at": now,
+            "lease_until": now,
+            "last_user_id": None,
+            "processed": 0,
+            "ok": 0,
+            "blocked": 0,
+            "errors": 0,
+        })
+        return str(result.inserted_id)
+
+    def start(self, job_id: str) -> asyncio.Task:
+        task = self._tasks.get(job_id)
+        if task is None or task.done():
+            task = self._tasks[job_id] = asyncio.create_task(self._run(job_id))
+            task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+        return task
+
+    async def resume_unfinished(self) -> List[str]:
+        """Продолжает рассылки, прерванные падением или рестартом."""
+        job_ids = []
+        try:
+            async for job in self.collection.find({"type": JOB_TYPE, "status": "running"}, {"_id": 1}):
+                job_ids.append(str(job["_id"]))
+        except Exception as e:
+            logger.error(f"Не удалось найти незавершённые рассылки: {e}")
+            return []
+        for job_id in job_ids:
+            logger.info(f"Resuming mailing job {job_id}")
+            self.start(job_id)
+        return job_ids
+
+    async def _claim(self, job_id: str) -> Optional[Dict]:
+        """Забирает задание, если его лиз истёк; ждёт, пока прежний владелец не отпустит."""
+        while True:
+            now = datetime.now(timezone.utc)
+            job = await self.collection.find_one_and_update(
+                {"_id": ObjectId(job_id), "type": JOB_TYPE, "status": "running", "lease_until": {"$lte": now}},
+                {"$set": {"lease_until": now + timedelta(seconds=JOB_LEASE_SEC)}},
+                return_document=ReturnDocument.AFTER
+            )
+            if job is not None:
+                return job
+            job = await self.collection.find_one({"_id": ObjectId(job_id), "type": JOB_TYPE}, {"status": 1, "lease_until": 1})
+            if job is None or job.get("status") != "running":
+                return None
+            lease_until = job["lease_until"].replace(tzinfo=timezone.utc)
+            await asyncio.sleep(max(1.0, (lease_until - now).total_seconds()))
+
+    async def _run(self, job_id: str) -> None:
+        try:
+            job = await self._claim(job_id)
+            if job is None:
+                return
+            await self._process(job)
+        except asyncio.CancelledError:
+            # Задание остаётся в статусе running и будет продолжено после рестарта.
+            raise
+        except Exception as e:
+            logger.error(f"Mailing job {job_id} failed: {e}", exc_info=True)
+            await self.collection.update_one({"_id": ObjectId(job_id), "type": JOB_TYPE}, {"$set": {"status": "failed"}})
+            await self.registry.finish(job_id, "failed")
+
+    async def _set_job_status(self, job_id: str, status: str) -> None:
+        now = datetime.now(timezone.utc)
+        update: Dict = {"status": status}
+        if status == "running":
+            # Продолжение после паузы: лиз продлит ближайший чекпоинт.
+            update["lease_until"] = now + timedelta(seconds=JOB_LEASE_SEC)
+        elif status == "cancelled":
+            update["finished_at"] = now
+        await self.collection.update_one({"_id": ObjectId(job_id), "type": JOB_TYPE}, {"$set": update})
+
+    async def resume(self, job_id: str) -> bool:
+        """Продолжает рассылку, поставленную на паузу до рестарта процесса."""
+        result = await self.collection.update_one(
+            {"_id": ObjectId(job_id), "type": JOB_TYPE, "status": "paused"},
+            {"$set": {"status": "running", "lease_until": datetime.now(timezone.utc)}}
+        )
+        if not result.modified_count:
+            return False
+        self.start(job_id)
+        return True
+
+    async def pause(self, job_id: str) -> bool:
+        """Пауза задания, которое выполняет другой процесс: тот остановится на ближайшем чекпоинте."""
+        result = await self.collection.update_one(
+            {"_id": ObjectId(job_id), "type": JOB_TYPE, "status": "running"},
+            {"$set": {"status": "paused"}}
+        )
+        return bool(result.modified_count)
+
+    async def cancel(self, job_id: str) -> bool:
+        result = await self.collection.update_one(
+            {"_id": ObjectId(job_id), "type": JOB_TYPE, "status": {"$in": ["running", "paused"]}},
+            {"$set": {"status": "cancelled", "finished_at": datetime.now(timezone.utc)}}
+        )
+        return bool(result.modified_count)
+
+    async def _process(self, job: Dict) -> None:
+        job_id = str(job["_id"])
+        handle = self.registry.register(JobHandle(
+            job_id,
+            f"📬 Рассылка · сегмент {job['segment']}",
+            job["admin_id"],
+            message_id=job.get("progress_message_id"),
+            counters={name: job.get(name, 0) for name in ("ok", "blocked", "errors")},
+            on_status=lambda status: self._set_job_status(job_id, status),
+        ))
+        handle.total = await self.segments.count(job["segment"])
+        batch: List[int] = []
+        async for uid in self.segments.iter_user_ids(job["segment"], job.get("last_user_id")):
+            batch.append(uid)
+            if len(batch) >= self.checkpoint_every:
+                await self._send_batch(job, handle, batch)
+                batch = []
+                if handle.cancelled or await self._stopped_externally(job, handle):
+                    break
+        if batch and not handle.cancelled:
+            await self._send_batch(job, handle, batch)
+
+        if handle.status == "paused":
+            # Пауза пришла из другого процесса: отпускаем задание, продолжит его mailing.resume().
+            await self.collection.update_one(
+                {"_id": job["_id"], "type": JOB_TYPE, "status": "paused"},
+                {"$set": {"lease_until": datetime.now(timezone.utc)}}
+            )
+            await self.registry.finish(job_id, "paused")
+            logger.info(f"Mailing job {job_id} paused from another process")
+            return
+
+        # Только из running: отмена или пауза, записанные другим процессом, не перетираются.
+        job = await self.collection.find_one_and_update(
+            {"_id": job["_id"], "type": JOB_TYPE, "status": "running"},
+            {"$set": {"status": "done", "finished_at": datetime.now(timezone.utc)}},
+            return_document=ReturnDocument.AFTER
+        ) or await self.collection.find_one({"_id": job["_id"], "type": JOB_TYPE})
+        status = job["status"]
+        await self.registry.finish(job_id, status)
+        logger.info(f"Mailing job {job_id} {status}: ok={job['ok']} blocked={job['blocked']} errors={job['errors']}")
+        title = "⏹ Рассылка остановлена" if status == "cancelled" else "✅ Рассылка завершена"
+        summary = "Нет пользователей в выбранном сегменте." if not job["processed"] else (
+            f"{title}\n\n"
+            f"Сегмент: {job['segment']}\n"
+            f"Всего: {job['processed']}\n"
+            f"Доставлено: {job['ok']}\n"
+            f"Заблокировали: {job['blocked']}\n"
+            f"Ошибок: {job['errors']}\n"
+        )
+        try:
+            await self.bot.send_message(job["admin_id"], summary, reply_markup=keyboards.back_to_admin_panel)
+        except Exception as e:
+            logger.error(f"Не удалось отправить итоги рассылки админу: {e}")
+
+    async def _stopped_externally(self, job: Dict, handle: JobHandle) -> bool:
+        """Сверяет статус с mailing_job на чекпоинте: пауза/отмена из другого процесса видна только там."""
+        doc = await self.collection.find_one({"_id": job["_id"], "type": JOB_TYPE}, {"status": 1})
+        status = doc.get("status") if doc else "cancelled"
+        if status not in ("paused", "cancelled") or status == handle.status:
+            return False
+        handle.status = status
+        return True
+
+    async def _send_batch(self, job: Dict, handle: JobHandle, user_ids: List[int]) -> None:
+        sem = asyncio.Semaphore(self.concurrency)
+        results = {"ok": 0, "blocked": 0, "errors": 0}
+        blocked: List[int] = []
+
+        async def worker(uid: int):
+            async with sem:
+                try:
+                    res = await self._send_with_retry(uid, job["text"], handle)
+                except JobCancelled:
+                    return
+            results[res] += 1
+            handle.incr(res)
+            if res == "blocked":
+                blocked.append(uid)
+
+        await asyncio.gather(*(worker(uid) for uid in user_ids))
+        await blacklist_users(self.collection, blocked)
+
+        now = datetime.now(timezone.utc)
+        await self.collection.update_one(
+            {"_id": job["_id"], "type": JOB_TYPE},
+            {
+                "$set": {
+                    "last_user_id": user_ids[-1],
+                    "updated_at": now,
+                    "lease_until": now + timedelta(seconds=JOB_LEASE_SEC),
+                },
+                "$inc": {"processed": sum(results.values()), **results},
+            }
+        )
+
+    async def _send_with_retry(self, user_id: int, text: str, handle: Optional[JobHandle] = None) -> str:
+        attempt = 0
+        retry_after_waits = 0
+        while True:
+            await self.bucket.acquire()
+            if handle is not None:
+                # Проверяем после ожидания токена: пауза должна останавливать и уже ждущие отправки.
+                await handle.wait_if_paused()
+            try:
+                await self.bot.send_message(user_id, text)
+                return "ok"
+            except TelegramRetryAfter as e:
+                # Пауза общая: 429 означает, что превышен лимит бота, а не одного чата.
+                self.bucket.pause_for(e.retry_after)
+                retry_after_waits += 1
+                if retry_after_waits > MAX_RETRY_AFTER_WAITS:
+                    return "errors"
+                logger.warning(f"Telegram flood control, pausing mailing for {e.retry_after}s")
+            except TelegramForbiddenError:
+                return "blocked"
+            except (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError) as e:
+                attempt += 1
+                if attempt >= self.max_retries:
+                    logger.warning(f"Mailing to {user_id} failed: {e}")
+                    return "errors"
+                await asyncio.sleep(0.5 * (2 ** (attempt - 1)))
+            except Exception as e:
+                logger.warning(f"Mailing to {user_id} failed: {e}")
+                return "errors"
+
+    async def close(self) -> None:
+        running = dict(self._tasks)
+        if not running:
+            return
+        for task in running.values():
+            task.cancel()
+        await asyncio.gather(*running.values(), return_exceptions=True)
+        # Снимаем лиз, чтобы следующий запуск сразу продолжил рассылку с чекпоинта.
+        try:
+            await self.collection.update_many(
+                {"_id": {"$in": [ObjectId(job_id) for job_id in running]}, "type": JOB_TYPE, "status": "running"},
+                {"$set": {"lease_until": datetime.now(timezone.utc)}}
+            )
+        except Exception as e:
+            logger.error(f"Не удалось освободить задания рассылки: {e}")
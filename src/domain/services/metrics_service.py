@@ -0,0 +1,386 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from src.infrastructure.database import claim_backfill
+
+logger = logging.getLogger(__name__)
+
+DAILY_TYPE = "metrics_daily"
+TOTALS_TYPE = "metrics_totals"
+BACKFILL_MARKER_TYPE = "metrics_backfill"
+BACKFILL_DAYS = 30
+
+_DAILY_COUNTERS = ("messages", "new_users", "sessions", "session_messages", "score_sum", "score_count", "portraits")
+
+
+@dataclass(frozen=True)
+class _Window:
+    today: datetime
+    d7: datetime
+    d30: datetime
+    prev7: datetime
+
+
+@dataclass(frozen=True)
+class MetricQuery:
+    """Независимый запрос админ-метрик: выполняется параллельно с остальными,
+    при ошибке или таймауте вместо результата подставляется default()."""
+    name: str
+    run: Callable[["MetricsService", _Window], Awaitable[Any]]
+    default: Callable[[], Any]
+    timeout: float = 5.0
+
+
+def _day_start(ts: Optional[datetime] = None) -> datetime:
+    ts = ts or datetime.now(timezone.utc)
+    return ts.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class MetricsService:
+    """Суточные роллапы метрик для админ-статистики.
+
+    События пишутся в документы type=metrics_daily (по одному на UTC-день,
+    с множествами активных пользователей) и type=metrics_totals (накопительные
+    счётчики), так что экран статистики читает несколько маленьких документов
+    вместо агрегаций по всей коллекции.
+    """
+
+    def __init__(self, users_collection, *, max_concurrency: int = 4, slow_query_sec: float = 1.0):
+        self.collection = users_collection
+        self.max_concurrency = max_concurrency
+        self.slow_query_sec = slow_query_sec
+        self.last_timings: Dict[str, float] = {}
+        self._seen_day: Optional[datetime] = None
+        self._seen_active: set[int] = set()
+        self._seen_dialog: set[int] = set()
+
+    def _reset_seen_if_new_day(self, day: datetime) -> None:
+        if self._seen_day != day:
+            self._seen_day = day
+            self._seen_active.clear()
+            self._seen_dialog.clear()
+
+    async def _update_daily(self, day: datetime, update: Dict[str, Any]) -> None:
+        await self.collection.update_one({"type": DAILY_TYPE, "date": day}, update, upsert=True)
+
+    async def _inc_totals(self, inc: Dict[str, int]) -> None:
+        await self.collection.update_one({"type": TOTALS_TYPE}, {"$inc": inc}, upsert=True)
+
+    async def record_active(self, user_id: int, new_user: bool = False) -> None:
+        day = _day_start()
+        self._reset_seen_if_new_day(day)
+        try:
+            if user_id in self._seen_active and not new_user:
+                return
+            update: Dict[str, Any] = {"$addToSet": {"active_users": user_id}}
+            if new_user:
+                update["$inc"] = {"new_users": 1}
+                await self._inc_totals({"users": 1})
+            await self._update_daily(day, update)
+            self._seen_active.add(user_id)
+        except Exception as e:
+            logger.error(f"Error recording activity metrics for {user_id}: {e}")
+
+    async def record_message(self, user_id: int) -> None:
+        day = _day_start()
+        self._reset_seen_if_new_day(day)
+        try:
+            update: Dict[str, Any] = {"$inc": {"messages": 1}}
+            totals_inc = {"messages": 1}
+            first_today = user_id not in self._seen_dialog
+            if first_today:
+                update["$addToSet"] = {"active_users": user_id, "dialog_users": user_id}
+                # Флаг в профиле позволяет считать уникальных авторов сообщений без distinct по истории.
+                flagged = await self.collection.update_one(
+                    {"user_id": user_id, "type": "user_profile", "has_messages": {"$ne": True}},
+                    {"$set": {"has_messages": True}}
+                )
+                if flagged.modified_count:
+                    totals_inc["message_senders"] = 1
+            await self._update_daily(day, update)
+            await self._inc_totals(totals_inc)
+            if first_today:
+                self._seen_dialog.add(user_id)
+                self._seen_active.add(user_id)
+        except Exception as e:
+            logger.error(f"Error recording message metrics for {user_id}: {e}")
+
+    async def record_session(self, message_count: int) -> None:
+        try:
+            await self._update_daily(_day_start(), {"$inc": {"sessions": 1, "session_messages": int(message_count or 0)}})
+        except Exception as e:
+            logger.error(f"Error recording session metrics: {e}")
+
+    async def record_score(self, score: int) -> None:
+        try:
+            await self._update_daily(_day_start(), {"$inc": {"score_sum": int(score), "score_count": 1}})
+        except Exception as e:
+            logger.error(f"Error recording score metrics: {e}")
+
+    async def record_portrait(self) -> None:
+        try:
+            await self._update_daily(_day_start(), {"$inc": {"portraits": 1}})
+        except Exception as e:
+            logger.error(f"Error recording portrait metrics: {e}")
+
+    async def record_onboarding_completed(self, user_id: int) -> None:
+        try:
+            # Как и has_messages: флаг гарантирует, что бэкфилл и живой путь посчитают пользователя один раз.
+            flagged = await self.collection.update_one(
+                {"user_id": user_id, "type": "user_profile", "onboarding_counted": {"$ne": True}},
+                {"$set": {"onboarding_counted": True}}
+            )
+            if flagged.modified_count:
+                await self._inc_totals({"onboarding_completed": 1})
+        except Exception as e:
+            logger.error(f"Error recording onboarding metrics: {e}")
+
+    async def _query_totals(self, window: "_Window") -> Dict[str, Any]:
+        return await self.collection.find_one({"type": TOTALS_TYPE}) or {}
+
+    async def _query_daily_counters(self, window: "_Window") -> List[Dict]:
+        return await self.collection.find(
+            {"type": DAILY_TYPE, "date": {"$gte": window.prev7}},
+            {"_id": 0, "date": 1, **{c: 1 for c in _DAILY_COUNTERS}}
+        ).to_list(length=None)
+
+    async def _query_today_dialogs(self, window: "_Window") -> int:
+        doc = await self.collection.find_one(
+            {"type": DAILY_TYPE, "date": window.today},
+            {"_id": 0, "dialog_users": 1}
+        ) or {}
+        return len(doc.get("dialog_users", []))
+
+    async def _query_unique_users(self, window: "_Window") -> Dict[str, int]:
+        pipeline = [
+            {"$match": {"type": DAILY_TYPE, "date": {"$gte": window.d30}}},
+            {"$project": {"date": 1, "active_users": 1}},
+            {"$unwind": "$active_users"},
+            {"$group": {"_id": "$active_users", "last": {"$max": "$date"}}},
+            {"$group": {
+                "_id": None,
+                "mau": {"$sum": 1},
+                "wau": {"$sum": {"$cond": [{"$gte": ["$last", window.d7]}, 1, 0]}},
+                "dau": {"$sum": {"$cond": [{"$gte": ["$last", window.today]}, 1, 0]}},
+            }}
+        ]
+        result = await self.collection.aggregate(pipeline).to_list(length=1)
+        return result[0] if result else {}
+
+    async def _run_metric_queries(self, window: "_Window") -> Dict[str, Any]:
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        timings: Dict[str, float] = {}
+        failed: List[str] = []
+
+        async def _run(spec: MetricQuery) -> Any:
+            async with semaphore:
+                started = time.monotonic()
+                try:
+                    return await asyncio.wait_for(spec.run(self, window), timeout=spec.timeout)
+                except Exception as e:
+                    failed.append(spec.name)
+                    reason = "timeout" if isinstance(e, asyncio.TimeoutError) else e
+                    logger.warning(f"Admin metric '{spec.name}' failed: {reason}")
+                    return spec.default()
+                finally:
+                    timings[spec.name] = round(time.monotonic() - started, 3)
+                    if timings[spec.name] > self.slow_query_sec:
+                        logger.warning(f"Slow admin metric '{spec.name}': {timings[spec.name]:.2f}s")
+
+        values = await asyncio.gather(*(_run(spec) for spec in METRIC_QUERIES))
+        self.last_timings = timings
+        return {
+            "values": {spec.name: value for spec, value in zip(METRIC_QUERIES, values)},
+            "failed": failed,
+            "timings": timings,
+        }
+
+    async def get_summary(self) -> Dict[str, Any]:
+        today = _day_start()
+        d7 = today - timedelta(days=6)
+        window = _Window(today=today, d7=d7, d30=today - timedelta(days=29), prev7=d7 - timedelta(days=7))
+
+        run = await self._run_metric_queries(window)
+        results = run["values"]
+        totals = results["totals"]
+        days = results["daily_counters"]
+        uniques = results["unique_users"]
+
+        def _sum(field: str, since: datetime, until: Optional[datetime] = None) -> int:
+            return sum(d.get(field, 0) for d in days
+                       if d["date"].replace(tzinfo=timezone.utc) >= since
+                       and (until is None or d["date"].replace(tzinfo=timezone.utc) < until))
+
+        today_doc = next((d for d in days if d["date"].replace(tzinfo=timezone.utc) >= today), {})
+
+        total_users = totals.get("users", 0)
+        total_messages = totals.get("messages", 0)
+        senders = totals.get("message_senders", 0)
+        sessions_7d = _sum("sessions", d7)
+        score_count_7d = _sum("score_count", d7)
+        score_count_prev = _sum("score_count", window.prev7, d7)
+        avg_score_7d = _sum("score_sum", d7) / score_count_7d if score_count_7d else 0.0
+        prev_avg_score_7d = _sum("score_sum", window.prev7, d7) / score_count_prev if score_count_prev else 0.0
+        trend = (avg_score_7d - prev_avg_score_7d) / prev_avg_score_7d if prev_avg_score_7d > 0 else 0.0
+
+        return {
+            "total_users": total_users,
+            "dau": uniques.get("dau", 0),
+            "wau": uniques.get("wau", 0),
+            "mau": uniques.get("mau", 0),
+            "new_24h": today_doc.get("new_users", 0),
+            "new_7d": _sum("new_users", d7),
+            "active_dialogs_24h": results["today_dialogs"],
+            "avg_msgs": {
+                "average_messages_per_user": round(total_messages / senders, 2) if senders else 0,
+                "total_messages": total_messages,
+                "unique_users": senders,
+            },
+            "sessions_7d": sessions_7d,
+            "avg_session_len": _sum("session_messages", d7) / sessions_7d if sessions_7d else 0.0,
+            "portraits_7d": _sum("portraits", d7),
+            "avg_score_7d": avg_score_7d,
+            "trend": trend,
+            "onboarding_conv": totals.get("onboarding_completed", 0) / (total_users or 1),
+            "failed_metrics": run["failed"],
+            "timings": run["timings"],
+        }
+
+    async def ensure_backfilled(self) -> None:
+        """Однократно заполняет роллапы из истории; упавший запуск повторяется после устаревания маркера."""
+        try:
+            marker = await claim_backfill(self.collection, BACKFILL_MARKER_TYPE,
+                                          on_insert={"cutoff": datetime.now(timezone.utc)})
+            if marker is None:
+                return
+            totals = await self.collection.find_one({"type": TOTALS_TYPE}, {"backfill_started_at": 1})
+            if totals and totals.get("backfill_started_at"):
+                # Роллапы заполнены прежней версией (захват прямо на totals) — повторять нельзя.
+                logger.info("Metrics rollups were backfilled before the marker existed, skipping")
+            else:
+                # Повторный запуск берёт исходный cutoff: всё после него уже посчитали живые record_*.
+                cutoff = marker["cutoff"]
+                await self._backfill(cutoff if cutoff.tzinfo else cutoff.replace(tzinfo=timezone.utc))
+            await self.collection.update_one(
+                {"type": BACKFILL_MARKER_TYPE},
+                {"$set": {"finished_at": datetime.now(timezone.utc)}}
+            )
+        except Exception as e:
+            logger.error(f"Metrics rollup backfill failed: {e}")
+
+    async def _backfill(self, cutoff: datetime) -> None:
+        """Досчитывает события до cutoff — момента захвата бэкфилла.
+
+        Всё, что случилось после cutoff, уже учтено живыми record_*, поэтому
+        история берётся строго до него. Авторов сообщений и завершивших онбординг
+        считаем по переключению флагов в профиле: кто первым поставил флаг, тот и посчитал.
+
+        Запуск можно повторить после сбоя: каждый суточный документ и totals получают свою
+        долю вместе с отметкой backfilled одним обновлением, а флаги, поставленные бэкфиллом,
+        помечены отдельно и пересчитываются целиком.
+        """
+        logger.info("Backfilling metrics rollups from history...")
+        since = _day_start() - timedelta(days=BACKFILL_DAYS - 1)
+        daily: Dict[datetime, Dict[str, Any]] = {}
+
+        def _bucket(day_str: str) -> Dict[str, Any]:
+            day = datetime.strptime(day_str, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+            return daily.setdefault(day, {"active_users": set(), "dialog_users": set()})
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def _by_day(doc_type: str, ts_field: str, group: Dict[str, Any]) -> List[Dict]:
+            pipeline = [
+                {"$match": {"type": doc_type, ts_field: {"$gte": since, "$lt": cutoff}}},
+                {"$group": {"_id": {"$dateToString": {"format": "%Y-%m-%d", "date": f"${ts_field}"}}, **group}}
+            ]
+            async with semaphore:
+                return await self.collection.aggregate(pipeline).to_list(length=None)
+
+        messages, active, created, sessions, scores, portraits = await asyncio.gather(
+            _by_day("user_message", "timestamp", {"n": {"$sum": 1}, "users": {"$addToSet": "$user_id"}}),
+            _by_day("user_profile", "last_active", {"users": {"$addToSet": "$user_id"}}),
+            _by_day("user_profile", "created_at", {"n": {"$sum": 1}}),
+            _by_day("session_summary", "date", {"n": {"$sum": 1}, "len": {"$sum": "$full_dialog_length"}}),
+            _by_day("progress_score", "timestamp", {"n": {"$sum": 1}, "s": {"$sum": "$score"}}),
+            _by_day("portrait", "generated_at", {"n": {"$sum": 1}}),
+        )
+        for row in messages:
+            bucket = _bucket(row["_id"])
+            bucket["messages"] = row["n"]
+            bucket["dialog_users"].update(row["users"])
+            bucket["active_users"].update(row["users"])
+        for row in active:
+            _bucket(row["_id"])["active_users"].update(row["users"])
+        for row in created:
+            _bucket(row["_id"])["new_users"] = row["n"]
+        for row in sessions:
+            bucket = _bucket(row["_id"])
+            bucket["sessions"], bucket["session_messages"] = row["n"], row["len"]
+        for row in scores:
+            bucket = _bucket(row["_id"])
+            bucket["score_count"], bucket["score_sum"] = row["n"], row["s"]
+        for row in portraits:
+            _bucket(row["_id"])["portraits"] = row["n"]
+
+        for day, values in daily.items():
+            inc = {c: values[c] for c in _DAILY_COUNTERS if values.get(c)}
+            update: Dict[str, Any] = {"$addToSet": {
+                "active_users": {"$each": sorted(values["active_users"])},
+                "dialog_users": {"$each": sorted(values["dialog_users"])},
+            }}
+            if inc:
+                update["$inc"] = inc
+            update["$set"] = {"backfilled": True}
+            await self.collection.update_one(
+                {"type": DAILY_TYPE, "date": day}, {"$setOnInsert": {"active_users": []}}, upsert=True
+            )
+            await self.collection.update_one({"type": DAILY_TYPE, "date": day, "backfilled": {"$ne": True}}, update)
+
+        senders_cursor = self.collection.aggregate([
+            {"$match": {"type": "user_message", "timestamp": {"$lt": cutoff}}},
+            {"$group": {"_id": "$user_id"}}
+        ])
+        senders = [row["_id"] async for row in senders_cursor]
+        for i in range(0, len(senders), 1000):
+            await self.collection.update_many(
+                {"type": "user_profile", "user_id": {"$in": senders[i:i + 1000]}, "has_messages": {"$ne": True}},
+                {"$set": {"has_messages": True, "has_messages_backfilled": True}}
+            )
+        await self.collection.update_many(
+            {"type": "user_profile", "onboarding_completed": True, "onboarding_counted": {"$ne": True}},
+            {"$set": {"onboarding_counted": True, "onboarding_backfilled": True}}
+        )
+
+        users, total_messages, new_senders, onboarded = await asyncio.gather(
+            # Профили без created_at (созданные онбордингом) живой путь не считает — их считаем здесь.
+            self.collection.count_documents({"type": "user_profile", "$or": [
+                {"created_at": {"$lt": cutoff}}, {"created_at": {"$exists": False}}
+            ]}),
+            self.collection.count_documents({"type": "user_message", "timestamp": {"$lt": cutoff}}),
+            self.collection.count_documents({"type": "user_profile", "has_messages_backfilled": True}),
+            self.collection.count_documents({"type": "user_profile", "onboarding_backfilled": True}),
+        )
+        await self.collection.update_one({"type": TOTALS_TYPE}, {"$setOnInsert": {"users": 0}}, upsert=True)
+        await self.collection.update_one(
+            {"type": TOTALS_TYPE, "backfilled": {"$ne": True}},
+            {"$inc": {
+                "users": users,
+                "onboarding_completed": onboarded,
+                "messages": total_messages,
+                "message_senders": new_senders,
+            }, "$set": {"backfilled": True}}
+        )
+        logger.info(f"Metrics rollups backfilled for {len(daily)} days")
+
+
+METRIC_QUERIES: tuple[MetricQuery, ...] = (
+    MetricQuery("totals", MetricsService._query_totals, dict, timeout=3.0),
+    MetricQuery("daily_counters", MetricsService._query_daily_counters, list, timeout=5.0),
+    MetricQuery("today_dialogs", MetricsService._query_today_dialogs, int, timeout=3.0),
+    MetricQuery("unique_users", MetricsService._query_unique_users, dict, timeout=8.0),
+)
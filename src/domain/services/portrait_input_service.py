@@ -0,0 +1,162 @@
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.domain.services.summary_service import SUMMARY_FAILED_TEXT
+from src.utils.token_estimator import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Сколько документов читать в худшем случае; бюджет токенов обычно обрезает выборку раньше.
+MAX_MESSAGES = 500
+MAX_SUMMARIES = 200
+# Доля бюджета, которую конспекты могут занять до того, как свежие сообщения наберут своё.
+SUMMARY_SHARE = 0.4
+# Предел для прошлого портрета: длинный портрет не должен съесть бюджет новых данных.
+PRIOR_SHARE = 0.5
+
+
+def _utc(dt: Optional[datetime]) -> Optional[datetime]:
+    if isinstance(dt, datetime) and dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt if isinstance(dt, datetime) else None
+
+
+@dataclass
+class PortraitInput:
+    prior: Optional[str] = None
+    prior_at: Optional[datetime] = None
+    summaries: List[Tuple[Optional[datetime], str]] = field(default_factory=list)
+    messages: List[str] = field(default_factory=list)
+    tokens: int = 0
+    dropped: int = 0
+
+    @property
+    def is_empty(self) -> bool:
+        """Нечего анализировать: ни конспектов, ни сообщений после прошлого портрета."""
+        return not self.summaries and not self.messages
+
+    def render(self) -> str:
+        parts = []
+        if self.prior:
+            date_str = f" от {self.prior_at.strftime('%d.%m.%Y')}" if self.prior_at else ""
+            parts.append(
+                f"ПРЕДЫДУЩИЙ ПОРТРЕТ{date_str} (уточни его по новым данным: сохрани то, что подтверждается, "
+                f"и явно отметь, что изменилось):\n---\n{self.prior}\n---"
+            )
+        if self.summaries:
+            lines = "\n".join(
+                f"- {dt.strftime('%d.%m.%Y')}: {text}" if dt else f"- {text}" for dt, text in self.summaries
+            )
+            parts.append(f"КОНСПЕКТЫ СЕССИЙ:\n---\n{lines}\n---")
+        if self.messages:
+            title = "НОВЫЕ СООБЩЕНИЯ ПОЛЬЗОВАТЕЛЯ" if self.prior else "СООБЩЕНИЯ ПОЛЬЗОВАТЕЛЯ"
+            lines = "\n".join(f"- {msg}" for msg in self.messages)
+            parts.append(f"{title}:\n---\n{lines}\n---")
+        return "\n\n".join(parts)
+
+
+class PortraitInputBuilder:
+    """Входные данные портрета в пределах бюджета токенов.
+
+    Вместо всей истории берутся прошлый портрет как отправная точка, конспекты сессий
+    после него и только новые сообщения — от свежих к старым, пока хватает бюджета.
+    Без прошлого портрета в ход идут все конспекты и последние сообщения.
+    """
+
+    def __init__(self, users_collection, *, token_budget: int = 12000,
+                 estimate: Optional[Callable[[str], int]] = None, message_archive=None):
+        self.collection = users_collection
+        self.token_budget = token_budget
+        self.estimate = estimate or estimate_tokens
+        self.message_archive = message_archive
+
+    async def build(self, user_id: int) -> PortraitInput:
+        result = PortraitInput()
+        last_portrait = await self.collection.find_one(
+            {"user_id": user_id, "type": "portrait"},
+            {"portrait_text": 1, "generated_at": 1, "_id": 0},
+            sort=[("generated_at", -1)]
+        )
+        since = None
+        if last_portrait and last_portrait.get("portrait_text"):
+            # Прошлый портрет входит всегда (без него регенерация теряет накопленный анализ), но не больше своей доли.
+            result.prior = self._truncate(last_portrait["portrait_text"], int(self.token_budget * PRIOR_SHARE))
+            result.prior_at = since = _utc(last_portrait.get("generated_at"))
+
+        budget = self.token_budget - (self.estimate(result.prior) if result.prior else 0)
+        summaries = await self._load_summaries(user_id, since)
+        messages = await self._load_messages(user_id, since)
+
+        summary_costs = [self.estimate(text) for _, text in summaries]
+        message_costs = [self.estimate(text) for text in messages]
+        # Сначала конспекты до своей доли, затем сообщения, затем остаток бюджета снова конспектам.
+        n_summaries, used = self._take(summary_costs, int(budget * SUMMARY_SHARE))
+        n_messages, used_messages = self._take(message_costs, budget - used)
+        used += used_messages
+        extra, used_extra = self._take(summary_costs[n_summaries:], budget - used)
+        n_summaries += extra
+        used += used_extra
+
+        # Выборки идут от свежих к старым; в промпт — по хронологии.
+        result.summaries = list(reversed(summaries[:n_summaries]))
+        result.messages = list(reversed(messages[:n_messages]))
+        result.tokens = self.token_budget - budget + used
+        result.dropped = len(summaries) - n_summaries + len(messages) - n_messages
+        if result.dropped:
+            logger.info(f"Portrait input for user {user_id}: {result.tokens} tokens, {result.dropped} items over budget")
+        return result
+
+    def _truncate(self, text: str, max_tokens: int) -> str:
+        cost = self.estimate(text)
+        if cost <= max_tokens:
+            return text
+        cut = int(len(text) * max_tokens / cost)
+        while cut > 0 and self.estimate(text[:cut]) > max_tokens:
+            cut = int(cut * 0.9)
+        return text[:cut].rstrip() + "…"
+
+    @staticmethod
+    def _take(costs: List[int], budget: int) -> Tuple[int, int]:
+        used = 0
+        for i, cost in enumerate(costs):
+            if used + cost > budget:
+                return i, used
+            used += cost
+        return len(costs), used
+
+    async def _load_summaries(self, user_id: int, since: Optional[datetime]) -> List[Tuple[Optional[datetime], str]]:
+        query: Dict = {"user_id": user_id, "type": "session_summary"}
+        if since is not None:
+            query["date"] = {"$gt": since}
+        summaries = []
+        async for doc in self.collection.find(query, {"summary": 1, "date": 1, "_id": 0}).sort("date", -1).limit(MAX_SUMMARIES):
+            text = (doc.get("summary") or "").strip()
+            if text and text != SUMMARY_FAILED_TEXT:
+                summaries.append((_utc(doc.get("date")), text))
+        return summaries
+
+    async def _load_messages(self, user_id: int, since: Optional[datetime]) -> List[str]:
+        if self.message_archive is not None:
+            # Реплики старше срока архивации лежат в бакетах: свежие документы и архив читаются
+            # вместе от новых к старым, поэтому в бюджет попадают последние сообщения после since.
+            docs = await self.message_archive.load_recent_messages(
+                user_id, roles=("user",), limit=MAX_MESSAGES, after=since
+            )
+        else:
+            query: Dict = {"user_id": user_id, "type": "user_message"}
+            if since is not None:
+                query["timestamp"] = {"$gt": since}
+            docs = await self.collection.find(
+                query, {"text": 1, "username": 1, "_id": 0}
+            ).sort("timestamp", -1).limit(MAX_MESSAGES).to_list(length=MAX_MESSAGES)
+
+        messages = []
+        for doc in docs:
+            text = (doc.get("text") or "").strip()
+            if not text:
+                continue
+            username = doc.get("username")
+            messages.append(f"@{username}: {text}" if username else text)
+        return messages
@@ -0,0 +1,414 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from src.domain.services.mailing_service import blacklist_users
+from src.presentation import keyboards, photos
+from src.utils.portrait_utils import split_into_pages, update_portrait_caption_animation
+
+logger = logging.getLogger(__name__)
+
+JOB_TYPE = "portrait_job"
+NIGHTLY_RUN_TYPE = "portrait_nightly_run"
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NIGHTLY = 10
+# Генерация идёт десятки секунд; лиз с запасом, после его истечения задание подхватит любой процесс.
+JOB_LEASE_SEC = 300
+# Пока генерация идёт, лиз продлевается: медленный ответ модели не должен отдать задание второму процессу.
+LEASE_RENEW_SEC = JOB_LEASE_SEC // 3
+MAX_JOB_ATTEMPTS = 3
+PORTRAIT_HEADER = "Ваш Психологический Портрет: 🧠\n\n"
+PORTRAIT_FAILED_TEXT = "Ошибка генерации портрета. Попробуйте позже."
+
+
+class PortraitGenerationError(Exception):
+    """Генерация не дала портрета; текст ошибки можно показать пользователю."""
+
+
+def _utc(dt: Optional[datetime]) -> Optional[datetime]:
+    if isinstance(dt, datetime) and dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt if isinstance(dt, datetime) else None
+
+
+class PortraitQueue:
+    """Фоновая генерация портретов: задания portrait_job в Mongo, очередь по приоритету и пул воркеров.
+
+    У пользователя не больше одного активного задания (атомарный upsert по active плюс частичный
+    уникальный индекс), поэтому повторное нажатие или ночная генерация не запускают вторую генерацию, а лишь
+    поднимают приоритет и запоминают сообщение, куда доставить результат. Задания переживают
+    рестарт: resume_unfinished возвращает в очередь всё, у чего истёк лиз.
+    """
+
+    def __init__(self, bot, users_collection, generate: Callable[[int], Awaitable[str]], *,
+                 fsm_storage=None, workers: int = 2, metrics=None,
+                 nightly_window: Tuple[int, int] = (1, 5), nightly_active_days: int = 7,
+                 cooldown_hours: int = 24):
+        self.bot = bot
+        self.collection = users_collection
+        self.generate = generate
+        self.fsm_storage = fsm_storage
+        self.workers = workers
+        self.metrics = metrics
+        self.nightly_window = nightly_window
+        self.nightly_active_days = nightly_active_days
+        self.cooldown_hours = cooldown_hours
+        self._queue: "asyncio.PriorityQueue[Tuple[int, int, ObjectId]]" = asyncio.PriorityQueue()
+        # Лучший приоритет, с которым задание лежит в очереди; устаревшие записи воркер пропускает.
+        self._queued: Dict[ObjectId, int] = {}
+        self._seq = 0
+        self._tasks: List[asyncio.Task] = []
+
+    # --- постановка в очередь ---
+
+    async def enqueue(self, user_id: int, chat_id: int, *, message_id: Optional[int] = None,
+                      priority: int = PRIORITY_INTERACTIVE, source: str = "interactive") -> Tuple[ObjectId, bool]:
+        """Ставит задание или обновляет активное; возвращает (id задания, создано ли новое).
+
+        Один атомарный upsert по (type, user_id, active): второе активное задание не появится,
+        даже если индекс portrait_job_active создать не удалось. Если индекс есть и параллельный
+        upsert упёрся в него, повторяем — второй раз найдётся уже вставленное задание.
+        """
+        now = datetime.now(timezone.utc)
+        new_id = ObjectId()
+        on_insert: Dict = {
+            "_id": new_id,
+            "status": "queued",
+            "attempts": 0,
+            "created_at": now,
+            "lease_until": now,
+        }
+        fields = {"message_id": message_id, "chat_id": chat_id, "source": source}
+        if message_id is not None:
+            update: Dict = {"$set": {"updated_at": now, **fields}}
+        else:
+            update = {"$set": {"updated_at": now}}
+            on_insert.update(fields)
+        update["$min"] = {"priority": priority}
+        update["$setOnInsert"] = on_insert
+        try:
+            before = await self.collection.find_one_and_update(
+                {"type": JOB_TYPE, "user_id": user_id, "active": True},
+                update,
+                projection={"_id": 1, "priority": 1},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError:
+            return await self.enqueue(user_id, chat_id, message_id=message_id, priority=priority, source=source)
+        if before is None:
+            job_id, created = new_id, True
+        else:
+            job_id, created = before["_id"], False
+            priority = min(priority, before.get("priority", priority))
+        self._push(job_id, priority)
+        return job_id, created
+
+    def _push(self, job_id: ObjectId, priority: int) -> None:
+        known = self._queued.get(job_id)
+        if known is not None and known <= priority:
+            return
+        self._queued[job_id] = priority
+        self._seq += 1
+        self._queue.put_nowait((priority, self._seq, job_id))
+
+    async def resume_unfinished(self) -> int:
+        """Возвращает в очередь активные задания с истёкшим лизом (рестарт или упавший процесс)."""
+        now = datetime.now(timezone.utc)
+        count = 0
+        try:
+            async for job in self.collection.find(
+                {"type": JOB_TYPE, "active": True, "lease_until": {"$lte": now}},
+                {"_id": 1, "priority": 1}
+            ):
+                self._push(job["_id"], job.get("priority", PRIORITY_NIGHTLY))
+                count += 1
+        except Exception as e:
+            logger.error(f"Не удалось найти незавершённые задания портретов: {e}")
+        if count:
+            logger.info(f"Resumed {count} portrait jobs")
+        return count
+
+    # --- воркеры ---
+
+    async def _worker(self) -> None:
+        while True:
+            priority, _, job_id = await self._queue.get()
+            try:
+                if self._queued.get(job_id) != priority:
+                    continue
+                del self._queued[job_id]
+                await self._process(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error processing portrait job {job_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _claim(self, job_id: ObjectId) -> Optional[Dict]:
+        now = datetime.now(timezone.utc)
+        return await self.collection.find_one_and_update(
+            {"_id": job_id, "type": JOB_TYPE, "active": True, "lease_until": {"$lte": now}},
+            {
+                "$set": {"status": "running", "lease_until": now + timedelta(seconds=JOB_LEASE_SEC),
+                         "updated_at": now},
+                "$inc": {"attempts": 1},
+            },
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _process(self, job_id: ObjectId) -> None:
+        job = await self._claim(job_id)
+        if job is None:
+            return
+        user_id = job["user_id"]
+        if job.get("attempts", 0) > MAX_JOB_ATTEMPTS:
+            logger.warning(f"Portrait job {job_id} of user {user_id} exceeded {MAX_JOB_ATTEMPTS} attempts")
+            job = await self._finish(job_id, "failed", error="too many attempts")
+            await self._deliver_failure(job, PORTRAIT_FAILED_TEXT)
+            return
+
+        stop_event = asyncio.Event()
+        animation_task = None
+        if job.get("message_id"):
+            animation_task = asyncio.create_task(
+                update_portrait_caption_animation(self.bot, job["chat_id"], job["message_id"], stop_event)
+            )
+        heartbeat_task = asyncio.create_task(self._keep_lease(job_id))
+        portrait_text = None
+        error_text = PORTRAIT_FAILED_TEXT
+        try:
+            portrait_text = await self.generate(user_id)
+        except PortraitGenerationError as e:
+            error_text = str(e) or PORTRAIT_FAILED_TEXT
+            logger.warning(f"User {user_id} failed to generate portrait: {error_text}")
+        except Exception as e:
+            logger.error(f"Critical error during portrait generation for user {user_id}: {e}")
+        finally:
+            heartbeat_task.cancel()
+            await asyncio.gather(heartbeat_task, return_exceptions=True)
+            stop_event.set()
+            if animation_task is not None:
+                # Не ждём паузу между кадрами анимации: воркер сразу берёт следующее задание.
+                animation_task.cancel()
+                await asyncio.gather(animation_task, return_exceptions=True)
+
+        if not portrait_text:
+            job = await self._finish(job_id, "failed", error=error_text)
+            await self._deliver_failure(job, error_text)
+            return
+
+        generated_at = await self._save(job, portrait_text)
+        # Адрес доставки читаем после завершения: пока шла генерация, пользователь мог нажать кнопку ещё раз.
+        job = await self._finish(job_id, "done")
+        await self._deliver(job, portrait_text, generated_at)
+
+    async def _keep_lease(self, job_id: ObjectId) -> None:
+        while True:
+            await asyncio.sleep(LEASE_RENEW_SEC)
+            now = datetime.now(timezone.utc)
+            try:
+                await self.collection.update_one(
+                    {"_id": job_id, "type": JOB_TYPE, "active": True, "status": "running"},
+                    {"$set": {"lease_until": now + timedelta(seconds=JOB_LEASE_SEC), "updated_at": now}}
+                )
+            except Exception as e:
+                logger.warning(f"Failed to renew lease of portrait job {job_id}: {e}")
+
+    async def _save(self, job: Dict, portrait_text: str) -> datetime:
+        user_id = job["user_id"]
+        now = datetime.now(timezone.utc)
+        await self.collection.insert_one({
+            "user_id": user_id,
+            "type": "portrait",
+            "portrait_text": portrait_text,
+            "generated_at": now,
+            "source": job.get("source", "interactive"),
+            # Ночной портрет пользователь ещё не открывал — покажем его без предупреждения о кулдауне.
+            "seen": job.get("message_id") is not None,
+        })
+        await self.collection.update_one(
+            {"user_id": user_id, "type": "user_profile"},
+            {"$set": {"last_portrait_timestamp": now}},
+            upsert=True
+        )
+        if self.metrics is not None:
+            try:
+                await self.metrics.record_portrait()
+            except Exception as e:
+                logger.warning(f"Failed to record portrait metric: {e}")
+        logger.info(f"Portrait saved to DB for user {user_id} ({job.get('source')})")
+        return now
+
+    async def _finish(self, job_id: ObjectId, status: str, *, error: Optional[str] = None) -> Dict:
+        now = datetime.now(timezone.utc)
+        job = await self.collection.find_one_and_update(
+            {"_id": job_id, "type": JOB_TYPE},
+            {"$set": {"status": status, "error": error, "finished_at": now, "updated_at": now},
+             "$unset": {"active": ""}},
+            return_document=ReturnDocument.AFTER
+        )
+        return job or {}
+
+    # --- доставка ---
+
+    async def _deliver(self, job: Dict, portrait_text: str, generated_at: datetime) -> None:
+        user_id, chat_id, message_id = job.get("user_id"), job.get("chat_id"), job.get("message_id")
+        if user_id is None:
+            return
+        if message_id is None:
+            await self._notify_nightly(user_id, chat_id or user_id)
+            return
+
+        full_text = f"{PORTRAIT_HEADER}{portrait_text}"
+        pages = split_into_pages(full_text)
+        nightly = await self._nightly_enabled(user_id)
+        markup = keyboards.portrait_pagination_keyboard(1, max(1, len(pages)), nightly=nightly)
+        try:
+            await self.bot.edit_message_caption(chat_id=chat_id, message_id=message_id,
+                                                caption=pages[0], reply_markup=markup)
+        except TelegramBadRequest as e:
+            logger.warning(f"Failed to edit portrait caption for user {user_id}: {e}")
+            try:
+                sent = await self.bot.send_photo(chat_id, photo=photos.portrait_photo, caption=pages[0],
+                                                 reply_markup=markup)
+                message_id = sent.message_id
+            except Exception as e:
+                logger.error(f"Не удалось доставить портрет пользователю {user_id}: {e}")
+                return
+        except TelegramForbiddenError:
+            await blacklist_users(self.collection, [user_id])
+            return
+
+        await self._update_state(user_id, chat_id, portrait_pages=pages, portrait_page_idx=1,
+                                 portrait_message_id=message_id, portrait_nightly=nightly,
+                                 portrait_loading=False, loading_message_id=None)
+
+    async def _deliver_failure(self, job: Dict, error_text: str) -> None:
+        if not job.get("message_id"):
+            return
+        try:
+            await self.bot.edit_message_caption(chat_id=job["chat_id"], message_id=job["message_id"],
+                                                caption=error_text, reply_markup=keyboards.back_to_menu_keyboard)
+        except Exception as e:
+            logger.warning(f"Failed to report portrait failure to user {job.get('user_id')}: {e}")
+        await self._update_state(job["user_id"], job["chat_id"], portrait_loading=False, loading_message_id=None)
+
+    async def _notify_nightly(self, user_id: int, chat_id: int) -> None:
+        try:
+            await self.bot.send_message(
+                chat_id,
+                "🌙 Пока вы отдыхали, я обновил ваш психологический портрет.",
+                reply_markup=keyboards.nightly_portrait_ready_keyboard,
+                disable_notification=True
+            )
+        except TelegramForbiddenError:
+            await blacklist_users(self.collection, [user_id])
+        except Exception as e:
+            logger.warning(f"Не удалось уведомить пользователя {user_id} о ночном портрете: {e}")
+
+    async def _nightly_enabled(self, user_id: int) -> bool:
+        profile = await self.collection.find_one({"user_id": user_id, "type": "user_profile"},
+                                                 {"portrait_nightly": 1, "_id": 0})
+        return bool(profile and profile.get("portrait_nightly"))
+
+    async def _update_state(self, user_id: int, chat_id: int, **data) -> None:
+        if self.fsm_storage is None:
+            return
+        try:
+            state = FSMContext(storage=self.fsm_storage,
+                               key=StorageKey(bot_id=self.bot.id, chat_id=chat_id, user_id=user_id))
+            await state.update_data(**data)
+        except Exception as e:
+            logger.warning(f"Failed to update portrait state of user {user_id}: {e}")
+
+    # --- ночная генерация ---
+
+    def _in_nightly_window(self, now: datetime) -> bool:
+        start, end = self.nightly_window
+        return start <= now.hour < end
+
+    async def schedule_nightly(self) -> int:
+        """Раз в сутки ставит ночные задания подписанным пользователям с новыми сообщениями."""
+        now = datetime.now(timezone.utc)
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        try:
+            marker = await self.collection.find_one_and_update(
+                {"type": NIGHTLY_RUN_TYPE, "date": today},
+                {"$setOnInsert": {"started_at": now}},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError:
+            return 0
+        if marker is not None:
+            return 0
+
+        cooldown_edge = now - timedelta(hours=self.cooldown_hours)
+        count = 0
+        async for profile in self.collection.find(
+            {
+                "type": "user_profile",
+                "portrait_nightly": True,
+                "blacklisted": {"$ne": True},
+                "last_active": {"$gte": now - timedelta(days=self.nightly_active_days)},
+            },
+            {"user_id": 1, "last_active": 1, "last_portrait_timestamp": 1, "_id": 0}
+        ):
+            user_id = profile.get("user_id")
+            if not isinstance(user_id, int):
+                continue
+            last_portrait = _utc(profile.get("last_portrait_timestamp"))
+            last_active = _utc(profile.get("last_active"))
+            if last_portrait is not None and (last_portrait > cooldown_edge
+                                              or (last_active is not None and last_portrait >= last_active)):
+                continue
+            try:
+                await self.enqueue(user_id, user_id, priority=PRIORITY_NIGHTLY, source="nightly")
+                count += 1
+            except Exception as e:
+                logger.error(f"Не удалось поставить ночной портрет пользователя {user_id}: {e}")
+        await self.collection.update_one(
+            {"type": NIGHTLY_RUN_TYPE, "date": today},
+            {"$set": {"finished_at": datetime.now(timezone.utc), "queued": count}}
+        )
+        logger.info(f"Nightly portraits queued: {count}")
+        return count
+
+    # --- жизненный цикл ---
+
+    def start(self, check_interval: int = 900) -> None:
+        if self._tasks:
+            return
+
+        async def scheduler():
+            while True:
+                try:
+                    await self.resume_unfinished()
+                    if self._in_nightly_window(datetime.now(timezone.utc)):
+                        await self.schedule_nightly()
+                    await asyncio.sleep(check_interval)
+                except asyncio.CancelledError:
+                    break
+                except Exception as e:
+                    logger.error(f"Error in portrait scheduler: {e}")
+                    await asyncio.sleep(check_interval)
+
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(max(1, self.workers))]
+        self._tasks.append(asyncio.create_task(scheduler()))
+
+    async def close(self) -> None:
+        # Незавершённые задания остаются активными в Mongo и продолжатся после рестарта.
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from google.genai import types
+
+from src.presentation.prompts import SYSTEM_PROMPT_TEXT
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_GUIDELINES = (
+    "### КАК ИСПОЛЬЗОВАТЬ КОНТЕКСТ ПОЛЬЗОВАТЕЛЯ:\n"
+    "ВАЖНО: Используй эту информацию для более персонализированного ответа:\n"
+    "- Если сейчас ночь, упомяни это естественно (например: 'Глубокая ночь, а мысли не отпускают?')\n"
+    "- РЕЗУЛЬТАТЫ ТЕСТОВ: Это психологические тесты, которые пользователь проходил ранее. "
+    "Если видишь высокий уровень стресса (≥4/5), тревожности (≥4/5) или выгорания (≥4/5) - будь более поддерживающим и эмпатичным. "
+    "Если видишь тип личности MBTI - учитывай особенности этого типа в общении. "
+    "Используй эту информацию естественно, не перечисляя явно, но учитывая в своих ответах.\n"
+    "- ОЦЕНКИ ПРОГРЕССА: Это дневник эмоций пользователя (шкала 1-10). "
+    "Если есть тенденция к улучшению - отметь это поддержкой; если к снижению - прояви больше эмпатии и предложи исследовать причины.\n"
+    "- Не перечисляй все данные явно, но используй их для понимания состояния пользователя\n"
+    "- Если видишь противоречия (например, высокий стресс по тесту, но хорошие оценки прогресса), мягко исследуй это в диалоге"
+)
+
+STYLE_MODIFIERS: Dict[str, str] = {
+    "empathy": (
+        "ТВОЙ ПРИОРИТЕТ: Сейчас ты должен быть максимально эмпатичным и поддерживающим. "
+        "Фокусируйся на валидации чувств пользователя, покажи, что ты слышишь его боль. "
+        "Уменьши количество прямых вопросов, увеличь количество фраз сочувствия."
+    ),
+    "action": (
+        "ТВОЙ ПРИОРИТЕТ: Ты должен быть максимально практичным и ориентированным на действия. "
+        "Избегай лишних фраз сочувствия. Сразу предлагай конкретные шаги, формулируй задачи "
+        "и фокусируйся на плане действий. В выводах '3-2-1' делай упор на '1️⃣ Действие'."
+    ),
+}
+
+# За сколько секунд до истечения TTL пересоздавать кэш Gemini.
+CACHE_REFRESH_MARGIN_SEC = 300
+# Потолок паузы между неудачными попытками создать кэш (пауза удваивается с каждой неудачей).
+MAX_FAILURE_COOLDOWN_SEC = 6 * 3600
+
+
+@dataclass
+class PreparedPrompt:
+    system_instruction: str
+    dynamic_section: str
+    cached_content: Optional[str] = None
+
+    def with_context(self, contents: List[types.Content]) -> List[types.Content]:
+        """Добавляет динамический хвост в начало первой реплики пользователя.
+
+        Отдельная user-реплика перед историей дала бы две user-реплики подряд.
+        Реплики из окна диалога мемоизированы, поэтому первая пересобирается, а не меняется на месте.
+        """
+        if not self.dynamic_section:
+            return contents
+        context_part = types.Part(text=self.dynamic_section)
+        if contents and contents[0].role == "user":
+            first = types.Content(role="user", parts=[context_part, *(contents[0].parts or [])])
+            return [first, *contents[1:]]
+        return [types.Content(role="user", parts=[context_part]), *contents]
+
+
+@dataclass
+class _CachedHandle:
+    name: str
+    expires_at: float
+
+
+class PromptBuilder:
+    """Собирает системную инструкцию: статичный префикс (промпт + правила + стиль)
+    мемоизируется по ai_style и, если возможно, хранится в кэше контекста Gemini,
+    а конспект и контекст пользователя идут отдельным динамическим хвостом.
+
+    Кэш создаётся и обновляется в фоне: запрос пользователя никогда не ждёт caches.create,
+    а пока кэша нет, промпт уходит целиком в system_instruction."""
+
+    def __init__(self, gemini_client=None, model: Optional[str] = None, *, use_cached_content: bool = True,
+                 cache_ttl_sec: int = 3600, failure_cooldown_sec: int = 600,
+                 max_failure_cooldown_sec: int = MAX_FAILURE_COOLDOWN_SEC):
+        self.gemini_client = gemini_client
+        self.model = model
+        self.use_cached_content = use_cached_content and gemini_client is not None and bool(model)
+        self.cache_ttl_sec = cache_ttl_sec
+        self.failure_cooldown_sec = failure_cooldown_sec
+        self.max_failure_cooldown_sec = max_failure_cooldown_sec
+        self._prefixes: Dict[str, str] = {}
+        self._handles: Dict[str, _CachedHandle] = {}
+        self._disabled_until: Dict[str, float] = {}
+        self._failures: Dict[str, int] = {}
+        self._refreshing: Dict[str, asyncio.Task] = {}
+
+    def static_prefix(self, ai_style: str) -> str:
+        prefix = self._prefixes.get(ai_style)
+        if prefix is None:
+            parts = [SYSTEM_PROMPT_TEXT, CONTEXT_GUIDELINES]
+            style_modifier = STYLE_MODIFIERS.get(ai_style)
+            if style_modifier:
+                parts.append(style_modifier)
+            prefix = self._prefixes[ai_style] = "\n\n".join(parts)
+        return prefix
+
+    @staticmethod
+    def dynamic_section(user_context: str = "", summary: str = "", session_summary: str = "") -> str:
+        parts = []
+        if summary:
+            parts.append(summary)
+        if session_summary:
+            parts.append(f"### НАЧАЛО ТЕКУЩЕЙ СЕССИИ (кратко; ранние реплики могли не войти в диалог ниже):\n{session_summary}")
+        if user_context:
+            parts.append(f"### КОНТЕКСТ ПОЛЬЗОВАТЕЛЯ:\n{user_context}")
+        return "\n\n".join(parts)
+
+    async def prepare(self, ai_style: str, user_context: str = "", summary: str = "",
+                      session_summary: str = "") -> PreparedPrompt:
+        prefix = self.static_prefix(ai_style)
+        dynamic = self.dynamic_section(user_context, summary, session_summary)
+        system_instruction = f"{prefix}\n\n{dynamic}" if dynamic else prefix
+        cached_content = await self._get_cached_content(ai_style) if self.use_cached_content else None
+        return PreparedPrompt(system_instruction, dynamic, cached_content)
+
+    async def _get_cached_content(self, ai_style: str) -> Optional[str]:
+        now = time.time()
+        handle = self._handles.get(ai_style)
+        if handle is not None and handle.expires_at - CACHE_REFRESH_MARGIN_SEC > now:
+            return handle.name
+        if self._disabled_until.get(ai_style, 0) <= now and ai_style not in self._refreshing:
+            task = asyncio.create_task(self._refresh(ai_style))
+            self._refreshing[ai_style] = task
+            task.add_done_callback(lambda _, style=ai_style: self._refreshing.pop(style, None))
+        # Пока идёт обновление, ещё не истёкший кэш остаётся годным.
+        if handle is not None and handle.expires_at > now:
+            return handle.name
+        return None
+
+    async def _refresh(self, ai_style: str) -> None:
+        try:
+            cached = await self.gemini_client.aio.caches.create(
+                model=self.model,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=self.static_prefix(ai_style),
+                    display_name=f"system-prefix-{ai_style}",
+                    ttl=f"{self.cache_ttl_sec}s",
+                )
+            )
+        except Exception as e:
+            # Например, префикс короче минимального размера кэша для модели.
+            failures = self._failures[ai_style] = self._failures.get(ai_style, 0) + 1
+            cooldown = min(self.failure_cooldown_sec * 2 ** (failures - 1), self.max_failure_cooldown_sec)
+            logger.warning(
+                f"Gemini context cache unavailable for style '{ai_style}', using inline prompt "
+                f"for the next {cooldown}s: {e}"
+            )
+            self._disabled_until[ai_style] = time.time() + cooldown
+            return
+
+        self._failures.pop(ai_style, None)
+        self._handles[ai_style] = _CachedHandle(cached.name, time.time() + self.cache_ttl_sec)
+        logger.info(f"Created Gemini context cache {cached.name} for style '{ai_style}'")
+
+    def invalidate(self, ai_style: str) -> None:
+        self._handles.pop(ai_style, None)
+        self._disabled_until[ai_style] = time.time() + self.failure_cooldown_sec
+
+    @staticmethod
+    def is_cache_error(error: Exception) -> bool:
+        msg = str(error).lower()
+        return "cachedcontent" in msg or "cached content" in msg or "cached_content" in msg
+
+    async def close(self) -> None:
+        refreshing = list(self._refreshing.values())
+        for task in refreshing:
+            task.cancel()
+        await asyncio.gather(*refreshing, return_exceptions=True)
+        handles, self._handles = self._handles, {}
+        for handle in handles.values():
+            try:
+                await self.gemini_client.aio.caches.delete(name=handle.name)
+            except Exception as e:
+                logger.debug(f"Failed to delete Gemini context cache {handle.name}: {e}")
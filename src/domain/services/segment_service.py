@@ -0,0 +1,160 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Callable, Dict, Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+
+from src.infrastructure.database import claim_backfill
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SIZE_TTL_SEC = 60
+BACKFILL_MARKER_TYPE = "segment_backfill"
+
+# Индекс (type, user_id, blacklisted, last_active, last_portrait_timestamp, progress_score_count)
+# из Database.ensure_indexes: все поля условий сегментов лежат в нём после user_id, поэтому
+# выборка любого сегмента — один покрытый проход по индексу в порядке user_id без чтения документов.
+SEGMENT_INDEX_NAME = "mailing_segments"
+
+# Диапазон вместо $exists: его можно проверить по индексу, не читая документ.
+_ANY_DATE = {"$gte": datetime(1970, 1, 1, tzinfo=timezone.utc)}
+
+
+@dataclass(frozen=True)
+class Segment:
+    title: str
+    conditions: Callable[[], Dict]
+
+
+SEGMENTS: Dict[str, Segment] = {
+    "all": Segment("Все пользователи", lambda: {}),
+    "active7": Segment(
+        "Активные 7 дней",
+        lambda: {"last_active": {"$gte": datetime.now(timezone.utc) - timedelta(days=7)}}
+    ),
+    "has_portrait": Segment("Есть портрет", lambda: {"last_portrait_timestamp": _ANY_DATE}),
+    "scores3": Segment("≥3 оценок", lambda: {"progress_score_count": {"$gte": 3}}),
+}
+
+
+class SegmentService:
+    """Сегменты рассылки как условия на поля профиля.
+
+    Поля поддерживаются инкрементально (last_active, last_portrait_timestamp,
+    progress_score_count), поэтому сегмент не пересчитывается по истории событий.
+    """
+
+    def __init__(self, users_collection, cache=None):
+        self.collection = users_collection
+        self.cache = cache
+
+    @staticmethod
+    def query(seg: str) -> Optional[Dict]:
+        segment = SEGMENTS.get(seg)
+        if segment is None:
+            return None
+        return {"type": "user_profile", "blacklisted": {"$ne": True}, **segment.conditions()}
+
+    async def iter_user_ids(self, seg: str, after_user_id: Optional[int] = None,
+                            batch_size: int = 500) -> AsyncIterator[int]:
+        """Получатели сегмента по возрастанию user_id, без загрузки всего списка в память."""
+        query = self.query(seg)
+        if query is None:
+            return
+        if after_user_id is not None:
+            query["user_id"] = {"$gt": after_user_id}
+        yielded = False
+        try:
+            async for uid in self._scan(query, batch_size, SEGMENT_INDEX_NAME):
+                yielded = True
+                yield uid
+        except OperationFailure as e:
+            # Индекс создаётся в фоне при старте и может ещё строиться или не создаться вовсе.
+            if yielded:
+                raise
+            logger.warning(f"Index {SEGMENT_INDEX_NAME} unavailable, scanning segment '{seg}' without hint: {e}")
+            async for uid in self._scan(query, batch_size, None):
+                yield uid
+
+    async def _scan(self, query: Dict, batch_size: int, hint: Optional[str]) -> AsyncIterator[int]:
+        cursor = self.collection.find(query, {"user_id": 1, "_id": 0}).sort("user_id", 1)
+        if hint is not None:
+            cursor = cursor.hint(hint)
+        async for d in cursor.batch_size(batch_size):
+            if isinstance(d.get("user_id"), int):
+                yield d["user_id"]
+
+    async def count(self, seg: str) -> int:
+        query = self.query(seg)
+        if query is None:
+            return 0
+
+        async def _count():
+            try:
+                return await self.collection.count_documents(query, hint=SEGMENT_INDEX_NAME)
+            except OperationFailure as e:
+                logger.warning(f"Index {SEGMENT_INDEX_NAME} unavailable, counting segment '{seg}' without hint: {e}")
+                return await self.collection.count_documents(query)
+
+        if self.cache is None:
+            return await _count()
+        return await self.cache.get_or_compute(f"segment_size:{seg}", _count, ttl=SEGMENT_SIZE_TTL_SEC)
+
+    async def counts(self) -> Dict[str, Optional[int]]:
+        async def _safe_count(seg: str) -> Optional[int]:
+            try:
+                return await self.count(seg)
+            except Exception as e:
+                logger.warning(f"Failed to count segment '{seg}': {e}")
+                return None
+
+        sizes = await asyncio.gather(*(_safe_count(seg) for seg in SEGMENTS))
+        return dict(zip(SEGMENTS, sizes))
+
+    async def record_progress_score(self, user_id: int) -> None:
+        try:
+            await self.collection.update_one(
+                {"type": "user_profile", "user_id": user_id},
+                {"$inc": {"progress_score_count": 1}}
+            )
+        except Exception as e:
+            logger.error(f"Error updating progress_score_count for {user_id}: {e}")
+
+    async def ensure_backfilled(self) -> None:
+        """Однократно проставляет progress_score_count профилям по истории оценок."""
+        try:
+            # Пропускаем только завершённый или свежий чужой запуск: упавший повторится после BACKFILL_STALE_MIN.
+            if await claim_backfill(self.collection, BACKFILL_MARKER_TYPE) is None:
+                return
+            await self._backfill()
+            await self.collection.update_one(
+                {"type": BACKFILL_MARKER_TYPE},
+                {"$set": {"finished_at": datetime.now(timezone.utc)}}
+            )
+        except Exception as e:
+            logger.error(f"Segment counters backfill failed: {e}")
+
+    async def _backfill(self) -> None:
+        cursor = self.collection.aggregate([
+            {"$match": {"type": "progress_score"}},
+            {"$group": {"_id": "$user_id", "n": {"$sum": 1}}},
+        ], allowDiskUse=True)
+        ops = []
+        updated = 0
+        async for row in cursor:
+            # $max: инкременты, пришедшие во время пересчёта, не затираются.
+            ops.append(UpdateOne(
+                {"type": "user_profile", "user_id": row["_id"]},
+                {"$max": {"progress_score_count": row["n"]}}
+            ))
+            if len(ops) >= 1000:
+                await self.collection.bulk_write(ops, ordered=False)
+                updated += len(ops)
+                ops = []
+        if ops:
+            await self.collection.bulk_write(ops, ordered=False)
+            updated += len(ops)
+        logger.info(f"Backfilled progress_score_count for {updated} profiles")
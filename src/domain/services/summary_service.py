@@ -0,0 +1,302 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from google.genai import types
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_SYSTEM_INSTRUCTION = (
+    "Ты — специалист по конспектированию. Твоя задача — извлечь ключевые темы, эмоции и проблемы, "
+    "обсужденные в предоставленном диалоге. Ответ должен быть кратким (не более 150 слов), "
+    "используй чистый текст без форматирования (без жирного, курсива, списков), так как он будет использован "
+    "для восстановления контекста в следующей сессии. "
+    "Если дан текущий конспект, обнови его с учётом новых реплик, а не пересказывай их отдельно."
+)
+SUMMARY_FAILED_TEXT = "Конспект не был сгенерирован из-за ошибки."
+
+# Через сколько минут «зависшее» завершение сессии может подхватить другой процесс.
+FINALIZE_CLAIM_TIMEOUT_MIN = 10
+MAX_PENDING_MESSAGES = 100_000
+
+
+class SessionSummarizer:
+    """Инкрементальный конспект сессии.
+
+    Реплики копятся в документе type=session_draft; каждые fold_every_turns ходов
+    они в фоне сворачиваются в running_summary. Завершение сессии только дописывает
+    остаток, а брошенные сессии закрывает периодический sweeper.
+    """
+
+    def __init__(self, users_collection, generate_content_func=None, gemini_client=None,
+                 openai_client=None, generate_openai_func=None, cache=None, *,
+                 fold_every_turns: int = 6, idle_timeout_min: int = 60, alert_func=None, bot=None,
+                 metrics=None):
+        self.collection = users_collection
+        self.generate_content_func = generate_content_func
+        self.gemini_client = gemini_client
+        self.openai_client = openai_client
+        self.generate_openai_func = generate_openai_func
+        self.cache = cache
+        self.fold_every_turns = max(1, fold_every_turns)
+        self.idle_timeout_min = idle_timeout_min
+        self.alert_func = alert_func
+        self.bot = bot
+        self.metrics = metrics
+        self._folding: set[int] = set()
+        self._background: set[asyncio.Task] = set()
+        self._sweeper_task: Optional[asyncio.Task] = None
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    @staticmethod
+    def _draft_filter(user_id: int) -> Dict:
+        return {"user_id": user_id, "type": "session_draft", "finalizing": {"$ne": True}}
+
+    async def record_turn(self, user_id: int, user_text: str, model_text: str) -> None:
+        now = datetime.now(timezone.utc)
+        try:
+            draft = await self.collection.find_one_and_update(
+                self._draft_filter(user_id),
+                {
+                    "$push": {"pending": {"$each": [
+                        {"role": "user", "content": user_text},
+                        {"role": "model", "content": model_text},
+                    ]}},
+                    "$inc": {"message_count": 1},
+                    "$set": {"last_active": now},
+                    "$setOnInsert": {"started_at": now, "running_summary": "", "folded_messages": 0},
+                },
+                upsert=True,
+                projection={"message_count": 1, "folded_messages": 1},
+                return_document=ReturnDocument.AFTER
+            )
+        except Exception as e:
+            logger.error(f"Error recording session turn for {user_id}: {e}")
+            return
+
+        unfolded = draft.get("message_count", 0) * 2 - draft.get("folded_messages", 0)
+        if unfolded >= self.fold_every_turns * 2 and user_id not in self._folding:
+            self._spawn(self._fold(user_id))
+
+    async def _fold(self, user_id: int) -> None:
+        self._folding.add(user_id)
+        try:
+            draft = await self.collection.find_one(self._draft_filter(user_id))
+            if not draft or not draft.get("pending"):
+                return
+            pending = draft["pending"]
+            summary = await self._summarize(user_id, draft.get("running_summary", ""), pending)
+            if summary is None:
+                return
+            # Срезаем ровно свёрнутые реплики: за время вызова LLM могли прийти новые.
+            await self.collection.update_one(
+                {"_id": draft["_id"], "type": "session_draft", "folded_messages": draft.get("folded_messages", 0)},
+                [{"$set": {
+                    "running_summary": summary,
+                    "folded_messages": {"$add": ["$folded_messages", len(pending)]},
+                    "pending": {"$slice": ["$pending", len(pending), MAX_PENDING_MESSAGES]},
+                }}]
+            )
+            logger.info(f"Folded {len(pending)} session messages into running summary for user {user_id}")
+        except Exception as e:
+            logger.error(f"Error folding session summary for {user_id}: {e}")
+        finally:
+            self._folding.discard(user_id)
+
+    async def close_session(self, user_id: int, session_started_at: Optional[datetime] = None) -> bool:
+        """Забирает черновик пользователя и дописывает конспект в фоне. False — конспекта сессии нет.
+
+        session_started_at — начало сессии из FSM: если sweeper уже закрыл эту сессию по простою,
+        продолжение дописывается в тот же session_summary, а не создаёт второй (он съел бы лишний
+        слот MAX_SESSIONS_PER_DAY).
+        """
+        draft = await self._claim({"user_id": user_id, "type": "session_draft"})
+        if draft is not None:
+            self._spawn(self._finalize(draft, continue_after=session_started_at))
+            return True
+        swept = await self._swept_summary(user_id, session_started_at)
+        if swept is None:
+            return False
+        # После простоя новых реплик не было: конспект уже сохранён, снимаем только отметку.
+        await self.collection.update_one({"_id": swept["_id"], "type": "session_summary"}, {"$unset": {"swept": ""}})
+        return True
+
+    async def _swept_summary(self, user_id: int, session_started_at: Optional[datetime]) -> Optional[Dict]:
+        if session_started_at is None:
+            return None
+        try:
+            return await self.collection.find_one(
+                {"user_id": user_id, "type": "session_summary", "swept": True,
+                 "started_at": {"$gte": session_started_at}},
+                sort=[("date", -1)]
+            )
+        except Exception as e:
+            logger.error(f"Error looking up swept session summary for {user_id}: {e}")
+            return None
+
+    async def running_summary(self, user_id: int, session_started_at: Optional[datetime] = None) -> str:
+        """Конспект уже свёрнутой части текущей сессии — для реплик, не вошедших в окно диалога.
+
+        Если сессию уже закрыл sweeper по простою, ранняя часть лежит в её session_summary.
+        """
+        try:
+            draft = await self.collection.find_one(
+                self._draft_filter(user_id), {"running_summary": 1, "_id": 0}
+            )
+            if draft and draft.get("running_summary"):
+                return draft["running_summary"]
+            swept = await self._swept_summary(user_id, session_started_at)
+            if swept and swept.get("summary") and swept["summary"] != SUMMARY_FAILED_TEXT:
+                return swept["summary"]
+        except Exception as e:
+            logger.error(f"Error loading running session summary for {user_id}: {e}")
+        return ""
+
+    async def discard_session(self, user_id: int) -> None:
+        try:
+            await self.collection.delete_many(self._draft_filter(user_id))
+        except Exception as e:
+            logger.error(f"Error discarding session draft for {user_id}: {e}")
+
+    async def _claim(self, query: Dict) -> Optional[Dict]:
+        now = datetime.now(timezone.utc)
+        stale_claim = now - timedelta(minutes=FINALIZE_CLAIM_TIMEOUT_MIN)
+        try:
+            return await self.collection.find_one_and_update(
+                {**query, "$or": [{"finalizing": {"$ne": True}}, {"finalizing_since": {"$lt": stale_claim}}]},
+                {"$set": {"finalizing": True, "finalizing_since": now}},
+                return_document=ReturnDocument.AFTER
+            )
+        except Exception as e:
+            logger.error(f"Error claiming session draft: {e}")
+            return None
+
+    async def _finalize(self, draft: Dict, *, swept: bool = False, continue_after: Optional[datetime] = None) -> None:
+        user_id = draft["user_id"]
+        summary = draft.get("running_summary") or ""
+        pending = draft.get("pending") or []
+        previous = await self._swept_summary(user_id, continue_after)
+        if previous is not None:
+            summary = "\n".join(s for s in (previous.get("summary"), summary) if s and s != SUMMARY_FAILED_TEXT)
+            summary = await self._summarize(user_id, summary, pending) or summary or SUMMARY_FAILED_TEXT
+        elif pending or not summary:
+            summary = await self._summarize(user_id, summary, pending) or summary or SUMMARY_FAILED_TEXT
+
+        now = datetime.now(timezone.utc)
+        try:
+            if previous is not None:
+                await self.collection.update_one(
+                    {"_id": previous["_id"], "type": "session_summary"},
+                    {
+                        "$set": {"summary": summary, "updated_at": now},
+                        "$inc": {"full_dialog_length": draft.get("message_count", 0)},
+                        "$unset": {"swept": ""},
+                    }
+                )
+            else:
+                record = {
+                    "user_id": user_id,
+                    "date": now,
+                    "summary": summary,
+                    "full_dialog_length": draft.get("message_count", 0),
+                    "started_at": draft.get("started_at"),
+                    "type": "session_summary"
+                }
+                if swept:
+                    # Пользователь может вернуться в ту же сессию — тогда конспект будет дописан.
+                    record["swept"] = True
+                await self.collection.insert_one(record)
+            await self.collection.delete_one({"_id": draft["_id"], "type": "session_draft"})
+        except Exception as e:
+            logger.error(f"MongoDB error during summary insertion: {e}")
+            return
+
+        if self.cache is not None:
+            await self.cache.delete(f"session_history:{user_id}")
+        if self.metrics is not None and previous is None:
+            await self.metrics.record_session(draft.get("message_count", 0))
+        logger.info(f"Session summary saved for user {user_id} ({draft.get('message_count', 0)} messages)")
+
+    async def _summarize(self, user_id: int, running_summary: str, turns: List[Dict]) -> Optional[str]:
+        dialog_text = "\n".join(f"{item['role']}: {item['content']}" for item in turns)
+        prompt = f"Вот диалог, который необходимо законспектировать:\n---\n{dialog_text}"
+        if running_summary:
+            prompt = f"Текущий конспект сессии:\n{running_summary}\n\n{prompt}"
+
+        if self.openai_client and self.generate_openai_func:
+            for model in ("gpt-4.1-mini", "gpt-5-mini"):
+                try:
+                    text = await self.generate_openai_func(self.openai_client, model, prompt, SUMMARY_SYSTEM_INSTRUCTION)
+                    if text and text.strip():
+                        return text
+                except Exception as e:
+                    logger.warning(f"OpenAI summary model '{model}' failed: {e}")
+            await self._alert(f"Сбой конспекта по OpenAI (4.1-mini/5-mini) для user {user_id}. Пробуем Gemini.",
+                              "summary_openai_failed")
+
+        if self.gemini_client and self.generate_content_func:
+            try:
+                response = await self.generate_content_func(
+                    self.gemini_client,
+                    'gemini-3-flash-preview',
+                    [types.Content(role="user", parts=[types.Part(text=prompt)])],
+                    SUMMARY_SYSTEM_INSTRUCTION
+                )
+                if response and response.text and response.text.strip():
+                    return response.text
+            except Exception as e:
+                logger.error(f"Gemini error during session summary: {e}")
+
+        await self._alert(f"Не удалось сгенерировать конспект ни OpenAI, ни Gemini для user {user_id}.",
+                          "summary_all_failed")
+        return None
+
+    async def _alert(self, text: str, key: str) -> None:
+        if self.alert_func and self.bot:
+            try:
+                await self.alert_func(self.bot, text, key=key)
+            except Exception:
+                pass
+
+    async def sweep_idle_sessions(self) -> int:
+        cutoff = datetime.now(timezone.utc) - timedelta(minutes=self.idle_timeout_min)
+        finalized = 0
+        while True:
+            draft = await self._claim({"type": "session_draft", "last_active": {"$lt": cutoff}})
+            if draft is None:
+                break
+            await self._finalize(draft, swept=True)
+            finalized += 1
+        if finalized:
+            logger.info(f"Finalized {finalized} idle sessions")
+        return finalized
+
+    def start_sweeper(self, interval: int = 300) -> None:
+        if self._sweeper_task and not self._sweeper_task.done():
+            return
+
+        async def sweeper():
+            while True:
+                try:
+                    await asyncio.sleep(interval)
+                    await self.sweep_idle_sessions()
+                except asyncio.CancelledError:
+                    break
+                except Exception as e:
+                    logger.error(f"Error in idle session sweeper: {e}")
+
+        self._sweeper_task = asyncio.create_task(sweeper())
+
+    async def close(self, timeout: float = 15.0) -> None:
+        if self._sweeper_task and not self._sweeper_task.done():
+            self._sweeper_task.cancel()
+        if self._background:
+            # Даём дописаться конспектам завершённых сессий; зависшие подхватит sweeper после рестарта.
+            await asyncio.wait(list(self._background), timeout=timeout)
@@ -7,27 +7,23 @@ logger = logging.getLogger(__name__)
 
 class UserService:
     
-    def __init__(self, users_collection, cache=None):
+    def __init__(self, users_collection, cache=None, metrics=None):
         self.collection = users_collection
         self.cache = cache
+        self.metrics = metrics
     
     async def get_user_profile(self, user_id: int) -> Optional[Dict]:
         cache_key = f"user_profile:{user_id}"
-        
-        if self.cache:
-            cached = await self.cache.get(cache_key)
-            if cached:
-                return cached
-        
-        try:
-            profile = await self.collection.find_one(
+
+        async def _load():
+            return await self.collection.find_one(
                 {"user_id": user_id, "type": "user_profile"}
             )
-            
-            if self.cache and profile:
-                await self.cache.set(cache_key, profile, ttl=300)
-            
-            return profile
+
+        try:
+            if self.cache:
+                return await self.cache.get_or_compute(cache_key, _load, ttl=300)
+            return await _load()
         except Exception as e:
             logger.error(f"Error loading user profile: {e}")
             return None
@@ -49,13 +45,15 @@ class UserService:
     async def save_user_profile_async(self, user_id: int, username: Optional[str], 
                                      first_name: Optional[str]):
         try:
-            await self.collection.update_one(
+            result = await self.collection.update_one(
                 {"user_id": user_id, "type": "user_profile"},
                 {
                     "$set": {
                         "username": username,
                         "first_name": first_name,
-                        "last_active": datetime.now(timezone.utc)
+                        "last_active": datetime.now(timezone.utc),
+                        # /start после блокировки значит, что бот снова доступен для рассылок.
+                        "blacklisted": False
                     },
                     "$setOnInsert": {
                         "created_at": datetime.now(timezone.utc)
@@ -66,6 +64,8 @@ class UserService:
             
             if self.cache:
                 await self.cache.delete(f"user_profile:{user_id}")
+            if self.metrics:
+                await self.metrics.record_active(user_id, new_user=result.upserted_id is not None)
         except Exception as e:
             logger.error(f"Error saving user profile: {e}")
 
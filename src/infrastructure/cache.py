@@ -1,72 +1,282 @@
+
 import asyncio
+import heapq
+import sys
 import time
-from typing import Optional, Dict, Any
+from collections import OrderedDict, defaultdict
+from typing import Optional, Dict, Any, Callable, Awaitable
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-class SimpleCache:
-    
+def _approx_size(value: Any, _depth: int = 0) -> int:
+    size = sys.getsizeof(value)
+    if _depth >= 4:
+        return size
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += _approx_size(k, _depth + 1) + _approx_size(v, _depth + 1)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            size += _approx_size(item, _depth + 1)
+    return size
+
+
+def _key_prefix(key: str) -> str:
+    return key.split(":", 1)[0] if ":" in key else key
+
+
+def _new_prefix_stats() -> Dict[str, int]:
+    return {"hits": 0, "misses": 0, "sets": 0, "evictions": 0, "expirations": 0,
+            "coalesced": 0, "stale_served": 0}
+
+
+class BaseCache:
+
     def __init__(self):
-        self._cache: Dict[str, tuple[Any, float]] = {}
+        self._stats: Dict[str, Dict[str, int]] = defaultdict(_new_prefix_stats)
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._invalidated: set[str] = set()
+        self._background: set[asyncio.Task] = set()
+
+    async def get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: Any, ttl: int = 300, stale_ttl: int = 0):
+        raise NotImplementedError
+
+    async def delete(self, key: str):
+        raise NotImplementedError
+
+    async def _lookup(self, key: str) -> Optional[tuple[Any, bool]]:
+        raise NotImplementedError
+
+    async def close(self):
+        for task in list(self._background):
+            task.cancel()
+
+    def _mark_invalidated(self, key: str) -> None:
+        if key in self._inflight:
+            self._invalidated.add(key)
+
+    async def get_or_compute(self, key: str, loader: Callable[[], Awaitable[Any]], ttl: int = 300,
+                             stale_ttl: int = 0, cache_none: bool = False) -> Any:
+        stats = self._stats[_key_prefix(key)]
+        found = await self._lookup(key)
+
+        if found is not None:
+            value, is_stale = found
+            stats["hits"] += 1
+            if is_stale and key not in self._inflight:
+                stats["stale_served"] += 1
+                task = asyncio.create_task(self._revalidate(key, loader, ttl, stale_ttl, cache_none))
+                self._background.add(task)
+                task.add_done_callback(self._background.discard)
+            return value
+
+        stats["misses"] += 1
+        return await self._load_once(key, loader, ttl, stale_ttl, cache_none)
+
+    async def _load_once(self, key: str, loader: Callable[[], Awaitable[Any]], ttl: int,
+                         stale_ttl: int, cache_none: bool) -> Any:
+        task = self._inflight.get(key)
+        if task is not None:
+            self._stats[_key_prefix(key)]["coalesced"] += 1
+        else:
+            task = asyncio.create_task(self._run_loader(key, loader, ttl, stale_ttl, cache_none))
+            self._inflight[key] = task
+            self._background.add(task)
+            task.add_done_callback(self._load_done)
+        # Загрузка идёт в своей задаче: отмена одного ожидающего (таймаут, прерванный хендлер)
+        # не отменяет её для остальных, результат всё равно попадёт в кэш.
+        return await asyncio.shield(task)
+
+    async def _run_loader(self, key: str, loader: Callable[[], Awaitable[Any]], ttl: int,
+                          stale_ttl: int, cache_none: bool) -> Any:
+        try:
+            value = await loader()
+            if key in self._invalidated:
+                self._invalidated.discard(key)
+            elif value is not None or cache_none:
+                await self.set(key, value, ttl=ttl, stale_ttl=stale_ttl)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+            self._invalidated.discard(key)
+
+    def _load_done(self, task: asyncio.Task) -> None:
+        self._background.discard(task)
+        if not task.cancelled():
+            # Помечаем исключение как полученное, даже если все ждущие ушли.
+            task.exception()
+
+    async def _revalidate(self, key: str, loader: Callable[[], Awaitable[Any]], ttl: int,
+                          stale_ttl: int, cache_none: bool) -> None:
+        try:
+            await self._load_once(key, loader, ttl, stale_ttl, cache_none)
+        except Exception as e:
+            logger.warning(f"Background cache refresh failed for {key}: {e}")
+
+    def _prefix_stats(self) -> Dict[str, Any]:
+        hits = sum(s["hits"] for s in self._stats.values())
+        misses = sum(s["misses"] for s in self._stats.values())
+        by_prefix = {}
+        for prefix, s in self._stats.items():
+            lookups = s["hits"] + s["misses"]
+            by_prefix[prefix] = {**s, "hit_rate": (s["hits"] / lookups) if lookups else 0.0}
+        return {
+            "hit_rate": (hits / (hits + misses)) if (hits + misses) else 0.0,
+            "evictions": sum(s["evictions"] for s in self._stats.values()),
+            "inflight_loads": len(self._inflight),
+            "by_prefix": by_prefix,
+        }
+
+
+class SimpleCache(BaseCache):
+
+    def __init__(self, max_entries: int = 10_000, max_bytes: int = 64 * 1024 * 1024):
+        super().__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._cache: "OrderedDict[str, tuple[Any, float, int]]" = OrderedDict()
+        self._expiry_heap: list[tuple[float, str]] = []
+        self._total_bytes = 0
+        self._fresh_until: Dict[str, float] = {}
         self._cleanup_task: Optional[asyncio.Task] = None
-    
+
     async def get(self, key: str) -> Optional[Any]:
-        if key not in self._cache:
+        stats = self._stats[_key_prefix(key)]
+        entry = self._cache.get(key)
+        if entry is None:
+            stats["misses"] += 1
             return None
-        
-        value, expiry = self._cache[key]
-        
+
+        value, expiry, _ = entry
+
         if time.time() > expiry:
-            del self._cache[key]
+            self._remove(key)
+            stats["expirations"] += 1
+            stats["misses"] += 1
+            return None
+
+        # Устаревшую запись (stale_ttl) отдаёт только get_or_compute, запуская фоновое обновление;
+        # прямой get без загрузчика видит её как промах.
+        fresh_until = self._fresh_until.get(key)
+        if fresh_until is not None and time.time() > fresh_until:
+            stats["misses"] += 1
             return None
-        
+
+        self._cache.move_to_end(key)
+        stats["hits"] += 1
         return value
-    
-    async def set(self, key: str, value: Any, ttl: int = 300):
-        expiry = time.time() + ttl
-        self._cache[key] = (value, expiry)
-    
+
+    async def set(self, key: str, value: Any, ttl: int = 300, stale_ttl: int = 0):
+        now = time.time()
+        expiry = now + ttl + max(0, stale_ttl)
+        size = _approx_size(value)
+        if size > self.max_bytes:
+            logger.debug(f"Cache value for {key} is too large to cache ({size} bytes)")
+            self._remove(key)
+            return
+
+        self._remove(key)
+        self._cache[key] = (value, expiry, size)
+        self._total_bytes += size
+        if stale_ttl > 0:
+            self._fresh_until[key] = now + ttl
+        heapq.heappush(self._expiry_heap, (expiry, key))
+        self._stats[_key_prefix(key)]["sets"] += 1
+        self._evict_if_needed()
+        self._compact_heap_if_needed()
+
     async def delete(self, key: str):
-        if key in self._cache:
-            del self._cache[key]
-    
+        self._remove(key)
+        self._mark_invalidated(key)
+
     async def clear(self):
         self._cache.clear()
-    
+        self._fresh_until.clear()
+        self._expiry_heap.clear()
+        self._total_bytes = 0
+
+    async def _lookup(self, key: str) -> Optional[tuple[Any, bool]]:
+        entry = self._cache.get(key)
+        now = time.time()
+        if entry is None or now > entry[1]:
+            return None
+        self._cache.move_to_end(key)
+        fresh_until = self._fresh_until.get(key)
+        return entry[0], fresh_until is not None and now > fresh_until
+
+    async def close(self):
+        await super().close()
+        if self._cleanup_task and not self._cleanup_task.done():
+            self._cleanup_task.cancel()
+        await self.clear()
+
+    def _remove(self, key: str) -> None:
+        entry = self._cache.pop(key, None)
+        self._fresh_until.pop(key, None)
+        if entry is not None:
+            self._total_bytes -= entry[2]
+
+    def _evict_if_needed(self) -> None:
+        while self._cache and (len(self._cache) > self.max_entries or self._total_bytes > self.max_bytes):
+            key, (_, _, size) = self._cache.popitem(last=False)
+            self._fresh_until.pop(key, None)
+            self._total_bytes -= size
+            self._stats[_key_prefix(key)]["evictions"] += 1
+
+    def _compact_heap_if_needed(self) -> None:
+        if len(self._expiry_heap) <= 2 * len(self._cache) + 64:
+            return
+        self._expiry_heap = [(entry[1], key) for key, entry in self._cache.items()]
+        heapq.heapify(self._expiry_heap)
+
+    def _purge_expired(self) -> int:
+        now = time.time()
+        purged = 0
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            expiry, key = heapq.heappop(self._expiry_heap)
+            entry = self._cache.get(key)
+            if entry is None or entry[1] != expiry:
+                continue
+            self._remove(key)
+            self._stats[_key_prefix(key)]["expirations"] += 1
+            purged += 1
+        return purged
+
     async def start_cleanup_task(self, interval: int = 60):
         if self._cleanup_task and not self._cleanup_task.done():
             return
-        
+
         async def cleanup():
             while True:
                 try:
                     await asyncio.sleep(interval)
-                    current_time = time.time()
-                    expired_keys = [
-                        key for key, (_, expiry) in self._cache.items()
-                        if current_time > expiry
-                    ]
-                    for key in expired_keys:
-                        del self._cache[key]
-                    if expired_keys:
-                        logger.debug(f"Cleaned up {len(expired_keys)} expired cache entries")
+                    purged = self._purge_expired()
+                    if purged:
+                        logger.debug(f"Cleaned up {purged} expired cache entries")
                 except asyncio.CancelledError:
                     break
                 except Exception as e:
                     logger.error(f"Error in cache cleanup: {e}")
-        
+
         self._cleanup_task = asyncio.create_task(cleanup())
-    
+
     def get_stats(self) -> Dict[str, Any]:
         current_time = time.time()
-        valid_entries = sum(1 for _, expiry in self._cache.values() if current_time <= expiry)
+        valid_entries = sum(1 for _, expiry, _ in self._cache.values() if current_time <= expiry)
         expired_entries = len(self._cache) - valid_entries
-        
+
         return {
+            "backend": "memory",
             "total_entries": len(self._cache),
             "valid_entries": valid_entries,
             "expired_entries": expired_entries,
-            "hit_rate": 0.0
+            "approx_bytes": self._total_bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            **self._prefix_stats(),
         }
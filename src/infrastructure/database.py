@@ -1,12 +1,53 @@
 import motor.motor_asyncio
-from typing import Optional
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
 import logging
 import asyncio
+from pymongo import ReturnDocument
 from .retry import retry_async
 
 logger = logging.getLogger(__name__)
 
 
+# Через сколько минут незавершённый бэкфилл считается брошенным и может быть запущен заново.
+BACKFILL_STALE_MIN = 30
+
+USERS_DATA_INDEXES: List[Tuple[List[Tuple[str, int]], Dict[str, Any]]] = [
+    ([("user_id", 1), ("type", 1), ("timestamp", -1)], {}),
+    ([("type", 1), ("timestamp", -1)], {}),
+    ([("user_id", 1), ("timestamp", -1)], {}),
+    ([("type", 1), ("last_active", -1)], {}),
+    ([("type", 1), ("created_at", -1)], {}),
+    ([("type", 1), ("last_portrait_timestamp", -1)], {}),
+    ([("user_id", 1), ("type", 1), ("generated_at", -1)], {}),
+
+    ([("user_id", 1), ("type", 1), ("date", -1)], {}),
+    ([("type", 1), ("date", -1)], {}),
+
+    ([("user_id", 1), ("type", 1), ("finished_at", -1)], {}),
+    ([("user_id", 1), ("type", 1), ("test_id", 1)], {}),
+
+    # Покрывающий индекс сегментов рассылки (см. segment_service.SEGMENTS).
+    ([("type", 1), ("user_id", 1), ("blacklisted", 1), ("last_active", 1),
+      ("last_portrait_timestamp", 1), ("progress_score_count", 1)], {"name": "mailing_segments"}),
+
+    ([("user_id", 1), ("type", 1)], {"unique": True, "partialFilterExpression": {"type": "user_context"},
+                                      "name": "user_context_unique"}),
+
+    # Архив реплик (archive_service): один бакет на (пользователь, месяц, seq).
+    ([("user_id", 1), ("type", 1), ("month", 1), ("seq", 1)],
+     {"unique": True, "partialFilterExpression": {"type": "message_bucket"}, "name": "message_buckets"}),
+
+    # Очередь портретов (portrait_queue_service): одно активное задание на пользователя
+    # и одна отметка ночного запуска на дату.
+    ([("type", 1), ("user_id", 1)],
+     {"unique": True, "partialFilterExpression": {"type": "portrait_job", "active": True},
+      "name": "portrait_job_active"}),
+    ([("type", 1), ("date", 1)],
+     {"unique": True, "partialFilterExpression": {"type": "portrait_nightly_run"}, "name": "portrait_nightly_runs"}),
+]
+
+
 class Database:
     
     def __init__(self, mongodb_uri: str, db_name: str):
@@ -56,25 +97,18 @@ class Database:
     
     async def ensure_indexes(self, collection_name: str):
         collection = self.get_collection(collection_name)
-        try:
-            await collection.create_index([("user_id", 1), ("type", 1), ("timestamp", -1)])
-            await collection.create_index([("type", 1), ("timestamp", -1)])
-            await collection.create_index([("user_id", 1), ("timestamp", -1)])
-            await collection.create_index([("type", 1), ("user_id", 1)])
-            await collection.create_index([("type", 1), ("last_active", -1)])
-            await collection.create_index([("type", 1), ("created_at", -1)])
-            await collection.create_index([("type", 1), ("last_portrait_timestamp", -1)])
-            await collection.create_index([("user_id", 1), ("type", 1), ("generated_at", -1)])
-            
-            await collection.create_index([("user_id", 1), ("type", 1), ("date", -1)])
-            await collection.create_index([("type", 1), ("date", -1)])
-            
-            await collection.create_index([("user_id", 1), ("type", 1), ("finished_at", -1)])
-            await collection.create_index([("user_id", 1), ("type", 1), ("test_id", 1)])
-            
+        # Каждый индекс в своём try: ошибка одного (например, конфликт опций) не оставляет без остальных.
+        failed = 0
+        for keys, options in USERS_DATA_INDEXES:
+            try:
+                await collection.create_index(keys, **options)
+            except Exception as e:
+                failed += 1
+                logger.error(f"Error creating index {options.get('name', keys)} on {collection_name}: {e}")
+        if failed:
+            logger.warning(f"{failed} of {len(USERS_DATA_INDEXES)} indexes were not created for {collection_name}")
+        else:
             logger.info(f"Optimized indexes created for {collection_name}")
-        except Exception as e:
-            logger.error(f"Error creating indexes: {e}")
     
     async def find_one_with_retry(self, collection_name: str, filter_dict: dict, **kwargs):
         collection = self.get_collection(collection_name)
@@ -108,3 +142,30 @@ class Database:
             exceptions=(Exception,),
             **kwargs
         )
+
+
+async def claim_backfill(collection, marker_type: str, on_insert: Optional[Dict[str, Any]] = None,
+                         stale_after_min: int = BACKFILL_STALE_MIN) -> Optional[Dict[str, Any]]:
+    """Захватывает однократный бэкфилл по документу-маркеру type=marker_type.
+
+    Возвращает маркер, если бэкфилл должен выполнить этот процесс: маркера ещё не было или прошлый
+    запуск так и не поставил finished_at и не продлевал started_at дольше stale_after_min минут.
+    Иначе None. По окончании вызывающий сам ставит маркеру finished_at.
+    """
+    now = datetime.now(timezone.utc)
+    before = await collection.find_one_and_update(
+        {"type": marker_type},
+        {"$setOnInsert": {"started_at": now, "attempts": 1, **(on_insert or {})}},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
+    if before is None:
+        return await collection.find_one({"type": marker_type})
+    if before.get("finished_at"):
+        return None
+    return await collection.find_one_and_update(
+        {"_id": before["_id"], "type": marker_type, "finished_at": {"$exists": False},
+         "started_at": {"$lt": now - timedelta(minutes=stale_after_min)}},
+        {"$set": {"started_at": now}, "$inc": {"attempts": 1}},
+        return_document=ReturnDocument.AFTER
+    )
@@ -0,0 +1,25 @@
+from typing import Any, Dict
+
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.redis import RedisStorage
+
+from .serialization import pack_state, unpack_state
+
+
+class BinaryRedisStorage(RedisStorage):
+    """RedisStorage с бинарными данными FSM (msgpack/zstd из serialization.pack_state).
+
+    Штатный get_data декодирует значение как UTF-8 перед json_loads, поэтому
+    чтение переопределено: байты передаются в unpack_state как есть.
+    """
+
+    def __init__(self, redis, **kwargs):
+        super().__init__(redis, json_dumps=pack_state, json_loads=unpack_state, **kwargs)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        value = await self.redis.get(self.key_builder.build(key, "data"))
+        if value is None:
+            return {}
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        return unpack_state(value)
@@ -8,10 +8,11 @@ logger = logging.getLogger(__name__)
 
 class HealthChecker:
     
-    def __init__(self, database=None, gemini_circuit=None, openai_circuit=None):
+    def __init__(self, database=None, gemini_circuit=None, openai_circuit=None, cache=None):
         self.database = database
         self.gemini_circuit = gemini_circuit
         self.openai_circuit = openai_circuit
+        self.cache = cache
     
     async def check_database(self) -> Dict[str, Any]:
         if self.database is None:
@@ -56,6 +57,17 @@ class HealthChecker:
                 "timestamp": datetime.now(timezone.utc).isoformat()
             }
     
+    def check_cache(self) -> Dict[str, Any]:
+        if self.cache is None:
+            return {"status": "unknown", "error": "Cache not initialized"}
+
+        try:
+            stats = self.cache.get_stats()
+            return {"status": "healthy", **stats}
+        except Exception as e:
+            logger.error(f"Cache health check failed: {e}")
+            return {"status": "unknown", "error": str(e)}
+
     async def get_health_status(self) -> Dict[str, Any]:
         db_status = await self.check_database()
         gemini_status = self.check_circuit_breaker(self.gemini_circuit, "Gemini")
@@ -72,7 +84,8 @@ class HealthChecker:
             "services": {
                 "database": db_status,
                 "gemini_api": gemini_status,
-                "openai_api": openai_status
+                "openai_api": openai_status,
+                "cache": self.check_cache()
             },
             "timestamp": datetime.now(timezone.utc).isoformat()
         }
@@ -0,0 +1,84 @@
+import time
+from typing import Optional, Dict, Any
+import logging
+
+from .cache import BaseCache, _key_prefix
+from .serialization import pack_value, unpack_value
+
+logger = logging.getLogger(__name__)
+
+
+class RedisCache(BaseCache):
+
+    def __init__(self, redis, namespace: str = "itb:cache:"):
+        super().__init__()
+        self.redis = redis
+        self.namespace = namespace
+
+    def _redis_key(self, key: str) -> str:
+        return f"{self.namespace}{key}"
+
+    async def _read(self, key: str) -> Optional[tuple[Any, Optional[float]]]:
+        raw = await self.redis.get(self._redis_key(key))
+        if raw is None:
+            return None
+        try:
+            value, fresh_until = unpack_value(raw)
+            return value, fresh_until
+        except Exception as e:
+            logger.warning(f"Corrupted cache entry {key}, dropping: {e}")
+            await self.redis.delete(self._redis_key(key))
+            return None
+
+    async def get(self, key: str) -> Optional[Any]:
+        stats = self._stats[_key_prefix(key)]
+        entry = await self._read(key)
+        # Как и в SimpleCache, устаревшую запись отдаёт только get_or_compute.
+        if entry is None or (entry[1] is not None and time.time() > entry[1]):
+            stats["misses"] += 1
+            return None
+        stats["hits"] += 1
+        return entry[0]
+
+    async def set(self, key: str, value: Any, ttl: int = 300, stale_ttl: int = 0):
+        now = time.time()
+        fresh_until = now + ttl if stale_ttl > 0 else None
+        total_ttl = max(1, int(ttl + max(0, stale_ttl)))
+        # Не pickle: Redis общий, и запись в него не должна превращаться в исполнение кода при чтении.
+        payload = pack_value([value, fresh_until])
+        await self.redis.set(self._redis_key(key), payload, ex=total_ttl)
+        self._stats[_key_prefix(key)]["sets"] += 1
+
+    async def delete(self, key: str):
+        await self.redis.delete(self._redis_key(key))
+        self._mark_invalidated(key)
+
+    async def clear(self):
+        keys = [k async for k in self.redis.scan_iter(match=f"{self.namespace}*", count=500)]
+        for i in range(0, len(keys), 500):
+            await self.redis.delete(*keys[i:i + 500])
+
+    async def _lookup(self, key: str) -> Optional[tuple[Any, bool]]:
+        entry = await self._read(key)
+        if entry is None:
+            return None
+        value, fresh_until = entry
+        return value, fresh_until is not None and time.time() > fresh_until
+
+    async def start_cleanup_task(self, interval: int = 60):
+        # Истечение записей выполняет сам Redis (EX у каждого ключа).
+        return
+
+    async def close(self):
+        await super().close()
+        try:
+            await self.redis.aclose()
+        except Exception as e:
+            logger.warning(f"Error closing Redis cache connection: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "redis",
+            "total_entries": None,
+            **self._prefix_stats(),
+        }
@@ -0,0 +1,109 @@
+import json
+from datetime import datetime
+from typing import Any, Dict
+
+from bson import ObjectId
+
+from src.utils.dialog import Dialog
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {"$dt": value.isoformat()}
+    if isinstance(value, Dialog):
+        return {"$dialog": value.to_wire()}
+    if isinstance(value, ObjectId):
+        return {"$oid": str(value)}
+    if isinstance(value, dict):
+        return {k: _encode(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(x) for x in value]
+    return value
+
+
+def _decode_hook(obj: Dict[str, Any]) -> Any:
+    if len(obj) == 1:
+        if "$dt" in obj:
+            return datetime.fromisoformat(obj["$dt"])
+        if "$dialog" in obj:
+            return Dialog.from_wire(obj["$dialog"])
+        if "$oid" in obj:
+            return ObjectId(obj["$oid"])
+    return obj
+
+
+# Бинарный формат для RedisStorage и RedisCache: байт формата + msgpack, при большом размере сжатый zstd.
+# Без msgpack пишется прежний JSON; читаются оба формата, поэтому переключение не теряет сессии.
+_FORMAT_MSGPACK = b"\x01"
+_FORMAT_MSGPACK_ZSTD = b"\x02"
+_EXT_DATETIME = 1
+_EXT_DIALOG = 2
+_EXT_OBJECT_ID = 3
+ZSTD_MIN_SIZE = 1024
+
+_zstd_compressor = zstandard.ZstdCompressor(level=3) if zstandard is not None else None
+_zstd_decompressor = zstandard.ZstdDecompressor() if zstandard is not None else None
+
+
+def _msgpack_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return msgpack.ExtType(_EXT_DATETIME, value.isoformat().encode("utf-8"))
+    if isinstance(value, Dialog):
+        return msgpack.ExtType(_EXT_DIALOG, msgpack.packb(value.to_wire(), use_bin_type=True))
+    if isinstance(value, ObjectId):
+        return msgpack.ExtType(_EXT_OBJECT_ID, value.binary)
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def _msgpack_ext_hook(code: int, data: bytes) -> Any:
+    if code == _EXT_DATETIME:
+        return datetime.fromisoformat(data.decode("utf-8"))
+    if code == _EXT_DIALOG:
+        return Dialog.from_wire(msgpack.unpackb(data, raw=False))
+    if code == _EXT_OBJECT_ID:
+        return ObjectId(data)
+    return msgpack.ExtType(code, data)
+
+
+def pack_state(data: Dict[str, Any]) -> bytes:
+    return pack_value(data)
+
+
+def unpack_state(raw: bytes) -> Dict[str, Any]:
+    return unpack_value(raw)
+
+
+def pack_value(value: Any) -> bytes:
+    """Кодирует произвольное значение (dict/list/скаляры, datetime, Dialog, ObjectId) без pickle:
+    из общего Redis читаются только данные, а не исполняемые объекты."""
+    if msgpack is None:
+        return json.dumps(_encode(value), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    raw = msgpack.packb(value, default=_msgpack_default, use_bin_type=True)
+    if _zstd_compressor is not None and len(raw) >= ZSTD_MIN_SIZE:
+        return _FORMAT_MSGPACK_ZSTD + _zstd_compressor.compress(raw)
+    return _FORMAT_MSGPACK + raw
+
+
+def unpack_value(raw: bytes) -> Any:
+    fmt = raw[:1]
+    if fmt == _FORMAT_MSGPACK_ZSTD:
+        if _zstd_decompressor is None:
+            raise RuntimeError("Payload is zstd-compressed, but zstandard is not installed")
+        payload = _zstd_decompressor.decompress(raw[1:])
+    elif fmt == _FORMAT_MSGPACK:
+        payload = raw[1:]
+    else:
+        return json.loads(raw.decode("utf-8"), object_hook=_decode_hook)
+    if msgpack is None:
+        raise RuntimeError("Payload is msgpack-encoded, but msgpack is not installed")
+    return msgpack.unpackb(payload, ext_hook=_msgpack_ext_hook, raw=False, strict_map_key=False)
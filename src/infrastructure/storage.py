@@ -0,0 +1,338 @@
+import logging
+from typing import Any, Dict, Iterable, List, Tuple
+
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+LAYOUT_SINGLE = "single"
+LAYOUT_DUAL = "dual"
+LAYOUT_SPLIT = "split"
+LAYOUTS = (LAYOUT_SINGLE, LAYOUT_DUAL, LAYOUT_SPLIT)
+
+# Отдельная коллекция на каждый тип документа. Типы, которых здесь нет, остаются в общей коллекции.
+TYPE_COLLECTIONS: Dict[str, str] = {
+    "user_profile": "user_profiles",
+    "user_message": "user_messages",
+    "model_response": "model_responses",
+    "session_draft": "session_drafts",
+    "session_summary": "session_summaries",
+    "portrait": "portraits",
+    "progress_score": "progress_scores",
+    "test_result": "test_results",
+    "user_context": "user_contexts",
+    "metrics_daily": "metrics",
+    "metrics_totals": "metrics",
+    "segment_backfill": "metrics",
+    "metrics_backfill": "metrics",
+    "mailing_job": "mailing_jobs",
+    "mailing_log": "mailing_jobs",
+    "blacklisted": "user_profiles",
+    "message_bucket": "message_archive",
+    "portrait_job": "portrait_jobs",
+    "portrait_nightly_run": "portrait_jobs",
+}
+
+# Поле type в документах сохраняется, поэтому индексы по-прежнему начинаются с него или с user_id —
+# запросы сервисов не меняются, а покрывающие индексы остаются покрывающими.
+COLLECTION_INDEXES: Dict[str, List[Tuple[List[Tuple[str, int]], Dict[str, Any]]]] = {
+    "user_profiles": [
+        ([("type", 1), ("last_active", -1)], {}),
+        ([("type", 1), ("created_at", -1)], {}),
+        ([("type", 1), ("user_id", 1), ("blacklisted", 1), ("last_active", 1),
+          ("last_portrait_timestamp", 1), ("progress_score_count", 1)], {"name": "mailing_segments"}),
+    ],
+    "user_messages": [
+        ([("user_id", 1), ("type", 1), ("timestamp", -1)], {}),
+        ([("type", 1), ("timestamp", -1)], {}),
+    ],
+    "model_responses": [
+        ([("user_id", 1), ("type", 1), ("timestamp", -1)], {}),
+        ([("type", 1), ("timestamp", -1)], {}),
+    ],
+    "session_drafts": [
+        ([("user_id", 1), ("type", 1)], {}),
+        ([("type", 1), ("last_active", 1)], {}),
+    ],
+    "session_summaries": [
+        ([("user_id", 1), ("type", 1), ("date", -1)], {}),
+        ([("type", 1), ("date", -1)], {}),
+    ],
+    "portraits": [
+        ([("user_id", 1), ("type", 1), ("generated_at", -1)], {}),
+        ([("type", 1), ("generated_at", -1)], {}),
+    ],
+    "progress_scores": [
+        ([("user_id", 1), ("type", 1), ("timestamp", -1)], {}),
+        ([("type", 1), ("timestamp", -1)], {}),
+    ],
+    "test_results": [
+        ([("user_id", 1), ("type", 1), ("finished_at", -1)], {}),
+        ([("user_id", 1), ("type", 1), ("test_id", 1)], {}),
+    ],
+    "user_contexts": [
+        ([("user_id", 1), ("type", 1)], {"unique": True, "partialFilterExpression": {"type": "user_context"},
+                                          "name": "user_context_unique"}),
+    ],
+    "metrics": [
+        ([("type", 1), ("date", -1)], {}),
+    ],
+    "mailing_jobs": [
+        ([("type", 1), ("status", 1)], {}),
+    ],
+    "message_archive": [
+        ([("user_id", 1), ("type", 1), ("month", 1), ("seq", 1)], {"unique": True, "name": "message_buckets"}),
+    ],
+    "portrait_jobs": [
+        ([("type", 1), ("user_id", 1)], {"unique": True, "name": "portrait_job_active",
+                                          "partialFilterExpression": {"type": "portrait_job", "active": True}}),
+        ([("type", 1), ("date", 1)], {"unique": True, "name": "portrait_nightly_runs",
+                                       "partialFilterExpression": {"type": "portrait_nightly_run"}}),
+    ],
+}
+
+
+class StorageRoutingError(ValueError):
+    pass
+
+
+def _literal_type(query: Any) -> str:
+    doc_type = query.get("type") if isinstance(query, dict) else None
+    if not isinstance(doc_type, str):
+        raise StorageRoutingError(f"Cannot route Mongo operation without a literal 'type': {query!r}")
+    return doc_type
+
+
+def _pipeline_type(pipeline: List[Dict]) -> str:
+    first = pipeline[0] if pipeline else {}
+    return _literal_type(first.get("$match"))
+
+
+def _request_type(request: Any) -> str:
+    # У операций pymongo (InsertOne/UpdateOne/ReplaceOne/DeleteOne) нет публичного доступа к фильтру.
+    query = getattr(request, "_filter", None)
+    if query is None:
+        query = getattr(request, "_doc", None)
+    return _literal_type(query)
+
+
+def _seeded_update(update: Any, query: Dict, _id: Any) -> Any:
+    """Апдейт для upsert в теневой коллекции: тот же _id и поля-равенства из фильтра."""
+    if not isinstance(update, dict):
+        return update
+    used = {field for op in update.values() if isinstance(op, dict) for field in op}
+    seed = {k: v for k, v in query.items()
+            if not k.startswith("$") and not isinstance(v, dict) and k not in used}
+    seed["_id"] = _id
+    return {**update, "$setOnInsert": {**update.get("$setOnInsert", {}), **seed}}
+
+
+class Storage:
+    """Хранилище документов по типам.
+
+    Раскладки:
+      single — всё в общей коллекции USERS_COLLECTION (как раньше);
+      dual   — чтение из общей коллекции, запись в обе (на время миграции);
+      split  — каждый тип в своей коллекции (TYPE_COLLECTIONS).
+    """
+
+    def __init__(self, db, legacy_collection_name: str, layout: str = LAYOUT_SINGLE):
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown storage layout '{layout}', expected one of {LAYOUTS}")
+        self.db = db
+        self.layout = layout
+        self.legacy = db[legacy_collection_name]
+
+    def typed_collection(self, doc_type: str):
+        name = TYPE_COLLECTIONS.get(doc_type)
+        return self.db[name] if name else self.legacy
+
+    def collection(self, doc_type: str):
+        """Коллекция, из которой сейчас читаются документы данного типа."""
+        return self.typed_collection(doc_type) if self.layout == LAYOUT_SPLIT else self.legacy
+
+    def users_collection(self):
+        """Объект с API коллекции Motor, который получают сервисы и обработчики."""
+        return self.legacy if self.layout == LAYOUT_SINGLE else RoutedCollection(self)
+
+    async def ensure_indexes(self) -> None:
+        if self.layout == LAYOUT_SINGLE:
+            return
+        for name, indexes in COLLECTION_INDEXES.items():
+            for keys, options in indexes:
+                try:
+                    await self.db[name].create_index(keys, **options)
+                except Exception as e:
+                    logger.error(f"Error creating index {keys} on {name}: {e}")
+        logger.info("Indexes for typed collections ensured")
+
+
+class RoutedCollection:
+    """Маршрутизирует операции по полю type в фильтре/документе/первом $match.
+
+    В раскладке dual основная запись идёт в общую коллекцию, а в типовую —
+    теневая копия; ошибки теневой записи только логируются, расхождения
+    исправляет `python -m src.tools.migrate_storage verify`.
+    """
+
+    def __init__(self, storage: Storage):
+        self.storage = storage
+
+    @property
+    def name(self) -> str:
+        return self.storage.legacy.name
+
+    def _primary(self, doc_type: str):
+        return self.storage.collection(doc_type)
+
+    def _shadow(self, doc_type: str):
+        if self.storage.layout != LAYOUT_DUAL:
+            return None
+        target = self.storage.typed_collection(doc_type)
+        return None if target is self.storage.legacy else target
+
+    async def _mirror(self, coro, what: str) -> None:
+        try:
+            await coro
+        except Exception as e:
+            logger.warning(f"Shadow {what} to typed collection failed: {e}")
+
+    # --- чтение ---
+
+    def find(self, filter: Dict, *args, **kwargs):
+        return self._primary(_literal_type(filter)).find(filter, *args, **kwargs)
+
+    async def find_one(self, filter: Dict, *args, **kwargs):
+        return await self._primary(_literal_type(filter)).find_one(filter, *args, **kwargs)
+
+    async def count_documents(self, filter: Dict, **kwargs) -> int:
+        return await self._primary(_literal_type(filter)).count_documents(filter, **kwargs)
+
+    def aggregate(self, pipeline: List[Dict], **kwargs):
+        return self._primary(_pipeline_type(pipeline)).aggregate(pipeline, **kwargs)
+
+    # --- запись ---
+
+    async def insert_one(self, document: Dict, **kwargs):
+        doc_type = _literal_type(document)
+        result = await self._primary(doc_type).insert_one(document, **kwargs)
+        shadow = self._shadow(doc_type)
+        if shadow is not None:
+            await self._mirror(shadow.insert_one(document), "insert_one")
+        return result
+
+    async def insert_many(self, documents: Iterable[Dict], ordered: bool = True, **kwargs):
+        documents = list(documents)
+        if self.storage.layout != LAYOUT_SPLIT:
+            try:
+                return await self.storage.legacy.insert_many(documents, ordered=ordered, **kwargs)
+            finally:
+                # _id уже проставлены драйвером, дубликаты в теневой коллекции безвредны.
+                await self._mirror_many([d for d in documents if "_id" in d])
+        return await self._insert_many_split(documents, ordered=ordered, **kwargs)
+
+    async def _mirror_many(self, documents: List[Dict]) -> None:
+        for doc_type, (_, group) in self._group_by_type(documents).items():
+            shadow = self._shadow(doc_type)
+            if shadow is None:
+                continue
+            try:
+                await shadow.insert_many(group, ordered=False)
+            except BulkWriteError as e:
+                if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                    logger.warning(f"Shadow insert_many to typed collection failed: {e}")
+            except Exception as e:
+                logger.warning(f"Shadow insert_many to typed collection failed: {e}")
+
+    @staticmethod
+    def _group_by_type(documents: List[Dict]) -> Dict[str, Tuple[List[int], List[Dict]]]:
+        groups: Dict[str, Tuple[List[int], List[Dict]]] = {}
+        for i, doc in enumerate(documents):
+            positions, group = groups.setdefault(_literal_type(doc), ([], []))
+            positions.append(i)
+            group.append(doc)
+        return groups
+
+    async def _insert_many_split(self, documents: List[Dict], ordered: bool, **kwargs):
+        inserted = 0
+        write_errors: List[Dict] = []
+        for doc_type, (positions, group) in self._group_by_type(documents).items():
+            try:
+                result = await self._primary(doc_type).insert_many(group, ordered=ordered, **kwargs)
+                inserted += len(result.inserted_ids)
+            except BulkWriteError as e:
+                # Индексы ошибок переводим обратно в позиции исходного списка.
+                for err in e.details.get("writeErrors", []):
+                    write_errors.append({**err, "index": positions[err["index"]]})
+                inserted += e.details.get("nInserted", 0)
+                if ordered:
+                    break
+        if write_errors:
+            raise BulkWriteError({"writeErrors": write_errors, "nInserted": inserted, "writeConcernErrors": []})
+        return _InsertManyResult([d.get("_id") for d in documents])
+
+    async def update_one(self, filter: Dict, update: Any, upsert: bool = False, **kwargs):
+        doc_type = _literal_type(filter)
+        result = await self._primary(doc_type).update_one(filter, update, upsert=upsert, **kwargs)
+        shadow = self._shadow(doc_type)
+        if shadow is not None:
+            if result.upserted_id is not None:
+                mirror = shadow.update_one({"_id": result.upserted_id},
+                                           _seeded_update(update, filter, result.upserted_id), upsert=True)
+            else:
+                mirror = shadow.update_one(filter, update, **kwargs)
+            await self._mirror(mirror, "update_one")
+        return result
+
+    async def update_many(self, filter: Dict, update: Any, **kwargs):
+        doc_type = _literal_type(filter)
+        result = await self._primary(doc_type).update_many(filter, update, **kwargs)
+        shadow = self._shadow(doc_type)
+        if shadow is not None:
+            await self._mirror(shadow.update_many(filter, update, **kwargs), "update_many")
+        return result
+
+    async def find_one_and_update(self, filter: Dict, update: Any, *args, **kwargs):
+        doc_type = _literal_type(filter)
+        doc = await self._primary(doc_type).find_one_and_update(filter, update, *args, **kwargs)
+        shadow = self._shadow(doc_type)
+        if shadow is not None and doc is not None and "_id" in doc:
+            upsert = kwargs.get("upsert", False)
+            mirror_update = _seeded_update(update, filter, doc["_id"]) if upsert else update
+            await self._mirror(shadow.update_one({"_id": doc["_id"]}, mirror_update, upsert=upsert),
+                               "find_one_and_update")
+        return doc
+
+    async def delete_one(self, filter: Dict, **kwargs):
+        doc_type = _literal_type(filter)
+        result = await self._primary(doc_type).delete_one(filter, **kwargs)
+        shadow = self._shadow(doc_type)
+        if shadow is not None:
+            await self._mirror(shadow.delete_one(filter, **kwargs), "delete_one")
+        return result
+
+    async def delete_many(self, filter: Dict, **kwargs):
+        doc_type = _literal_type(filter)
+        result = await self._primary(doc_type).delete_many(filter, **kwargs)
+        shadow = self._shadow(doc_type)
+        if shadow is not None:
+            await self._mirror(shadow.delete_many(filter, **kwargs), "delete_many")
+        return result
+
+    async def bulk_write(self, requests: List[Any], **kwargs):
+        requests = list(requests)
+        doc_types = {_request_type(request) for request in requests}
+        if len(doc_types) != 1:
+            raise StorageRoutingError(f"bulk_write must target a single document type, got {sorted(doc_types)}")
+        doc_type = doc_types.pop()
+        result = await self._primary(doc_type).bulk_write(requests, **kwargs)
+        shadow = self._shadow(doc_type)
+        if shadow is not None:
+            await self._mirror(shadow.bulk_write(requests, **kwargs), "bulk_write")
+        return result
+
+
+class _InsertManyResult:
+    def __init__(self, inserted_ids: List[Any]):
+        self.inserted_ids = inserted_ids
+        self.acknowledged = True
@@ -0,0 +1,127 @@
+import asyncio
+import hmac
+import logging
+from typing import Optional
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+
+    def __init__(
+        self,
+        dp: Dispatcher,
+        bot: Bot,
+        *,
+        path: str,
+        secret_token: str = "",
+        health_checker=None,
+        queue_size: int = 1000,
+        workers: int = 16
+    ):
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self.health_checker = health_checker
+        self.workers = workers
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.rejected_updates = 0
+        self._worker_tasks: list[asyncio.Task] = []
+        self._runner: Optional[web.AppRunner] = None
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self._handle_update)
+        app.router.add_get("/health", self._handle_health)
+        return app
+
+    async def _handle_update(self, request: web.Request) -> web.Response:
+        if self.secret_token:
+            received = request.headers.get(SECRET_HEADER, "")
+            if not hmac.compare_digest(received, self.secret_token):
+                return web.Response(status=401)
+
+        try:
+            payload = await request.json()
+            update = Update.model_validate(payload, context={"bot": self.bot})
+        except Exception as e:
+            logger.warning(f"Invalid webhook payload: {e}")
+            return web.Response(status=400)
+
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Telegram повторит доставку позже — это и есть back-pressure.
+            self.rejected_updates += 1
+            logger.warning(f"Update queue is full ({self.queue.qsize()}), rejecting update {update.update_id}")
+            return web.Response(status=503, headers={"Retry-After": "1"})
+
+        return web.Response(status=200)
+
+    async def _handle_health(self, request: web.Request) -> web.Response:
+        body = {
+            "update_queue": {
+                "size": self.queue.qsize(),
+                "capacity": self.queue.maxsize,
+                "rejected": self.rejected_updates,
+            }
+        }
+        status = 200
+        if self.health_checker is not None:
+            try:
+                health = await self.health_checker.get_health_status()
+                body.update(health)
+                if health.get("overall") != "healthy":
+                    status = 503
+            except Exception as e:
+                logger.error(f"Error in HTTP health check: {e}")
+                body["error"] = str(e)
+                status = 503
+        return web.json_response(body, status=status)
+
+    async def _worker(self, idx: int) -> None:
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                logger.error(f"Webhook worker {idx} failed to process update {update.update_id}: {e}", exc_info=True)
+            finally:
+                self.queue.task_done()
+
+    async def start(self, host: str, port: int, webhook_url: str) -> None:
+        self._runner = web.AppRunner(self.build_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host=host, port=port)
+        await site.start()
+
+        self._worker_tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+        await self.bot.set_webhook(
+            url=webhook_url,
+            secret_token=self.secret_token or None,
+            allowed_updates=self.dp.resolve_used_update_types(),
+        )
+        logger.info(f"Webhook server listening on {host}:{port}{self.path}, workers: {self.workers}")
+
+    async def stop(self, drain_timeout: float = 10.0) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Webhook queue not drained in {drain_timeout}s, {self.queue.qsize()} updates dropped")
+
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Dict, List, Optional
+
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+class WriteBehindBuffer:
+    """Копит документы и пишет их пачками через insert_many(ordered=False).
+
+    Пачка уходит при наборе max_batch документов или раз в flush_interval секунд.
+    Если MongoDB не успевает, очередь заполняется и put() начинает ждать —
+    это и есть back-pressure для обработчиков.
+    """
+
+    def __init__(self, collection, *, max_batch: int = 200, flush_interval: float = 0.5,
+                 max_pending: int = 10_000, max_retries: int = 5, retry_base_delay: float = 0.2,
+                 retry_max_delay: float = 10.0):
+        self.collection = collection
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self._flusher_task: Optional[asyncio.Task] = None
+        self._closing = False
+        self._stats = {"written": 0, "batches": 0, "retries": 0, "dropped": 0, "blocked_puts": 0}
+
+    def start(self) -> None:
+        if self._flusher_task is None or self._flusher_task.done():
+            self._flusher_task = asyncio.create_task(self._flusher())
+
+    async def put(self, doc: Dict[str, Any]) -> None:
+        if self._closing or self._flusher_task is None:
+            # Буфер уже остановлен (или ещё не запущен) — пишем напрямую.
+            await self._insert_with_retry([doc])
+            return
+        if self._queue.full():
+            self._stats["blocked_puts"] += 1
+        await self._queue.put(doc)
+
+    async def _flusher(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout=timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._insert_with_retry(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _insert_with_retry(self, docs: List[Dict[str, Any]]) -> None:
+        attempt = 0
+        while docs:
+            try:
+                await self.collection.insert_many(docs, ordered=False)
+                self._stats["written"] += len(docs)
+                self._stats["batches"] += 1
+                return
+            except BulkWriteError as e:
+                write_errors = e.details.get("writeErrors", [])
+                failed = {err["index"] for err in write_errors if err.get("code") != DUPLICATE_KEY_ERROR}
+                # Дубликаты _id означают, что документ уже записан прошлой попыткой.
+                self._stats["written"] += len(docs) - len(failed)
+                docs = [doc for i, doc in enumerate(docs) if i in failed]
+                if not docs:
+                    return
+                error = e
+            except Exception as e:
+                error = e
+
+            attempt += 1
+            if attempt > self.max_retries:
+                self._stats["dropped"] += len(docs)
+                logger.error(f"Dropping {len(docs)} documents after {self.max_retries} retries: {error}")
+                return
+            self._stats["retries"] += 1
+            delay = min(self.retry_max_delay, self.retry_base_delay * (2 ** (attempt - 1)))
+            delay = random.uniform(delay / 2, delay)
+            logger.warning(f"insert_many of {len(docs)} documents failed (attempt {attempt}), retry in {delay:.2f}s: {error}")
+            await asyncio.sleep(delay)
+
+    async def close(self, timeout: float = 15.0) -> None:
+        self._closing = True
+        if self._flusher_task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Write buffer not drained in {timeout}s, {self._queue.qsize()} documents lost")
+        self._flusher_task.cancel()
+        try:
+            await self._flusher_task
+        except asyncio.CancelledError:
+            pass
+        self._flusher_task = None
+
+    def get_stats(self) -> Dict[str, int]:
+        return {"pending": self._queue.qsize(), **self._stats}
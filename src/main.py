@@ -1,4 +1,6 @@
 import asyncio
+import functools
+import signal
 import sys
 import logging
 from logging.handlers import RotatingFileHandler
@@ -7,6 +9,16 @@ from typing import Optional
 import motor.motor_asyncio
 from src import config
 from src.application.handlers import router as handler_router
+from src.application.middlewares import UserSerializationMiddleware
+from src.domain.services.prompt_service import PromptBuilder
+from src.domain.services.conversation_service import ConversationWindowBuilder
+from src.domain.services.summary_service import SessionSummarizer
+from src.domain.services.metrics_service import MetricsService
+from src.domain.services.mailing_service import MailingService, migrate_legacy_blacklist
+from src.domain.services.job_service import JobRegistry
+from src.domain.services.segment_service import SegmentService
+from src.domain.services.archive_service import MessageArchive
+from src.domain.services.portrait_queue_service import PortraitQueue
 from src.application.callbacks import (
     menu_router,
     session_router,
@@ -16,10 +28,15 @@ from src.application.callbacks import (
     onboarding_router,
     profile_router
 )
+from src.application.callbacks.portrait_callbacks import generate_portrait
 from src.infrastructure.cache import SimpleCache
 from src.infrastructure.database import Database
+from src.infrastructure.storage import LAYOUT_SPLIT, Storage
 from src.infrastructure.circuit_breaker import CircuitBreaker
 from src.infrastructure.health import HealthChecker
+from src.infrastructure.webhook import WebhookServer
+from src.infrastructure.write_buffer import WriteBehindBuffer
+from src.utils.token_estimator import TokenEstimator
 
 from google import genai
 from google.genai import types
@@ -32,6 +49,11 @@ try:
 except Exception:
     AsyncOpenAI = None
 
+try:
+    from redis.asyncio import Redis
+except Exception:
+    Redis = None
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 root_logger = logging.getLogger()
 for h in list(root_logger.handlers):
@@ -51,21 +73,26 @@ DEFAULT_TEMPERATURE = 0.8
 _ALERT_THROTTLE: dict[str, float] = {}
 _ALERT_THROTTLE_WINDOW_SEC = 60.0
 
-def generate_content_sync(client, model_name, contents, system_instruction=None):
-    """Синхронный вызов Gemini (оставлен для совместимости, без ретраев)."""
+def _build_generate_config(system_instruction=None, cached_content=None):
     config_params = {
         "temperature": DEFAULT_TEMPERATURE
     }
 
-    if system_instruction:
+    if cached_content:
+        # Системная инструкция уже лежит в кэше; передавать её повторно API не позволяет.
+        config_params['cached_content'] = cached_content
+    elif system_instruction:
         config_params['system_instruction'] = system_instruction
 
-    config_obj = types.GenerateContentConfig(**config_params) if config_params else None
+    return types.GenerateContentConfig(**config_params) if config_params else None
+
 
+def generate_content_sync(client, model_name, contents, system_instruction=None):
+    """Синхронный вызов Gemini (оставлен для совместимости, без ретраев)."""
     return client.models.generate_content(
         model=model_name,
         contents=contents,
-        config=config_obj
+        config=_build_generate_config(system_instruction)
     )
 
 
@@ -76,9 +103,26 @@ def count_tokens_sync(client, model_name, contents):
     )
 
 
+async def generate_content_async(client, model_name, contents, system_instruction=None, cached_content=None):
+    """Нативный асинхронный вызов Gemini через client.aio (без потоков executor'а)."""
+    return await client.aio.models.generate_content(
+        model=model_name,
+        contents=contents,
+        config=_build_generate_config(system_instruction, cached_content)
+    )
+
+
+async def count_tokens_async(client, model_name, contents):
+    return await client.aio.models.count_tokens(
+        model=model_name,
+        contents=contents
+    )
+
+
 async def _run_with_timeout(func, *args, timeout: float):
-    loop = asyncio.get_event_loop()
-    return await asyncio.wait_for(loop.run_in_executor(None, func, *args), timeout=timeout)
+    # wait_for отменяет саму корутину запроса, поэтому по таймауту HTTP-вызов
+    # действительно прерывается, а не продолжает занимать поток в фоне.
+    return await asyncio.wait_for(func(*args), timeout=timeout)
 
 
 async def generate_content_async_with_retry(client,
@@ -89,13 +133,14 @@ async def generate_content_async_with_retry(client,
                                             timeout: float = 20.0,
                                             retries: int = 3,
                                             backoff_base: float = 1.0,
-                                            circuit_breaker=None):
+                                            circuit_breaker=None,
+                                            cached_content: Optional[str] = None):
     if circuit_breaker is not None:
         try:
             return await circuit_breaker.call(
                 _generate_with_retry_internal,
                 client, model_name, contents, system_instruction,
-                timeout, retries, backoff_base
+                timeout, retries, backoff_base, cached_content
             )
         except Exception as e:
             from src.infrastructure.circuit_breaker import CircuitBreakerOpenError
@@ -105,23 +150,24 @@ async def generate_content_async_with_retry(client,
     
     return await _generate_with_retry_internal(
         client, model_name, contents, system_instruction,
-        timeout, retries, backoff_base
+        timeout, retries, backoff_base, cached_content
     )
 
 
 async def _generate_with_retry_internal(client, model_name, contents, system_instruction,
-                                        timeout, retries, backoff_base):
+                                        timeout, retries, backoff_base, cached_content=None):
     attempt = 0
     last_err = None
     max_retries = min(retries, 2)
     while attempt < max_retries:
         try:
             return await _run_with_timeout(
-                generate_content_sync,
+                generate_content_async,
                 client,
                 model_name,
                 contents,
                 system_instruction,
+                cached_content,
                 timeout=min(timeout, 10.0)
             )
         except Exception as e:
@@ -138,6 +184,92 @@ async def _generate_with_retry_internal(client, model_name, contents, system_ins
     raise last_err if last_err else RuntimeError("Gemini call failed without explicit error")
 
 
+async def generate_content_stream_async(client, model_name, contents, system_instruction=None, on_chunk=None,
+                                        cached_content=None):
+    """Потоковая генерация Gemini: on_chunk получает накопленный текст после каждого чанка."""
+    stream = await client.aio.models.generate_content_stream(
+        model=model_name,
+        contents=contents,
+        config=_build_generate_config(system_instruction, cached_content)
+    )
+    parts: list[str] = []
+    async for chunk in stream:
+        text = getattr(chunk, "text", None)
+        if not text:
+            continue
+        parts.append(text)
+        if on_chunk is not None:
+            on_chunk("".join(parts))
+    return "".join(parts)
+
+
+async def generate_content_stream_with_retry(client,
+                                             model_name,
+                                             contents,
+                                             system_instruction: Optional[str] = None,
+                                             *,
+                                             on_chunk=None,
+                                             timeout: float = 60.0,
+                                             retries: int = 2,
+                                             backoff_base: float = 0.5,
+                                             circuit_breaker=None,
+                                             cached_content: Optional[str] = None):
+    if circuit_breaker is not None:
+        try:
+            return await circuit_breaker.call(
+                _stream_with_retry_internal,
+                client, model_name, contents, system_instruction,
+                on_chunk, timeout, retries, backoff_base, cached_content
+            )
+        except Exception as e:
+            from src.infrastructure.circuit_breaker import CircuitBreakerOpenError
+            if isinstance(e, CircuitBreakerOpenError):
+                raise RuntimeError("AI service temporarily unavailable (circuit breaker open)")
+            raise
+
+    return await _stream_with_retry_internal(
+        client, model_name, contents, system_instruction,
+        on_chunk, timeout, retries, backoff_base, cached_content
+    )
+
+
+async def _stream_with_retry_internal(client, model_name, contents, system_instruction,
+                                      on_chunk, timeout, retries, backoff_base, cached_content=None):
+    attempt = 0
+    last_err = None
+    received = False
+
+    def _tracking_on_chunk(text):
+        nonlocal received
+        received = True
+        if on_chunk is not None:
+            on_chunk(text)
+
+    while attempt < retries:
+        try:
+            return await _run_with_timeout(
+                generate_content_stream_async,
+                client,
+                model_name,
+                contents,
+                system_instruction,
+                _tracking_on_chunk,
+                cached_content,
+                timeout=timeout
+            )
+        except Exception as e:
+            last_err = e
+            msg = str(e).lower()
+            client_err = any(code in msg for code in [" 4", "bad request", "unauthorized", "forbidden"]) and "429" not in msg
+
+            attempt += 1
+            # Повтор после частично показанного ответа дал бы дубли в сообщении пользователя.
+            if received or client_err or attempt >= retries:
+                break
+            await asyncio.sleep(min(backoff_base * (2 ** (attempt - 1)), 2.0))
+    raise last_err if last_err else RuntimeError("Gemini stream failed without explicit error")
+
+
 async def count_tokens_async_with_retry(client,
                                         model_name,
                                         contents,
@@ -167,7 +299,7 @@ async def _count_tokens_internal(client, model_name, contents, timeout, retries,
     while attempt < retries:
         try:
             return await _run_with_timeout(
-                count_tokens_sync,
+                count_tokens_async,
                 client,
                 model_name,
                 contents,
@@ -285,14 +417,37 @@ async def _verify_openai_models(bot: Bot, client: "AsyncOpenAI"):
     except Exception as e:
         logger.warning(f"Не удалось проверить список моделей OpenAI: {e}")
 
+def _create_cache_and_storage():
+    if config.REDIS_URL:
+        if Redis is None:
+            logger.critical("REDIS_URL задан, но пакет redis не установлен. Exiting...")
+            sys.exit(1)
+        from src.infrastructure.fsm_storage import BinaryRedisStorage
+        from src.infrastructure.redis_cache import RedisCache
+
+        cache = RedisCache(Redis.from_url(config.REDIS_URL), namespace=config.REDIS_CACHE_NAMESPACE)
+        storage = BinaryRedisStorage(
+            Redis.from_url(config.REDIS_URL),
+            state_ttl=config.FSM_STATE_TTL_SEC,
+            data_ttl=config.FSM_STATE_TTL_SEC,
+        )
+        logger.info("Using Redis for cache and FSM storage")
+        return cache, storage
+
+    cache = SimpleCache(max_entries=config.CACHE_MAX_ENTRIES, max_bytes=config.CACHE_MAX_BYTES)
+    logger.info("Using in-memory cache and FSM storage")
+    return cache, None
+
+
 async def main():
     global gemini_client, mongo_client, db, users_collection, openai_client
 
-    cache = SimpleCache()
-    asyncio.create_task(cache.start_cleanup_task())
+    cache, fsm_storage = _create_cache_and_storage()
+    asyncio.create_task(cache.start_cleanup_task(interval=config.CACHE_CLEANUP_INTERVAL_SEC))
     
     gemini_circuit = CircuitBreaker(failure_threshold=3, timeout=30.0)
     openai_circuit = CircuitBreaker(failure_threshold=5, timeout=60.0)
+    token_estimator = TokenEstimator(calibrate_every=config.TOKEN_ESTIMATOR_CALIBRATE_EVERY)
     
     try:
         gemini_client = genai.Client(api_key=config.GEMINI_API_KEY)
@@ -315,15 +470,23 @@ async def main():
     try:
         database = Database(config.MONGODB_URI, config.DB_NAME)
         await database.connect()
-        users_collection = database.get_collection(config.USERS_COLLECTION)
-        asyncio.create_task(database.ensure_indexes(config.USERS_COLLECTION))
+        document_storage = Storage(database.db, config.USERS_COLLECTION, layout=config.STORAGE_LAYOUT)
+        users_collection = document_storage.users_collection()
+        if document_storage.layout != LAYOUT_SPLIT:
+            asyncio.create_task(database.ensure_indexes(config.USERS_COLLECTION))
+        asyncio.create_task(document_storage.ensure_indexes())
+        logger.info(f"Document storage layout: {document_storage.layout}")
         logger.info("Database initialized successfully")
     except Exception as e:
         logger.critical(f"Failed to initialize database: {e}")
         logger.critical("Bot cannot start without database. Exiting...")
         sys.exit(1)
 
-    dp = Dispatcher()
+    dp = Dispatcher(storage=fsm_storage) if fsm_storage is not None else Dispatcher()
+
+    user_serialization = UserSerializationMiddleware(merge_messages=config.MERGE_RAPID_MESSAGES)
+    dp.message.outer_middleware(user_serialization)
+    dp.callback_query.outer_middleware(user_serialization)
 
     dp.include_routers(
         handler_router,
@@ -343,13 +506,112 @@ async def main():
 
     logger.info("Приложение успешно запущено с оптимизациями.")
 
-    async def generate_with_circuit(client, model, contents, system_instruction=None, timeout=10.0, retries=2, backoff_base=0.5):
-        return await generate_content_async_with_retry(
-            client, model, contents, system_instruction,
-            timeout=timeout, retries=retries, backoff_base=backoff_base,
-            circuit_breaker=gemini_circuit
-        )
+    llm_semaphore = asyncio.Semaphore(config.MAX_CONCURRENT_LLM_CALLS)
+
+    async def generate_with_circuit(client, model, contents, system_instruction=None, timeout=10.0, retries=2, backoff_base=0.5,
+                                    cached_content=None):
+        async with llm_semaphore:
+            return await generate_content_async_with_retry(
+                client, model, contents, system_instruction,
+                timeout=timeout, retries=retries, backoff_base=backoff_base,
+                circuit_breaker=gemini_circuit, cached_content=cached_content
+            )
     
+    async def stream_with_circuit(client, model, contents, system_instruction=None, on_chunk=None, timeout=60.0, retries=2, backoff_base=0.5,
+                                  cached_content=None):
+        async with llm_semaphore:
+            return await generate_content_stream_with_retry(
+                client, model, contents, system_instruction,
+                on_chunk=on_chunk, timeout=timeout, retries=retries, backoff_base=backoff_base,
+                circuit_breaker=gemini_circuit, cached_content=cached_content
+            )
+
+    async def openai_with_limit(client, model, prompt, system_instruction=None, **kwargs):
+        async with llm_semaphore:
+            return await generate_openai_chat_async(client, model, prompt, system_instruction, **kwargs)
+
+    metrics = MetricsService(
+        users_collection,
+        max_concurrency=config.ADMIN_METRICS_CONCURRENCY,
+        slow_query_sec=config.ADMIN_METRIC_SLOW_SEC
+    )
+    asyncio.create_task(metrics.ensure_backfilled())
+
+    write_buffer = WriteBehindBuffer(
+        users_collection,
+        max_batch=config.WRITE_BUFFER_MAX_BATCH,
+        flush_interval=config.WRITE_BUFFER_FLUSH_INTERVAL_SEC,
+        max_pending=config.WRITE_BUFFER_MAX_PENDING
+    )
+    write_buffer.start()
+
+    session_summarizer = SessionSummarizer(
+        users_collection,
+        generate_with_circuit,
+        gemini_client,
+        openai_client=openai_client,
+        generate_openai_func=openai_with_limit,
+        cache=cache,
+        fold_every_turns=config.SUMMARY_FOLD_EVERY_TURNS,
+        idle_timeout_min=config.SESSION_IDLE_TIMEOUT_MIN,
+        alert_func=send_alert,
+        bot=bot,
+        metrics=metrics
+    )
+    session_summarizer.start_sweeper(interval=config.SESSION_SWEEP_INTERVAL_SEC)
+
+    message_archive = MessageArchive(users_collection, archive_after_days=config.MESSAGE_ARCHIVE_AFTER_DAYS)
+    message_archive.start(interval=config.MESSAGE_ARCHIVE_INTERVAL_SEC)
+
+    segments = SegmentService(users_collection, cache)
+    asyncio.create_task(segments.ensure_backfilled())
+    jobs = JobRegistry(bot, report_interval=config.JOB_PROGRESS_INTERVAL_SEC)
+    mailing = MailingService(
+        bot,
+        users_collection,
+        rate_per_sec=config.MAILING_RATE_PER_SEC,
+        concurrency=config.MAILING_CONCURRENCY,
+        checkpoint_every=config.MAILING_CHECKPOINT_EVERY,
+        registry=jobs,
+        segments=segments
+    )
+    try:
+        await migrate_legacy_blacklist(users_collection)
+    except Exception as e:
+        logger.error(f"Failed to migrate legacy blacklist: {e}")
+    asyncio.create_task(mailing.resume_unfinished())
+
+    prompt_builder = PromptBuilder(
+        gemini_client,
+        'gemini-3-flash-preview',
+        use_cached_content=config.PROMPT_CACHE_ENABLED,
+        cache_ttl_sec=config.PROMPT_CACHE_TTL_SEC
+    )
+
+    portrait_queue = PortraitQueue(
+        bot,
+        users_collection,
+        functools.partial(
+            generate_portrait,
+            users_collection=users_collection,
+            generate_content_sync_func=generate_with_circuit,
+            gemini_client=gemini_client,
+            openai_client=openai_client,
+            generate_openai_func=openai_with_limit,
+            alert_func=send_alert,
+            bot=bot,
+            message_archive=message_archive,
+            token_estimator=token_estimator
+        ),
+        fsm_storage=dp.storage,
+        workers=config.PORTRAIT_WORKERS,
+        metrics=metrics,
+        nightly_window=config.PORTRAIT_NIGHTLY_WINDOW_UTC,
+        nightly_active_days=config.PORTRAIT_NIGHTLY_ACTIVE_DAYS,
+        cooldown_hours=config.PORTRAIT_COOLDOWN_HOURS
+    )
+    portrait_queue.start(check_interval=config.PORTRAIT_NIGHTLY_CHECK_INTERVAL_SEC)
+
     async def count_tokens_with_circuit(client, model, contents, timeout=10.0, retries=3, backoff_base=1.0):
         return await count_tokens_async_with_retry(
             client, model, contents,
@@ -361,7 +623,8 @@ async def main():
         health_checker = HealthChecker(
             database=database,
             gemini_circuit=gemini_circuit,
-            openai_circuit=openai_circuit
+            openai_circuit=openai_circuit,
+            cache=cache
         )
         logger.info("Health checker initialized successfully")
     except Exception as e:
@@ -373,23 +636,69 @@ async def main():
         "gemini_circuit": gemini_circuit,
         "openai_circuit": openai_circuit,
         "generate_content_sync_func": generate_with_circuit,
+        "stream_content_func": stream_with_circuit if config.STREAMING_ENABLED else None,
         "count_tokens_sync_func": count_tokens_with_circuit,
         "openai_client": openai_client,
-        "generate_openai_func": generate_openai_chat_async,
+        "generate_openai_func": openai_with_limit,
         "users_collection": users_collection,
         "database": database,
+        "document_storage": document_storage,
         "cache": cache,
         "config": config,
         "bot": bot,
         "alert_func": send_alert,
         "health_checker": health_checker,
+        "token_estimator": token_estimator,
+        "prompt_builder": prompt_builder,
+        "session_summarizer": session_summarizer,
+        "write_buffer": write_buffer,
+        "message_archive": message_archive,
+        "portrait_queue": portrait_queue,
+        "metrics": metrics,
+        "mailing": mailing,
+        "jobs": jobs,
+        "segments": segments,
+        "conversation_window": ConversationWindowBuilder(
+            token_budget=config.CONVERSATION_WINDOW_TOKENS,
+            estimate=token_estimator.estimate
+        ),
     })
 
+    webhook_server = None
+
     try:
         if openai_client is not None:
             asyncio.create_task(_verify_openai_models(bot, openai_client))
-        logger.info("Starting bot polling...")
-        await dp.start_polling(bot)
+        if config.BOT_MODE == "webhook":
+            webhook_server = WebhookServer(
+                dp,
+                bot,
+                path=config.WEBHOOK_PATH,
+                secret_token=config.WEBHOOK_SECRET,
+                health_checker=health_checker,
+                queue_size=config.WEBHOOK_QUEUE_SIZE,
+                workers=config.WEBHOOK_WORKERS
+            )
+            logger.info("Starting bot in webhook mode...")
+            await webhook_server.start(
+                config.WEBAPP_HOST,
+                config.WEBAPP_PORT,
+                f"{config.WEBHOOK_BASE_URL.rstrip('/')}{config.WEBHOOK_PATH}"
+            )
+            # В polling сигналы обрабатывает aiogram; здесь ставим свои, иначе SIGTERM при деплое
+            # убьёт процесс мимо finally и буфер записи не будет сброшен.
+            stop_event = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                try:
+                    loop.add_signal_handler(sig, stop_event.set)
+                except (NotImplementedError, RuntimeError):
+                    pass
+            await stop_event.wait()
+            logger.info("Stop signal received")
+        else:
+            logger.info("Starting bot polling...")
+            await dp.start_polling(bot)
     except KeyboardInterrupt:
         logger.info("Bot stopped by user")
     except Exception as e:
@@ -397,6 +706,48 @@ async def main():
         raise
     finally:
         logger.info("Shutting down...")
+        try:
+            if webhook_server is not None:
+                await webhook_server.stop()
+        except Exception as e:
+            logger.error(f"Error stopping webhook server: {e}")
+
+        try:
+            await user_serialization.close()
+        except Exception as e:
+            logger.error(f"Error draining per-user update queues: {e}")
+
+        try:
+            await mailing.close()
+            await jobs.close()
+        except Exception as e:
+            logger.error(f"Error stopping mailing jobs: {e}")
+
+        try:
+            await session_summarizer.close()
+        except Exception as e:
+            logger.error(f"Error stopping session summarizer: {e}")
+
+        try:
+            await portrait_queue.close()
+        except Exception as e:
+            logger.error(f"Error stopping portrait workers: {e}")
+
+        try:
+            await message_archive.close()
+        except Exception as e:
+            logger.error(f"Error stopping message archiver: {e}")
+
+        try:
+            await write_buffer.close()
+        except Exception as e:
+            logger.error(f"Error draining write buffer: {e}")
+
+        try:
+            await prompt_builder.close()
+        except Exception as e:
+            logger.error(f"Error releasing Gemini context caches: {e}")
+
         try:
             if database is not None:
                 await database.close()
@@ -411,9 +762,14 @@ async def main():
         
         try:
             if cache is not None:
-                await cache.clear()
+                await cache.close()
+        except Exception as e:
+            logger.error(f"Error closing cache: {e}")
+
+        try:
+            await dp.storage.close()
         except Exception as e:
-            logger.error(f"Error clearing cache: {e}")
+            logger.error(f"Error closing FSM storage: {e}")
         
         logger.info("Shutdown complete")
 
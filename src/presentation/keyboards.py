@@ -1,3 +1,5 @@
+from typing import Optional
+
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 main_menu = InlineKeyboardMarkup(
@@ -118,7 +120,7 @@ def question_keyboard(options: list[tuple[str, str]], *, show_end: bool = True,
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
-def portrait_pagination_keyboard(current_page: int, total_pages: int) -> InlineKeyboardMarkup:
+def portrait_pagination_keyboard(current_page: int, total_pages: int, nightly: Optional[bool] = None) -> InlineKeyboardMarkup:
     prev_btn = InlineKeyboardButton(text="⬅️", callback_data=f"portrait_page:{current_page-1}") if current_page > 1 else None
     next_btn = InlineKeyboardButton(text="➡️", callback_data=f"portrait_page:{current_page+1}") if current_page < total_pages else None
 
@@ -132,10 +134,23 @@ def portrait_pagination_keyboard(current_page: int, total_pages: int) -> InlineK
     kb_rows = []
     if row:
         kb_rows.append(row)
+    if nightly is not None:
+        if nightly:
+            toggle = InlineKeyboardButton(text="🌙 Ночное обновление: вкл", callback_data="portrait_nightly:off")
+        else:
+            toggle = InlineKeyboardButton(text="🌙 Обновлять портрет ночью", callback_data="portrait_nightly:on")
+        kb_rows.append([toggle])
     kb_rows.append([InlineKeyboardButton(text="🏠 В меню", callback_data="main_menu")])
 
     return InlineKeyboardMarkup(inline_keyboard=kb_rows)
 
+nightly_portrait_ready_keyboard = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(text="🧠 Открыть портрет", callback_data="get_portrait")
+        ]
+    ])
+
 support_menu = InlineKeyboardMarkup(
     inline_keyboard=[
         [
@@ -225,4 +240,13 @@ mailing_confirm_keyboard = InlineKeyboardMarkup(
             InlineKeyboardButton(text="🛑 Отмена", callback_data="mail_cancel")
         ]
     ]
-)
\ No newline at end of file
+)
+
+def job_control_keyboard(job_id: str, *, paused: bool = False) -> InlineKeyboardMarkup:
+    toggle = (
+        InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"job:resume:{job_id}") if paused
+        else InlineKeyboardButton(text="⏸ Пауза", callback_data=f"job:pause:{job_id}")
+    )
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [toggle, InlineKeyboardButton(text="⏹ Остановить", callback_data=f"job:cancel:{job_id}")]
+    ])
@@ -0,0 +1,386 @@
+"""Аудит индексов: explain() для каждой формы запроса бота на локальном mongod.
+
+    python -m src.tools.index_audit [--uri mongodb://localhost:27017] [--db index_audit]
+                                    [--layout single|split] [--seed 200] [--keep]
+
+Создаёт индексы так же, как бот при старте, при пустых коллекциях заполняет их
+синтетическими документами и прогоняет explain по списку QUERY_SHAPES.
+Код возврата 1, если хоть один запрос выполняется через COLLSCAN или сортировку
+в памяти (SORT). Дополнительно печатает размеры индексов, индексы, которые не выбрал
+ни один план, и индексы — префиксы других индексов.
+
+При добавлении запроса в сервис или обработчик добавьте его форму в QUERY_SHAPES.
+"""
+import argparse
+import asyncio
+import sys
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+import motor.motor_asyncio
+
+from src.domain.services.segment_service import SEGMENT_INDEX_NAME, SEGMENTS, SegmentService
+from src.infrastructure.database import Database
+from src.infrastructure.storage import LAYOUT_SINGLE, LAYOUT_SPLIT, Storage
+
+DEFAULT_USERS_COLLECTION = "users_data"
+BAD_STAGES = {"COLLSCAN": "collection scan", "SORT": "in-memory sort"}
+
+_UID = 1
+_NOW = datetime.now(timezone.utc)
+_TODAY = _NOW.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+@dataclass(frozen=True)
+class QueryShape:
+    name: str
+    doc_type: str
+    op: str  # find | count | aggregate | update | find_and_modify | delete
+    filter: Optional[Dict] = None
+    sort: Optional[Dict] = None
+    projection: Optional[Dict] = None
+    limit: int = 0
+    hint: Optional[str] = None
+    pipeline: Optional[List[Dict]] = None
+
+    def command(self, collection: str) -> Dict[str, Any]:
+        query = self.filter or {}
+        if self.op == "find":
+            cmd: Dict[str, Any] = {"find": collection, "filter": query}
+            if self.sort:
+                cmd["sort"] = self.sort
+            if self.projection:
+                cmd["projection"] = self.projection
+            if self.limit:
+                cmd["limit"] = self.limit
+        elif self.op == "count":
+            cmd = {"count": collection, "query": query}
+        elif self.op == "aggregate":
+            cmd = {"aggregate": collection, "pipeline": self.pipeline, "cursor": {}}
+        elif self.op == "update":
+            cmd = {"update": collection, "updates": [{"q": query, "u": {"$set": {"_audit": True}}}]}
+        elif self.op == "find_and_modify":
+            cmd = {"findAndModify": collection, "query": query, "update": {"$set": {"_audit": True}}}
+            if self.sort:
+                cmd["sort"] = self.sort
+        elif self.op == "delete":
+            cmd = {"delete": collection, "deletes": [{"q": query, "limit": 0}]}
+        else:
+            raise ValueError(f"Unknown query op '{self.op}'")
+        if self.hint:
+            cmd["hint"] = self.hint
+        return cmd
+
+
+def _profile(op: str, name: str, **extra) -> QueryShape:
+    return QueryShape(name, "user_profile", op, {"user_id": _UID, "type": "user_profile", **extra})
+
+
+def _by_day(doc_type: str, ts_field: str) -> QueryShape:
+    return QueryShape(f"metrics_service._backfill/{doc_type}.{ts_field}", doc_type, "aggregate", pipeline=[
+        {"$match": {"type": doc_type, ts_field: {"$gte": _NOW - timedelta(days=30)}}},
+        {"$group": {"_id": {"$dateToString": {"format": "%Y-%m-%d", "date": f"${ts_field}"}}, "n": {"$sum": 1}}},
+    ])
+
+
+def _segment_shapes() -> List[QueryShape]:
+    shapes = []
+    for seg in SEGMENTS:
+        query = SegmentService.query(seg)
+        shapes.append(QueryShape(f"segment_service.iter_user_ids/{seg}", "user_profile", "find",
+                                 {**query, "user_id": {"$gt": _UID}}, sort={"user_id": 1},
+                                 projection={"user_id": 1, "_id": 0}, hint=SEGMENT_INDEX_NAME))
+        shapes.append(QueryShape(f"segment_service.count/{seg}", "user_profile", "count", query,
+                                 hint=SEGMENT_INDEX_NAME))
+    return shapes
+
+
+# Формы запросов сервисов и обработчиков; значения условий — заглушки, важны только поля и операторы.
+QUERY_SHAPES: List[QueryShape] = [
+    # Профиль
+    _profile("find", "user_service.get_user_profile"),
+    _profile("update", "user_service.save_user_profile_async"),
+    _profile("update", "metrics_service.record_message", has_messages={"$ne": True}),
+    QueryShape("metrics_service._backfill/has_messages", "user_profile", "update",
+               {"type": "user_profile", "user_id": {"$in": [_UID, _UID + 1]}}),
+    QueryShape("metrics_service._backfill/users", "user_profile", "count", {"type": "user_profile"}),
+    QueryShape("metrics_service._backfill/onboarding", "user_profile", "count",
+               {"type": "user_profile", "onboarding_completed": True}),
+    QueryShape("mailing_service.migrate_legacy_blacklist", "blacklisted", "find", {"type": "blacklisted"},
+               projection={"user_id": 1, "_id": 0}),
+    *_segment_shapes(),
+
+    # Диалог и сессии
+    QueryShape("portrait_input_service._load_messages", "user_message", "find",
+               {"user_id": _UID, "type": "user_message", "timestamp": {"$gt": _NOW - timedelta(days=1)}},
+               sort={"timestamp": -1}, projection={"text": 1, "username": 1, "_id": 0}, limit=500),
+    QueryShape("portrait_input_service._load_summaries", "session_summary", "find",
+               {"user_id": _UID, "type": "session_summary", "date": {"$gt": _NOW - timedelta(days=1)}},
+               sort={"date": -1}, projection={"summary": 1, "date": 1, "_id": 0}, limit=200),
+    QueryShape("metrics_service._backfill/senders", "user_message", "aggregate", pipeline=[
+        {"$match": {"type": "user_message"}},
+        {"$group": {"_id": "$user_id"}},
+    ]),
+    QueryShape("metrics_service._backfill/messages", "user_message", "count", {"type": "user_message"}),
+    QueryShape("session_callbacks._fetch_session_history", "session_summary", "find",
+               {"user_id": _UID, "type": "session_summary"}, sort={"date": -1}, limit=1),
+    QueryShape("session_callbacks/sessions_today", "session_summary", "count",
+               {"user_id": _UID, "type": "session_summary", "date": {"$gte": _TODAY}}),
+    QueryShape("summary_service.record_turn", "session_draft", "find_and_modify",
+               {"user_id": _UID, "type": "session_draft", "finalizing": {"$ne": True}}),
+    QueryShape("summary_service._claim/user", "session_draft", "find_and_modify",
+               {"user_id": _UID, "type": "session_draft",
+                "$or": [{"finalizing": {"$ne": True}}, {"finalizing_since": {"$lt": _NOW}}]}),
+    QueryShape("summary_service.discard_session", "session_draft", "delete",
+               {"user_id": _UID, "type": "session_draft", "finalizing": {"$ne": True}}),
+    QueryShape("summary_service.sweep_idle_sessions", "session_draft", "find_and_modify",
+               {"type": "session_draft", "last_active": {"$lt": _NOW},
+                "$or": [{"finalizing": {"$ne": True}}, {"finalizing_since": {"$lt": _NOW}}]}),
+
+    # Архив реплик
+    QueryShape("archive_service.load_messages", "message_bucket", "find",
+               {"user_id": _UID, "type": "message_bucket"}, sort={"month": 1, "seq": 1},
+               projection={"payload": 1, "last_ts": 1}),
+    QueryShape("archive_service.load_messages/hot", "user_message", "find",
+               {"user_id": _UID, "type": "user_message", "timestamp": {"$gt": _NOW - timedelta(days=90)}},
+               sort={"timestamp": 1}, projection={"text": 1, "username": 1, "timestamp": 1, "_id": 0}, limit=500),
+    QueryShape("archive_service.load_recent_messages/newest", "message_bucket", "find",
+               {"user_id": _UID, "type": "message_bucket"}, sort={"month": -1, "seq": -1},
+               projection={"last_ts": 1}, limit=1),
+    QueryShape("archive_service.load_recent_messages", "message_bucket", "find",
+               {"user_id": _UID, "type": "message_bucket", "last_ts": {"$gt": 0}}, sort={"month": -1, "seq": -1},
+               projection={"payload": 1}),
+    QueryShape("archive_service.load_recent_messages/hot", "user_message", "find",
+               {"user_id": _UID, "type": "user_message", "timestamp": {"$gt": _NOW - timedelta(days=90)}},
+               sort={"timestamp": -1}, projection={"text": 1, "username": 1, "timestamp": 1, "_id": 0}, limit=500),
+    QueryShape("archive_service.archive_once", "model_response", "aggregate", pipeline=[
+        {"$match": {"type": "model_response", "timestamp": {"$lt": _NOW - timedelta(days=90)}}},
+        {"$group": {"_id": "$user_id"}},
+    ]),
+    QueryShape("archive_service._archive_user", "model_response", "find",
+               {"user_id": _UID, "type": "model_response", "timestamp": {"$lt": _NOW - timedelta(days=90)}},
+               sort={"timestamp": 1}, limit=1000),
+    QueryShape("archive_service._append_to_bucket", "message_bucket", "find",
+               {"user_id": _UID, "type": "message_bucket", "month": _TODAY.replace(day=1)},
+               sort={"seq": -1}, limit=1),
+
+    # Портрет, оценки, тесты, контекст
+    QueryShape("portrait_service.check_cooldown/last_portrait", "portrait", "find",
+               {"user_id": _UID, "type": "portrait"}, sort={"generated_at": -1}, limit=1),
+    QueryShape("profile_callbacks._get_user_stats_async", "progress_score", "find",
+               {"user_id": _UID, "type": "progress_score"}, sort={"timestamp": -1}),
+    QueryShape("context_service.rebuild_context_doc/tests", "test_result", "find",
+               {"user_id": _UID, "type": "test_result"}, sort={"finished_at": -1}, limit=5),
+    QueryShape("context_service.rebuild_context_doc/scores", "progress_score", "find",
+               {"user_id": _UID, "type": "progress_score"}, sort={"timestamp": -1}, limit=5),
+    QueryShape("context_service/user_context", "user_context", "find",
+               {"user_id": _UID, "type": "user_context"}, projection={"tests": 1, "scores": 1}, limit=1),
+    QueryShape("context_service._push_entry", "user_context", "update",
+               {"user_id": _UID, "type": "user_context", "scores.timestamp": {"$ne": _NOW}}),
+    QueryShape("segment_service._backfill", "progress_score", "aggregate", pipeline=[
+        {"$match": {"type": "progress_score"}},
+        {"$group": {"_id": "$user_id", "n": {"$sum": 1}}},
+    ]),
+
+    # Метрики
+    QueryShape("metrics_service._query_totals", "metrics_totals", "find", {"type": "metrics_totals"}, limit=1),
+    QueryShape("metrics_service._query_daily_counters", "metrics_daily", "find",
+               {"type": "metrics_daily", "date": {"$gte": _TODAY - timedelta(days=14)}}),
+    QueryShape("metrics_service._query_today_dialogs", "metrics_daily", "find",
+               {"type": "metrics_daily", "date": _TODAY}, limit=1),
+    QueryShape("metrics_service._query_unique_users", "metrics_daily", "aggregate", pipeline=[
+        {"$match": {"type": "metrics_daily", "date": {"$gte": _TODAY - timedelta(days=30)}}},
+        {"$project": {"date": 1, "active_users": 1}},
+    ]),
+    _by_day("user_message", "timestamp"),
+    _by_day("user_profile", "last_active"),
+    _by_day("user_profile", "created_at"),
+    _by_day("session_summary", "date"),
+    _by_day("progress_score", "timestamp"),
+    _by_day("portrait", "generated_at"),
+
+    # Рассылки
+    QueryShape("mailing_service.resume_unfinished", "mailing_job", "find",
+               {"type": "mailing_job", "status": "running"}, projection={"_id": 1}),
+
+    # Очередь портретов
+    QueryShape("portrait_queue_service.enqueue", "portrait_job", "find_and_modify",
+               {"user_id": _UID, "type": "portrait_job", "active": True}),
+    QueryShape("portrait_queue_service.resume_unfinished", "portrait_job", "find",
+               {"type": "portrait_job", "active": True, "lease_until": {"$lte": _NOW}},
+               projection={"_id": 1, "priority": 1}),
+    QueryShape("portrait_queue_service.schedule_nightly/marker", "portrait_nightly_run", "find_and_modify",
+               {"type": "portrait_nightly_run", "date": _TODAY}),
+    QueryShape("portrait_queue_service.schedule_nightly", "user_profile", "find",
+               {"type": "user_profile", "portrait_nightly": True, "blacklisted": {"$ne": True},
+                "last_active": {"$gte": _NOW - timedelta(days=7)}},
+               projection={"user_id": 1, "last_active": 1, "last_portrait_timestamp": 1, "_id": 0}),
+]
+
+# Поля синтетических документов: каждое, по которому есть условие или сортировка в QUERY_SHAPES.
+_SEED_TIME_FIELDS = ("timestamp", "date", "generated_at", "finished_at", "last_active", "created_at",
+                     "last_portrait_timestamp", "month", "lease_until")
+
+
+def _seed_docs(doc_type: str, n: int) -> List[Dict]:
+    docs = []
+    for i in range(n):
+        doc: Dict[str, Any] = {"type": doc_type, "user_id": i, "status": "done", "test_id": f"t{i % 5}",
+                               "progress_score_count": i % 7, "seq": 0, "blacklisted": i % 20 == 0,
+                               "active": True, "portrait_nightly": i % 3 == 0}
+        for offset, f in enumerate(_SEED_TIME_FIELDS):
+            doc[f] = _NOW - timedelta(hours=i + offset)
+        docs.append(doc)
+    return docs
+
+
+def _find_key(node: Any, key: str) -> Iterator[Any]:
+    if isinstance(node, dict):
+        for k, v in node.items():
+            if k == key:
+                yield v
+            else:
+                yield from _find_key(v, key)
+    elif isinstance(node, list):
+        for item in node:
+            yield from _find_key(item, key)
+
+
+def _stages(plan: Any) -> Iterator[Dict]:
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan
+        for v in plan.values():
+            yield from _stages(v)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _stages(item)
+
+
+def analyze_explain(explain: Dict) -> Dict[str, Any]:
+    """Стадии выигравших планов: проблемные (COLLSCAN/SORT) и использованные индексы."""
+    problems: List[str] = []
+    indexes: Set[str] = set()
+    # Для агрегаций план лежит в stages[0].$cursor, в шардированном кластере — по шардам.
+    for plan in _find_key(explain, "winningPlan"):
+        for stage in _stages(plan):
+            name = stage["stage"]
+            if name in BAD_STAGES and BAD_STAGES[name] not in problems:
+                problems.append(BAD_STAGES[name])
+            if stage.get("indexName"):
+                indexes.add(stage["indexName"])
+    return {"problems": problems, "indexes": indexes}
+
+
+def redundant_indexes(index_info: Dict[str, Dict]) -> Dict[str, str]:
+    """Индексы, ключ которых — префикс ключа другого индекса без особых опций."""
+    plain = {
+        name: list(info["key"]) for name, info in index_info.items()
+        if name != "_id_" and not (info.get("unique") or info.get("partialFilterExpression") or info.get("sparse"))
+    }
+    result = {}
+    for name, key in plain.items():
+        for other, other_key in plain.items():
+            if other != name and len(other_key) > len(key) and other_key[:len(key)] == key:
+                result[name] = other
+                break
+    return result
+
+
+def _format_size(size: float) -> str:
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+async def _prepare(uri: str, db_name: str, collection: str, layout: str, seed: int) -> Storage:
+    database = Database(uri, db_name)
+    await database.connect(max_retries=1)
+    storage = Storage(database.db, collection, layout=layout)
+    if layout == LAYOUT_SPLIT:
+        await storage.ensure_indexes()
+    else:
+        await database.ensure_indexes(collection)
+
+    for doc_type in sorted({shape.doc_type for shape in QUERY_SHAPES}):
+        target = storage.collection(doc_type)
+        if seed and not await target.count_documents({"type": doc_type}, limit=1):
+            await target.insert_many(_seed_docs(doc_type, seed))
+    return storage
+
+
+async def audit(storage: Storage) -> Dict[str, Any]:
+    db = storage.db
+    used: Dict[str, Set[str]] = {}
+    failures = []
+    for shape in QUERY_SHAPES:
+        target = storage.collection(shape.doc_type)
+        explain = await db.command({"explain": shape.command(target.name), "verbosity": "queryPlanner"})
+        result = analyze_explain(explain)
+        used.setdefault(target.name, set()).update(result["indexes"])
+        indexes = ", ".join(sorted(result["indexes"])) or "-"
+        status = "FAIL" if result["problems"] else "ok"
+        print(f"[{status:4}] {target.name:18} {shape.name:55} {indexes}"
+              + (f"  <- {', '.join(result['problems'])}" if result["problems"] else ""))
+        if result["problems"]:
+            failures.append(shape.name)
+
+    print("\nIndexes:")
+    unused_total = 0
+    for name in sorted(used):
+        collection = db[name]
+        index_info = await collection.index_information()
+        stats = await collection.aggregate([{"$collStats": {"storageStats": {}}}]).to_list(length=None)
+        sizes = stats[0]["storageStats"].get("indexSizes", {}) if stats else {}
+        ops = {row["name"]: row["accesses"]["ops"]
+               async for row in collection.aggregate([{"$indexStats": {}}])}
+        redundant = redundant_indexes(index_info)
+        print(f"  {name}:")
+        for index_name in sorted(index_info):
+            notes = []
+            if index_name != "_id_" and index_name not in used[name]:
+                notes.append("unused by audited queries")
+                unused_total += 1
+            if index_name in redundant:
+                notes.append(f"prefix of {redundant[index_name]}")
+            print(f"    {index_name:70} {_format_size(sizes.get(index_name, 0)):>10}  ops={ops.get(index_name, 0)}"
+                  + (f"  ({'; '.join(notes)})" if notes else ""))
+
+    print(f"\n{len(QUERY_SHAPES)} query shapes, {len(failures)} with COLLSCAN/in-memory SORT, "
+          f"{unused_total} unused indexes")
+    return {"failures": failures, "unused": unused_total}
+
+
+async def run(uri: str, db_name: str, collection: str, layout: str, seed: int, keep: bool) -> int:
+    client = motor.motor_asyncio.AsyncIOMotorClient(uri)
+    try:
+        created = db_name not in await client.list_database_names()
+        storage = await _prepare(uri, db_name, collection, layout, seed)
+        try:
+            result = await audit(storage)
+        finally:
+            storage.db.client.close()
+            if created and not keep:
+                await client.drop_database(db_name)
+        return 1 if result["failures"] else 0
+    finally:
+        client.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="explain() всех форм запросов бота и отчёт по индексам")
+    parser.add_argument("--uri", default="mongodb://localhost:27017")
+    parser.add_argument("--db", default="index_audit", help="временная база создаётся и удаляется после аудита")
+    parser.add_argument("--collection", default=DEFAULT_USERS_COLLECTION)
+    parser.add_argument("--layout", choices=(LAYOUT_SINGLE, LAYOUT_SPLIT), default=LAYOUT_SINGLE)
+    parser.add_argument("--seed", type=int, default=200, help="документов каждого типа в пустых коллекциях")
+    parser.add_argument("--keep", action="store_true", help="не удалять временную базу")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args.uri, args.db, args.collection, args.layout, args.seed, args.keep)))
+
+
+if __name__ == "__main__":
+    main()
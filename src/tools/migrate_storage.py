@@ -0,0 +1,135 @@
+"""Онлайн-миграция общей коллекции в коллекции по типам документов.
+
+Порядок:
+  1. STORAGE_LAYOUT=dual и рестарт бота — новые записи идут в обе раскладки;
+  2. python -m src.tools.migrate_storage copy   — перенос истории пачками;
+  3. python -m src.tools.migrate_storage verify — сверка и исправление расхождений;
+  4. STORAGE_LAYOUT=split и рестарт.
+
+Обе команды сохраняют чекпоинт (последний _id) в коллекции storage_migrations
+и после падения продолжают с него; --reset начинает проход заново.
+"""
+import argparse
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List
+
+import motor.motor_asyncio
+from pymongo import ReplaceOne, UpdateOne
+
+from src import config
+from src.infrastructure.storage import LAYOUT_DUAL, Storage, TYPE_COLLECTIONS
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_COLLECTION = "storage_migrations"
+
+
+async def _load_checkpoint(checkpoints, step: str, reset: bool) -> Dict:
+    if reset:
+        await checkpoints.delete_one({"_id": step})
+    return await checkpoints.find_one({"_id": step}) or {"_id": step, "last_id": None, "processed": 0, "written": 0}
+
+
+async def _save_checkpoint(checkpoints, state: Dict) -> None:
+    await checkpoints.replace_one(
+        {"_id": state["_id"]},
+        {**state, "updated_at": datetime.now(timezone.utc)},
+        upsert=True
+    )
+
+
+async def _copy_batch(storage: Storage, docs: List[Dict], verify: bool) -> int:
+    by_target: Dict[str, List[Dict]] = {}
+    for doc in docs:
+        doc_type = doc.get("type")
+        if doc_type in TYPE_COLLECTIONS:
+            by_target.setdefault(TYPE_COLLECTIONS[doc_type], []).append(doc)
+
+    written = 0
+    for name, group in by_target.items():
+        target = storage.db[name]
+        if verify:
+            existing = {
+                d["_id"]: d async for d in target.find({"_id": {"$in": [doc["_id"] for doc in group]}})
+            }
+            # Общая коллекция остаётся источником истины, пока раскладка не split.
+            ops = [ReplaceOne({"_id": doc["_id"]}, doc, upsert=True)
+                   for doc in group if existing.get(doc["_id"]) != doc]
+        else:
+            # $setOnInsert не перезаписывает документы, уже попавшие в типовую коллекцию через dual-запись.
+            ops = [UpdateOne({"_id": doc["_id"]}, {"$setOnInsert": doc}, upsert=True) for doc in group]
+        if ops:
+            result = await target.bulk_write(ops, ordered=False)
+            written += (result.upserted_count + result.modified_count) if verify else result.upserted_count
+    return written
+
+
+async def _prune_range(storage: Storage, low, high) -> int:
+    """Удаляет из типовых коллекций документы диапазона _id, которых уже нет в общей коллекции
+    (например, черновик сессии удалили между чтением пачки и её копированием)."""
+    id_range = {"$lte": high} if low is None else {"$gt": low, "$lte": high}
+    pruned = 0
+    for name in sorted(set(TYPE_COLLECTIONS.values())):
+        target = storage.db[name]
+        candidates = [d["_id"] async for d in target.find({"_id": id_range}, {"_id": 1})]
+        if not candidates:
+            continue
+        alive = {d["_id"] async for d in storage.legacy.find({"_id": {"$in": candidates}}, {"_id": 1})}
+        orphans = [_id for _id in candidates if _id not in alive]
+        if orphans:
+            result = await target.delete_many({"_id": {"$in": orphans}})
+            pruned += result.deleted_count
+    return pruned
+
+
+async def run(step: str, *, batch_size: int, pause: float, reset: bool) -> Dict:
+    client = motor.motor_asyncio.AsyncIOMotorClient(config.MONGODB_URI)
+    try:
+        db = client[config.DB_NAME]
+        storage = Storage(db, config.USERS_COLLECTION, layout=LAYOUT_DUAL)
+        await storage.ensure_indexes()
+        checkpoints = db[CHECKPOINT_COLLECTION]
+        state = await _load_checkpoint(checkpoints, step, reset)
+        if state.get("finished_at") and not reset:
+            logger.info(f"Step '{step}' already finished, use --reset to run it again")
+            return state
+
+        while True:
+            query = {"_id": {"$gt": state["last_id"]}} if state["last_id"] is not None else {}
+            docs = await storage.legacy.find(query).sort("_id", 1).limit(batch_size).to_list(length=batch_size)
+            if not docs:
+                break
+            state["written"] += await _copy_batch(storage, docs, verify=step == "verify")
+            if step == "verify":
+                state["pruned"] = state.get("pruned", 0) + await _prune_range(storage, state["last_id"], docs[-1]["_id"])
+            state["processed"] += len(docs)
+            state["last_id"] = docs[-1]["_id"]
+            await _save_checkpoint(checkpoints, state)
+            logger.info(f"{step}: processed {state['processed']}, written {state['written']}")
+            if pause:
+                await asyncio.sleep(pause)
+
+        state["finished_at"] = datetime.now(timezone.utc)
+        await _save_checkpoint(checkpoints, state)
+        logger.info(f"{step} finished: processed {state['processed']}, written {state['written']}")
+        return state
+    finally:
+        client.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Перенос users_data в коллекции по типам документов")
+    parser.add_argument("step", choices=("copy", "verify"))
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--pause", type=float, default=0.0, help="пауза между пачками, сек (снижает нагрузку)")
+    parser.add_argument("--reset", action="store_true", help="начать проход заново, игнорируя чекпоинт")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    asyncio.run(run(args.step, batch_size=args.batch_size, pause=args.pause, reset=args.reset))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+from collections import deque
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+ROLE_USER = 0
+ROLE_MODEL = 1
+ROLE_CODES = {"user": ROLE_USER, "model": ROLE_MODEL, "assistant": ROLE_MODEL}
+ROLE_NAMES = ("user", "model")
+SUMMARY_PREFIX = "ПРЕДЫДУЩИЙ КОНСПЕКТ СЕССИИ:"
+
+
+class Turn:
+    __slots__ = ("role", "content")
+
+    def __init__(self, role: int, content: str):
+        self.role = role
+        self.content = content
+
+    @property
+    def role_name(self) -> str:
+        return ROLE_NAMES[self.role]
+
+    def as_dict(self) -> Dict[str, str]:
+        return {"role": self.role_name, "content": self.content}
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, Turn) and other.role == self.role and other.content == self.content
+
+    def __repr__(self) -> str:
+        return f"Turn({self.role_name!r}, {self.content[:30]!r})"
+
+
+class Dialog:
+    """Последние реплики сессии в кольцевом буфере и конспект прошлой сессии отдельно от них.
+
+    Добавление реплики не копирует историю: самая старая вытесняется из deque(maxlen),
+    поэтому стоимость хода и размер состояния FSM ограничены max_turns.
+    """
+
+    __slots__ = ("summary", "_turns")
+
+    def __init__(self, max_turns: int = 20, summary: Optional[str] = None, turns: Iterable[Turn] = ()):
+        self.summary = summary
+        self._turns: "deque[Turn]" = deque(turns, maxlen=max_turns)
+
+    @property
+    def max_turns(self) -> int:
+        return self._turns.maxlen or 0
+
+    def add(self, role: str, content: str) -> None:
+        self._turns.append(Turn(ROLE_CODES.get(role, ROLE_USER), content))
+
+    def __len__(self) -> int:
+        return len(self._turns)
+
+    def __iter__(self) -> Iterator[Turn]:
+        return iter(self._turns)
+
+    def with_turn(self, role: str, content: str) -> Iterator[Turn]:
+        """Реплики так, как они будут выглядеть после add(), без изменения буфера."""
+        skip = 1 if len(self._turns) == self.max_turns else 0
+        yield from islice(self._turns, skip, None)
+        yield Turn(ROLE_CODES.get(role, ROLE_USER), content)
+
+    def summary_message(self) -> Optional[Dict[str, str]]:
+        if not self.summary:
+            return None
+        return {"role": "user", "content": f"{SUMMARY_PREFIX} {self.summary}. Учти его в текущем диалоге."}
+
+    def messages(self) -> Iterator[Dict[str, str]]:
+        """Прежний формат current_dialog: конспект первой репликой, затем диалог."""
+        summary = self.summary_message()
+        if summary is not None:
+            yield summary
+        for turn in self._turns:
+            yield turn.as_dict()
+
+    # --- сериализация ---
+
+    def to_wire(self) -> List[Any]:
+        flat: List[Any] = []
+        for turn in self._turns:
+            flat.append(turn.role)
+            flat.append(turn.content)
+        return [self.max_turns, self.summary, flat]
+
+    @classmethod
+    def from_wire(cls, wire: List[Any]) -> "Dialog":
+        max_turns, summary, flat = wire
+        return cls(max_turns, summary, (Turn(flat[i], flat[i + 1]) for i in range(0, len(flat), 2)))
+
+    @classmethod
+    def from_state(cls, value: Any, max_turns: int = 20) -> "Dialog":
+        """Диалог из данных FSM: Dialog, прежний список словарей или пусто."""
+        if isinstance(value, Dialog):
+            if value.max_turns == max_turns:
+                return value
+            return cls(max_turns, value.summary, value._turns)
+        dialog = cls(max_turns)
+        if not isinstance(value, list):
+            return dialog
+        items = value
+        if items and isinstance(items[0], dict) and str(items[0].get("content", "")).startswith(SUMMARY_PREFIX):
+            dialog.summary = _strip_summary(items[0]["content"])
+            items = items[1:]
+        for item in items:
+            if isinstance(item, dict) and item.get("content"):
+                dialog.add(item.get("role", "user"), str(item["content"]))
+        return dialog
+
+
+def _strip_summary(content: str) -> str:
+    text = content[len(SUMMARY_PREFIX):].strip()
+    suffix = ". Учти его в текущем диалоге."
+    return text[:-len(suffix)] if text.endswith(suffix) else text
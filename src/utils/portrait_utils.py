@@ -32,6 +32,22 @@ def sanitize_portrait_text(text: str) -> str:
     return s
 
 
+def split_into_pages(text: str, max_len: int = 1000) -> list[str]:
+    pages = []
+    text_left = text
+    while text_left:
+        chunk = text_left[:max_len]
+        if len(text_left) > max_len:
+            last_nl = chunk.rfind("\n")
+            last_space = chunk.rfind(" ")
+            cut_at = max(last_nl, last_space)
+            if cut_at > 200:
+                chunk = chunk[:cut_at]
+        pages.append(chunk)
+        text_left = text_left[len(chunk):]
+    return pages
+
+
 async def update_portrait_caption_animation(bot, chat_id: int, message_id: int, stop_event: asyncio.Event):
     animation_texts = [
         "👂 Внимательно слушаю вашу историю...",
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_MAX_MESSAGE_LEN = 4096
+
+
+class ProgressiveMessageEditor:
+
+    def __init__(self, bot, chat_id: int, message_id: int, *, min_interval: float = 1.0,
+                 min_delta_chars: int = 15, cursor: str = " ▌"):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.min_interval = min_interval
+        self.min_delta_chars = min_delta_chars
+        self.cursor = cursor
+        self.edits = 0
+        self.first_chunk_at: Optional[float] = None
+        self._latest = ""
+        self._sent = ""
+        self._last_edit_at = 0.0
+        self._event = asyncio.Event()
+        self._stopped = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def update(self, text: str) -> None:
+        if not text:
+            return
+        if self.first_chunk_at is None:
+            self.first_chunk_at = time.monotonic()
+        self._latest = text
+        self._event.set()
+
+    async def stop(self) -> None:
+        self._stopped = True
+        self._event.set()
+        if self._task is not None:
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                logger.error(f"Error in progressive message editor: {e}")
+
+    async def _run(self) -> None:
+        while not self._stopped:
+            await self._event.wait()
+            self._event.clear()
+            if self._stopped:
+                break
+
+            wait_for = self.min_interval - (time.monotonic() - self._last_edit_at)
+            if wait_for > 0:
+                await asyncio.sleep(wait_for)
+                if self._stopped:
+                    break
+
+            text = self._latest
+            if len(text) - len(self._sent) < self.min_delta_chars and self._sent:
+                continue
+
+            visible = text[:TELEGRAM_MAX_MESSAGE_LEN - len(self.cursor)] + self.cursor
+            try:
+                await self.bot.edit_message_text(
+                    chat_id=self.chat_id,
+                    message_id=self.message_id,
+                    text=visible
+                )
+                self._sent = text
+                self.edits += 1
+            except TelegramRetryAfter as e:
+                logger.warning(f"Stream edit throttled by Telegram, retry after {e.retry_after}s")
+                self._last_edit_at = time.monotonic() + e.retry_after
+                self._event.set()
+                continue
+            except TelegramBadRequest as e:
+                if "message is not modified" not in str(e):
+                    logger.warning(f"Stopping progressive edits: {e}")
+                    return
+            self._last_edit_at = time.monotonic()
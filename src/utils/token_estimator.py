@@ -0,0 +1,101 @@
+import logging
+from typing import Dict, Iterable
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHARS_PER_TOKEN: Dict[str, float] = {
+    "cyrillic": 3.2,
+    "latin": 4.0,
+    "other": 2.0,
+}
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def _script_counts(text: str) -> Dict[str, int]:
+    counts = {"cyrillic": 0, "latin": 0, "other": 0}
+    for ch in text:
+        if "Ѐ" <= ch <= "ӿ":
+            counts["cyrillic"] += 1
+        elif ch.isascii():
+            counts["latin"] += 1
+        else:
+            counts["other"] += 1
+    return counts
+
+
+def _dominant_script(counts: Dict[str, int]) -> str:
+    return max(counts, key=lambda k: counts[k])
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    counts = _script_counts(text)
+    raw = sum(counts[k] / DEFAULT_CHARS_PER_TOKEN[k] for k in counts)
+    return int(raw) + MESSAGE_OVERHEAD_TOKENS
+
+
+class TokenEstimator:
+
+    def __init__(self, calibrate_every: int = 25, smoothing: float = 0.2,
+                 min_correction: float = 0.5, max_correction: float = 2.0):
+        self.calibrate_every = max(1, int(calibrate_every))
+        self.smoothing = smoothing
+        self.min_correction = min_correction
+        self.max_correction = max_correction
+        self._correction: Dict[str, float] = {k: 1.0 for k in DEFAULT_CHARS_PER_TOKEN}
+        self._samples: Dict[str, int] = {k: 0 for k in DEFAULT_CHARS_PER_TOKEN}
+        self._estimates_since_calibration = 0
+
+    def _raw_estimate(self, counts: Dict[str, int]) -> float:
+        return sum(counts[k] / DEFAULT_CHARS_PER_TOKEN[k] for k in counts)
+
+    def estimate(self, text: str) -> int:
+        if not text:
+            return 0
+        self._estimates_since_calibration += 1
+        counts = _script_counts(text)
+        corrected = self._raw_estimate(counts) * self._correction[_dominant_script(counts)]
+        return int(corrected) + MESSAGE_OVERHEAD_TOKENS
+
+    def estimate_many(self, texts: Iterable[str]) -> int:
+        return sum(self.estimate(t) for t in texts if t)
+
+    def should_calibrate(self) -> bool:
+        return self._estimates_since_calibration >= self.calibrate_every
+
+    def begin_calibration(self) -> bool:
+        """Занимает слот калибровки; счётчик сбрасывается сразу, а не после ответа count_tokens.
+
+        Иначе неудачный или ещё не завершённый запрос оставляет счётчик выше порога,
+        и каждая следующая реплика запускает новый удалённый count_tokens.
+        """
+        if not self.should_calibrate():
+            return False
+        self._estimates_since_calibration = 0
+        return True
+
+    def calibrate(self, text: str, actual_tokens: int) -> None:
+        self._estimates_since_calibration = 0
+        if not text or not actual_tokens or actual_tokens <= 0:
+            return
+        counts = _script_counts(text)
+        raw = self._raw_estimate(counts)
+        if raw <= 0:
+            return
+        script = _dominant_script(counts)
+        observed = max(self.min_correction, min(self.max_correction, actual_tokens / raw))
+        previous = self._correction[script]
+        if self._samples[script] == 0:
+            updated = observed
+        else:
+            updated = (1 - self.smoothing) * previous + self.smoothing * observed
+        self._correction[script] = updated
+        self._samples[script] += 1
+        logger.debug(f"Token estimator calibrated for {script}: {previous:.3f} -> {updated:.3f}")
+
+    def get_stats(self) -> Dict[str, Dict[str, float]]:
+        return {
+            script: {"correction": round(self._correction[script], 3), "samples": self._samples[script]}
+            for script in DEFAULT_CHARS_PER_TOKEN
+        }
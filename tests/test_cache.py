@@ -0,0 +1,131 @@
+import asyncio
+
+import pytest
+
+from src.infrastructure.cache import SimpleCache
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def test_concurrent_misses_share_one_load():
+    async def scenario():
+        cache = SimpleCache()
+        calls = 0
+
+        async def loader():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05)
+            return {"n": 1}
+
+        results = await asyncio.gather(*(cache.get_or_compute("user_profile:1", loader) for _ in range(5)))
+        assert results == [{"n": 1}] * 5
+        assert calls == 1
+        stats = cache.get_stats()["by_prefix"]["user_profile"]
+        assert stats["coalesced"] == 4
+        assert stats["sets"] == 1
+
+    _run(scenario())
+
+
+def test_cancelled_waiter_does_not_cancel_shared_load():
+    async def scenario():
+        cache = SimpleCache()
+        release = asyncio.Event()
+
+        async def loader():
+            await release.wait()
+            return "value"
+
+        first = asyncio.create_task(cache.get_or_compute("k", loader))
+        second = asyncio.create_task(cache.get_or_compute("k", loader))
+        await asyncio.sleep(0)
+        first.cancel()
+        release.set()
+        assert await second == "value"
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        assert await cache.get("k") == "value"
+
+    _run(scenario())
+
+
+def test_loader_error_reaches_every_waiter_and_is_not_cached():
+    async def scenario():
+        cache = SimpleCache()
+
+        async def loader():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("db down")
+
+        results = await asyncio.gather(*(cache.get_or_compute("k", loader) for _ in range(3)),
+                                       return_exceptions=True)
+        assert all(isinstance(r, RuntimeError) for r in results)
+        assert await cache.get("k") is None
+
+        async def ok():
+            return 42
+
+        assert await cache.get_or_compute("k", ok) == 42
+
+    _run(scenario())
+
+
+def test_delete_during_load_keeps_result_out_of_cache():
+    async def scenario():
+        cache = SimpleCache()
+        release = asyncio.Event()
+
+        async def loader():
+            await release.wait()
+            return "old"
+
+        task = asyncio.create_task(cache.get_or_compute("k", loader))
+        await asyncio.sleep(0)
+        # Запись инвалидирована, пока шла загрузка: прочитанное до изменения значение не кэшируем.
+        await cache.delete("k")
+        release.set()
+        assert await task == "old"
+        assert await cache.get("k") is None
+
+    _run(scenario())
+
+
+def test_stale_value_served_while_one_refresh_runs():
+    async def scenario():
+        cache = SimpleCache()
+        await cache.set("admin_summary", {"v": 1}, ttl=0, stale_ttl=300)
+        await asyncio.sleep(0.01)
+        calls = 0
+
+        async def loader():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return {"v": 2}
+
+        # Прямой get не отдаёт устаревшую запись: без загрузчика её некому обновить.
+        assert await cache.get("admin_summary") is None
+        assert await cache.get_or_compute("admin_summary", loader, ttl=60, stale_ttl=300) == {"v": 1}
+        assert await cache.get_or_compute("admin_summary", loader, ttl=60, stale_ttl=300) == {"v": 1}
+        await asyncio.sleep(0.05)
+        assert calls == 1
+        assert await cache.get("admin_summary") == {"v": 2}
+
+    _run(scenario())
+
+
+def test_lru_eviction_by_entries():
+    async def scenario():
+        cache = SimpleCache(max_entries=2)
+        await cache.set("a", 1)
+        await cache.set("b", 2)
+        assert await cache.get("a") == 1
+        await cache.set("c", 3)
+        assert await cache.get("b") is None
+        assert await cache.get("a") == 1
+        assert await cache.get("c") == 3
+
+    _run(scenario())
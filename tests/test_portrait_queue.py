@@ -0,0 +1,133 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from mongomock_motor import AsyncMongoMockClient
+
+from src.domain.services import portrait_queue_service
+from src.domain.services.portrait_queue_service import (
+    JOB_TYPE,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_NIGHTLY,
+    PortraitQueue,
+)
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def _queue(generate=None):
+    collection = AsyncMongoMockClient()["test"]["users"]
+
+    async def default_generate(user_id):
+        return "portrait"
+
+    return PortraitQueue(None, collection, generate or default_generate), collection
+
+
+async def _expire_lease(collection, job_id):
+    past = datetime.now(timezone.utc) - timedelta(seconds=1)
+    await collection.update_one({"_id": job_id, "type": JOB_TYPE}, {"$set": {"lease_until": past}})
+
+
+def test_enqueue_keeps_one_active_job_per_user():
+    async def scenario():
+        queue, collection = _queue()
+        job_id, created = await queue.enqueue(1, 10, priority=PRIORITY_NIGHTLY, source="nightly")
+        assert created is True
+        # Нажатие кнопки поверх ночного задания: то же задание, приоритет выше, адрес доставки новый.
+        again, created = await queue.enqueue(1, 10, message_id=55, priority=PRIORITY_INTERACTIVE)
+        assert (again, created) == (job_id, False)
+
+        results = await asyncio.gather(*(queue.enqueue(2, 20) for _ in range(5)))
+        assert len({job for job, _ in results}) == 1
+        assert [created for _, created in results].count(True) == 1
+
+        job = await collection.find_one({"_id": job_id, "type": JOB_TYPE})
+        assert job["priority"] == PRIORITY_INTERACTIVE
+        assert job["message_id"] == 55
+        assert job["source"] == "interactive"
+        assert await collection.count_documents({"type": JOB_TYPE, "active": True}) == 2
+
+    _run(scenario())
+
+
+def test_enqueue_without_message_keeps_delivery_address():
+    async def scenario():
+        queue, collection = _queue()
+        job_id, _ = await queue.enqueue(1, 10, message_id=55)
+        await queue.enqueue(1, 10, priority=PRIORITY_NIGHTLY, source="nightly")
+        job = await collection.find_one({"_id": job_id, "type": JOB_TYPE})
+        assert (job["message_id"], job["source"], job["priority"]) == (55, "interactive", PRIORITY_INTERACTIVE)
+
+    _run(scenario())
+
+
+def test_claim_is_exclusive_until_lease_expires():
+    async def scenario():
+        queue, collection = _queue()
+        job_id, _ = await queue.enqueue(1, 10)
+
+        job = await queue._claim(job_id)
+        assert job["status"] == "running"
+        assert job["attempts"] == 1
+        assert await queue._claim(job_id) is None
+
+        # Процесс с лизом упал: после истечения лиза задание подхватывает другой.
+        await _expire_lease(collection, job_id)
+        job = await queue._claim(job_id)
+        assert job["attempts"] == 2
+
+    _run(scenario())
+
+
+def test_resume_unfinished_requeues_only_expired_leases():
+    async def scenario():
+        queue, collection = _queue()
+        expired, _ = await queue.enqueue(1, 10, priority=PRIORITY_NIGHTLY)
+        held, _ = await queue.enqueue(2, 20)
+        await queue._claim(expired)
+        await queue._claim(held)
+        await _expire_lease(collection, expired)
+
+        fresh = PortraitQueue(None, collection, queue.generate)
+        assert await fresh.resume_unfinished() == 1
+        assert fresh._queue.get_nowait() == (PRIORITY_NIGHTLY, 1, expired)
+
+    _run(scenario())
+
+
+def test_lease_renewed_while_generation_runs(monkeypatch):
+    async def scenario():
+        monkeypatch.setattr(portrait_queue_service, "LEASE_RENEW_SEC", 0.01)
+        queue, collection = _queue()
+        job_id, _ = await queue.enqueue(1, 10)
+        job = await queue._claim(job_id)
+        first_lease = job["lease_until"]
+
+        await asyncio.sleep(0.01)
+        heartbeat = asyncio.create_task(queue._keep_lease(job_id))
+        await asyncio.sleep(0.05)
+        heartbeat.cancel()
+        await asyncio.gather(heartbeat, return_exceptions=True)
+
+        job = await collection.find_one({"_id": job_id, "type": JOB_TYPE})
+        assert job["lease_until"] > first_lease
+
+    _run(scenario())
+
+
+def test_finished_job_frees_slot_for_new_one():
+    async def scenario():
+        queue, collection = _queue()
+        job_id, _ = await queue.enqueue(1, 10)
+        await queue._claim(job_id)
+        finished = await queue._finish(job_id, "done")
+        assert finished["status"] == "done"
+        assert "active" not in finished
+
+        new_id, created = await queue.enqueue(1, 10)
+        assert created is True
+        assert new_id != job_id
+
+    _run(scenario())
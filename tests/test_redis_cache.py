@@ -0,0 +1,79 @@
+import asyncio
+import pickle
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from fakeredis import FakeAsyncRedis
+
+from src.infrastructure.redis_cache import RedisCache
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def test_get_set_roundtrip():
+    async def scenario():
+        cache = RedisCache(FakeAsyncRedis())
+        doc = {"_id": ObjectId(), "user_id": 1, "created_at": datetime(2024, 5, 1, tzinfo=timezone.utc), "tags": ["a"]}
+        await cache.set("user_profile:1", doc, ttl=60)
+        assert await cache.get("user_profile:1") == doc
+        assert await cache.get("user_profile:2") is None
+
+        await cache.delete("user_profile:1")
+        assert await cache.get("user_profile:1") is None
+
+    _run(scenario())
+
+
+def test_pickle_payload_is_dropped_not_loaded():
+    async def scenario():
+        redis = FakeAsyncRedis()
+        cache = RedisCache(redis)
+        await redis.set(cache._redis_key("k"), pickle.dumps(("v", None)))
+        assert await cache.get("k") is None
+        assert await redis.get(cache._redis_key("k")) is None
+
+    _run(scenario())
+
+
+def test_stale_value_served_while_revalidating():
+    async def scenario():
+        cache = RedisCache(FakeAsyncRedis())
+        # ttl=0: запись сразу устаревает, но ещё stale_ttl секунд отдаётся из кэша.
+        await cache.set("admin_summary", {"v": 1}, ttl=0, stale_ttl=300)
+        await asyncio.sleep(0.01)
+
+        calls = 0
+
+        async def loader():
+            nonlocal calls
+            calls += 1
+            return {"v": 2}
+
+        assert await cache.get_or_compute("admin_summary", loader, ttl=60, stale_ttl=300) == {"v": 1}
+        await asyncio.sleep(0.05)
+        assert calls == 1
+        assert await cache.get("admin_summary") == {"v": 2}
+        assert cache.get_stats()["by_prefix"]["admin_summary"]["stale_served"] == 1
+
+    _run(scenario())
+
+
+def test_concurrent_misses_share_one_load():
+    async def scenario():
+        cache = RedisCache(FakeAsyncRedis())
+        calls = 0
+
+        async def loader():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05)
+            return [1, 2, 3]
+
+        results = await asyncio.gather(*(cache.get_or_compute("segment_size:all", loader) for _ in range(5)))
+        assert results == [[1, 2, 3]] * 5
+        assert calls == 1
+        assert await cache.get("segment_size:all") == [1, 2, 3]
+
+    _run(scenario())
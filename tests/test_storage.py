@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+from pymongo import InsertOne, ReturnDocument
+
+from src.infrastructure.storage import (
+    LAYOUT_DUAL,
+    LAYOUT_SINGLE,
+    LAYOUT_SPLIT,
+    RoutedCollection,
+    Storage,
+    StorageRoutingError,
+)
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def _storage(layout):
+    db = AsyncMongoMockClient()["test"]
+    return Storage(db, "users_data", layout=layout), db
+
+
+def test_single_layout_uses_legacy_collection_directly():
+    storage, db = _storage(LAYOUT_SINGLE)
+    assert storage.users_collection() is storage.legacy
+    assert storage.collection("user_message") is storage.legacy
+
+
+def test_unknown_layout_rejected():
+    with pytest.raises(ValueError):
+        _storage("sharded")
+
+
+def test_split_layout_routes_by_type():
+    async def scenario():
+        storage, db = _storage(LAYOUT_SPLIT)
+        users = storage.users_collection()
+        assert isinstance(users, RoutedCollection)
+
+        await users.insert_one({"type": "user_message", "user_id": 1, "text": "hi"})
+        await users.insert_one({"type": "some_future_type", "user_id": 1})
+        await users.update_one({"type": "user_profile", "user_id": 1}, {"$set": {"name": "a"}}, upsert=True)
+
+        assert await db["user_messages"].count_documents({}) == 1
+        assert await db["user_profiles"].count_documents({}) == 1
+        # Типы без своей коллекции остаются в общей.
+        assert await db["users_data"].count_documents({}) == 1
+        assert (await users.find_one({"type": "user_message", "user_id": 1}))["text"] == "hi"
+        assert await users.find({"type": "user_profile"}).to_list(None) != []
+
+    _run(scenario())
+
+
+def test_operation_without_literal_type_is_rejected():
+    async def scenario():
+        storage, _ = _storage(LAYOUT_SPLIT)
+        users = storage.users_collection()
+        with pytest.raises(StorageRoutingError):
+            await users.find_one({"user_id": 1})
+        with pytest.raises(StorageRoutingError):
+            await users.update_one({"type": {"$in": ["user_message", "model_response"]}}, {"$set": {"x": 1}})
+        with pytest.raises(StorageRoutingError):
+            users.aggregate([{"$group": {"_id": "$type"}}])
+
+    _run(scenario())
+
+
+def test_split_insert_many_groups_types_and_keeps_order_of_ids():
+    async def scenario():
+        storage, db = _storage(LAYOUT_SPLIT)
+        users = storage.users_collection()
+        docs = [
+            {"type": "user_message", "user_id": 1},
+            {"type": "model_response", "user_id": 1},
+            {"type": "user_message", "user_id": 2},
+        ]
+        result = await users.insert_many(docs, ordered=False)
+        assert result.inserted_ids == [d["_id"] for d in docs]
+        assert await db["user_messages"].count_documents({}) == 2
+        assert await db["model_responses"].count_documents({}) == 1
+
+    _run(scenario())
+
+
+def test_dual_layout_reads_legacy_and_mirrors_writes():
+    async def scenario():
+        storage, db = _storage(LAYOUT_DUAL)
+        users = storage.users_collection()
+
+        await users.insert_one({"type": "user_message", "user_id": 1, "text": "hi"})
+        doc = await users.find_one_and_update(
+            {"type": "session_draft", "user_id": 1},
+            {"$inc": {"message_count": 1}, "$setOnInsert": {"pending": []}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        await users.update_one({"type": "session_draft", "user_id": 1}, {"$inc": {"message_count": 1}})
+
+        assert await db["users_data"].count_documents({}) == 2
+        assert await db["user_messages"].count_documents({}) == 1
+        # Теневая копия upsert'а получает тот же _id и поля-равенства из фильтра.
+        shadow = await db["session_drafts"].find_one({"_id": doc["_id"]})
+        assert shadow["user_id"] == 1
+        assert shadow["type"] == "session_draft"
+        assert shadow["message_count"] == 2
+
+        await users.delete_many({"type": "user_message", "user_id": 1})
+        assert await db["user_messages"].count_documents({}) == 0
+        assert storage.collection("user_message") is storage.legacy
+
+    _run(scenario())
+
+
+def test_bulk_write_rejects_mixed_types():
+    async def scenario():
+        storage, _ = _storage(LAYOUT_SPLIT)
+        users = storage.users_collection()
+        with pytest.raises(StorageRoutingError):
+            await users.bulk_write([InsertOne({"type": "user_message"}), InsertOne({"type": "portrait"})])
+
+    _run(scenario())
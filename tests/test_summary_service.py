@@ -0,0 +1,144 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from mongomock_motor import AsyncMongoMockClient
+
+from src.domain.services.summary_service import SUMMARY_FAILED_TEXT, SessionSummarizer
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+class FakeLLM:
+    """generate_openai_func: отвечает конспектом с номером вызова; gate задерживает ответ."""
+
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.prompts = []
+        self.gate = None
+
+    async def __call__(self, client, model, prompt, system_instruction):
+        self.prompts.append(prompt)
+        if self.gate is not None:
+            await self.gate.wait()
+        if self.fail:
+            raise RuntimeError("llm down")
+        return f"summary#{len(self.prompts)}"
+
+
+def _summarizer(llm, **kwargs):
+    collection = AsyncMongoMockClient()["test"]["users"]
+    summarizer = SessionSummarizer(collection, openai_client=object(), generate_openai_func=llm,
+                                   fold_every_turns=2, **kwargs)
+    return summarizer, collection
+
+
+def test_fold_keeps_turns_recorded_during_llm_call():
+    async def scenario():
+        llm = FakeLLM()
+        llm.gate = asyncio.Event()
+        summarizer, collection = _summarizer(llm)
+        await summarizer.record_turn(1, "u1", "m1")
+        await summarizer.record_turn(1, "u2", "m2")
+        await asyncio.sleep(0.01)
+        assert len(llm.prompts) == 1
+        # Свёртка ждёт модель; новая реплика не должна пропасть при срезе pending.
+        await summarizer.record_turn(1, "u3", "m3")
+        llm.gate.set()
+        await summarizer.close()
+
+        draft = await collection.find_one({"user_id": 1, "type": "session_draft"})
+        assert draft["running_summary"] == "summary#1"
+        assert draft["folded_messages"] == 4
+        assert [t["content"] for t in draft["pending"]] == ["u3", "m3"]
+        assert await summarizer.running_summary(1) == "summary#1"
+
+    _run(scenario())
+
+
+def test_next_fold_passes_running_summary_to_model():
+    async def scenario():
+        llm = FakeLLM()
+        summarizer, collection = _summarizer(llm)
+        for n in range(4):
+            await summarizer.record_turn(1, f"u{n}", f"m{n}")
+            await asyncio.sleep(0.01)
+        await summarizer.close()
+
+        assert len(llm.prompts) == 2
+        assert "Текущий конспект сессии:\nsummary#1" in llm.prompts[1]
+        draft = await collection.find_one({"user_id": 1, "type": "session_draft"})
+        assert draft["folded_messages"] == 8
+        assert draft["pending"] == []
+
+    _run(scenario())
+
+
+def test_failed_fold_leaves_pending_untouched():
+    async def scenario():
+        summarizer, collection = _summarizer(FakeLLM(fail=True))
+        await summarizer.record_turn(1, "u1", "m1")
+        await summarizer.record_turn(1, "u2", "m2")
+        await summarizer.close()
+
+        draft = await collection.find_one({"user_id": 1, "type": "session_draft"})
+        assert draft["folded_messages"] == 0
+        assert len(draft["pending"]) == 4
+
+    _run(scenario())
+
+
+def test_close_session_claims_draft_once_and_saves_summary():
+    async def scenario():
+        llm = FakeLLM()
+        summarizer, collection = _summarizer(llm)
+        await summarizer.record_turn(7, "hello", "hi")
+
+        assert await summarizer.close_session(7) is True
+        # Черновик уже забран первым вызовом: повторное завершение его не получает.
+        assert await summarizer.close_session(7) is False
+        await summarizer.close()
+
+        summaries = await collection.find({"user_id": 7, "type": "session_summary"}).to_list(None)
+        assert [s["summary"] for s in summaries] == ["summary#1"]
+        assert summaries[0]["full_dialog_length"] == 1
+        assert await collection.find_one({"user_id": 7, "type": "session_draft"}) is None
+
+    _run(scenario())
+
+
+def test_summary_failure_is_recorded_with_placeholder():
+    async def scenario():
+        summarizer, collection = _summarizer(FakeLLM(fail=True))
+        await summarizer.record_turn(7, "hello", "hi")
+        assert await summarizer.close_session(7) is True
+        await summarizer.close()
+
+        summary = await collection.find_one({"user_id": 7, "type": "session_summary"})
+        assert summary["summary"] == SUMMARY_FAILED_TEXT
+
+    _run(scenario())
+
+
+def test_stale_finalize_claim_is_taken_over_by_sweeper():
+    async def scenario():
+        summarizer, collection = _summarizer(FakeLLM(), idle_timeout_min=60)
+        long_ago = datetime.now(timezone.utc) - timedelta(hours=2)
+        await collection.insert_many([
+            # Процесс, начавший завершение, упал: отметка finalizing старше FINALIZE_CLAIM_TIMEOUT_MIN.
+            {"user_id": 1, "type": "session_draft", "last_active": long_ago, "started_at": long_ago,
+             "pending": [{"role": "user", "content": "a"}], "message_count": 1, "running_summary": "",
+             "finalizing": True, "finalizing_since": long_ago},
+            # Завершение идёт прямо сейчас — его не трогаем.
+            {"user_id": 2, "type": "session_draft", "last_active": long_ago, "started_at": long_ago,
+             "pending": [{"role": "user", "content": "b"}], "message_count": 1, "running_summary": "",
+             "finalizing": True, "finalizing_since": datetime.now(timezone.utc)},
+        ])
+
+        assert await summarizer.sweep_idle_sessions() == 1
+        swept = await collection.find_one({"user_id": 1, "type": "session_summary"})
+        assert swept["swept"] is True
+        assert await collection.find_one({"user_id": 2, "type": "session_draft"}) is not None
+
+    _run(scenario())
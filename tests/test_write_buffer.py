@@ -0,0 +1,135 @@
+import asyncio
+
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+from src.infrastructure.write_buffer import DUPLICATE_KEY_ERROR, WriteBehindBuffer
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+class FakeCollection:
+    """insert_many с заранее заданными сбоями: каждый элемент failures — исключение на очередной вызов."""
+
+    def __init__(self, failures=()):
+        self.failures = list(failures)
+        self.calls = []
+        self.docs = []
+
+    async def insert_many(self, docs, ordered=True):
+        assert ordered is False
+        self.calls.append([d["n"] for d in docs])
+        if self.failures:
+            failure = self.failures.pop(0)
+            if callable(failure):
+                failure = failure(docs)
+            if isinstance(failure, BulkWriteError):
+                failed = {err["index"] for err in failure.details["writeErrors"]}
+                self.docs.extend(d for i, d in enumerate(docs) if i not in failed)
+            raise failure
+        self.docs.extend(docs)
+
+
+def _bulk_error(*errors):
+    return BulkWriteError({"writeErrors": [{"index": i, "code": code} for i, code in errors]})
+
+
+def _buffer(collection, **kwargs):
+    options = {"max_batch": 3, "flush_interval": 0.05, "retry_base_delay": 0.001, "retry_max_delay": 0.001}
+    options.update(kwargs)
+    return WriteBehindBuffer(collection, **options)
+
+
+def test_flushes_full_batches_and_remainder_on_close():
+    async def scenario():
+        collection = FakeCollection()
+        buffer = _buffer(collection)
+        buffer.start()
+        for n in range(7):
+            await buffer.put({"n": n})
+        await buffer.close()
+        assert collection.calls == [[0, 1, 2], [3, 4, 5], [6]]
+        assert buffer.get_stats()["written"] == 7
+        assert buffer.get_stats()["pending"] == 0
+
+    _run(scenario())
+
+
+def test_partial_batch_flushed_by_interval():
+    async def scenario():
+        collection = FakeCollection()
+        buffer = _buffer(collection, max_batch=100)
+        buffer.start()
+        await buffer.put({"n": 1})
+        await asyncio.sleep(0.15)
+        assert collection.calls == [[1]]
+        await buffer.close()
+
+    _run(scenario())
+
+
+def test_retries_only_failed_documents():
+    async def scenario():
+        # Документ 0 уже записан прошлой попыткой (дубликат), документ 2 упал по другой причине.
+        collection = FakeCollection([_bulk_error((0, DUPLICATE_KEY_ERROR), (2, 91))])
+        buffer = _buffer(collection)
+        buffer.start()
+        for n in range(3):
+            await buffer.put({"n": n})
+        await buffer.close()
+        assert collection.calls == [[0, 1, 2], [2]]
+        assert sorted(d["n"] for d in collection.docs) == [1, 2]
+        stats = buffer.get_stats()
+        assert stats["written"] == 3
+        assert stats["retries"] == 1
+        assert stats["dropped"] == 0
+
+    _run(scenario())
+
+
+def test_transient_error_retried_then_dropped_after_max_retries():
+    async def scenario():
+        collection = FakeCollection([AutoReconnect("down")] * 3)
+        buffer = _buffer(collection, max_retries=2)
+        await buffer._insert_with_retry([{"n": 1}, {"n": 2}])
+        assert len(collection.calls) == 3
+        stats = buffer.get_stats()
+        assert stats["dropped"] == 2
+        assert stats["retries"] == 2
+        assert collection.docs == []
+
+        collection = FakeCollection([AutoReconnect("blip")])
+        buffer = _buffer(collection)
+        await buffer._insert_with_retry([{"n": 1}])
+        assert [d["n"] for d in collection.docs] == [1]
+
+    _run(scenario())
+
+
+def test_put_writes_directly_when_not_started():
+    async def scenario():
+        collection = FakeCollection()
+        buffer = _buffer(collection)
+        await buffer.put({"n": 5})
+        assert collection.calls == [[5]]
+
+    _run(scenario())
+
+
+def test_full_queue_applies_back_pressure():
+    async def scenario():
+        collection = FakeCollection()
+        buffer = _buffer(collection, max_pending=2, max_batch=1)
+        buffer._flusher_task = asyncio.get_running_loop().create_future()  # запущен, но не разбирает очередь
+        await buffer.put({"n": 1})
+        await buffer.put({"n": 2})
+        blocked = asyncio.create_task(buffer.put({"n": 3}))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+        assert buffer.get_stats()["blocked_puts"] == 1
+        buffer._queue.get_nowait()
+        await asyncio.wait_for(blocked, timeout=1)
+        buffer._flusher_task.cancel()
+
+    _run(scenario())